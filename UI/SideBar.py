@@ -9,10 +9,12 @@ from UI.Templates import (
     LineEdit,
     ProgressBar,
     customFileDialog,
+    Widget,
 )
 from config.uiConfig import configStyleSheet
 from utils import rgbToHex
 from events import EventChildClass
+from client.profiling import formatBytes, formatRecord
 
 
 class DatasetModelItem(ObjectListItem, EventChildClass):
@@ -114,6 +116,17 @@ class DatasetModelItem(ObjectListItem, EventChildClass):
             self.saveButton.setToolTip("Save dataset")
             layout.addWidget(self.saveButton)
 
+            # follow button, for datasets whose file keeps growing
+            if obj.followable:
+                self.followButton = ToolButton(
+                    self.toggleFollowObject, icon="start"
+                )
+                self.followButton.setButtonSize(self.iconSize, self.iconSize)
+                self.followButton.setToolTip(
+                    "Follow file and ingest newly appended configurations"
+                )
+                layout.addWidget(self.followButton)
+
             if (
                 (obj.isSubDataset)
                 and not (obj.frozen)
@@ -213,6 +226,12 @@ class DatasetModelItem(ObjectListItem, EventChildClass):
     def freezeObject(self):
         self.handler.env.freezeSubDataset(self.id)
 
+    def toggleFollowObject(self):
+        env = self.handler.env
+        state = not env.isFollowed(self.id)
+        env.followDataset(self.id, state=state)
+        self.followButton.setIconByName("pause" if state else "start")
+
     def renameObject(self):
         self.titleLabel.setText(
             self.getObject().getName()
@@ -407,6 +426,55 @@ class TasksList(ObjectList, EventChildClass):
         self.removeObject(taskID)
 
 
+class ProfileList(Widget, EventChildClass):
+    """
+    Most recent profiled generations and predictions (see
+    Environment.getProfile), newest first.
+    """
+
+    maxItems = 20
+
+    def __init__(self, handler, **kwargs):
+        super().__init__(layout="vertical", **kwargs)
+        EventChildClass.__init__(self)
+        self.handler = handler
+        self.layout.setContentsMargins(16, 8, 16, 8)
+        self.layout.setSpacing(8)
+        self.labels = []
+
+        self.eventSubscribe("GENERATION_PROFILED", self.onGenerationProfiled)
+
+    def onGenerationProfiled(self, record, taskID=None):
+        names = [n for n in (record["model"], record["dataset"]) if n]
+        title = record["key"]
+        if len(names) > 0:
+            title += f" ({' on '.join(names)})"
+        text = f"{title}\n{formatRecord(record)}"
+        if record["status"] != "done":
+            text += f", {record['status']}"
+
+        label = QtWidgets.QLabel(text)
+        label.setToolTip(
+            f"{record['cacheKey'] or record['key']}\n"
+            f"Configurations: {record['nConfigs']}, atoms: "
+            f"{record['nAtoms']}\n"
+            f"Wall time: {record['wall']:.3f}s\n"
+            f"CPU time: {record['cpu']:.3f}s (this thread: "
+            f"{record['threadCPU']:.3f}s)\n"
+            f"Peak memory increase: {formatBytes(record['peakMemory'])}\n"
+            f"Output: {formatBytes(record['outputBytes'])}"
+        )
+        self.layout.insertWidget(0, label)
+        self.labels.insert(0, label)
+
+        while len(self.labels) > self.maxItems:
+            old = self.labels.pop()
+            self.layout.removeWidget(old)
+            old.deleteLater()
+
+        self.forceUpdateParent()
+
+
 class SideBar(ContentBar):
     def __init__(self, handler, **kwargs):
         super().__init__(handler, **kwargs)
@@ -426,3 +494,7 @@ class SideBar(ContentBar):
         self.tasksList = TasksList(self.handler, parent=self)
         self.addContent("TASKS", widget=self.tasksList)
         self.setExpanded("TASKS")
+
+        self.profileList = ProfileList(self.handler, parent=self)
+        self.addContent("PROFILE", widget=self.profileList)
+        self.setCollapsed("PROFILE")
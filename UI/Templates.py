@@ -1722,7 +1722,10 @@ class SettingsPane(Widget, EventChildClass):
 #############
 
 
-def customFileDialog(parent, fileTypes=None, extensions=None, save=False):
+def customFileDialog(
+    parent, fileTypes=None, extensions=None, save=False, multiple=False
+):
+    # with multiple=True, returns a list of file names instead of a single one
     options = QFileDialog.Options()
 
     if fileTypes is None:
@@ -1748,6 +1751,12 @@ def customFileDialog(parent, fileTypes=None, extensions=None, save=False):
             fileName, selectedFilter = QFileDialog.getSaveFileName(
                 parent, "Save File", "", filterString, options=options
             )
+        elif multiple:
+            fileName, selectedFilter = QFileDialog.getOpenFileNames(
+                parent, "Open Files", "", filterString, options=options
+            )
+            if len(fileName) == 0:
+                return None, None
         else:
             fileName, selectedFilter = QFileDialog.getOpenFileName(
                 parent, "Open File", "", filterString, options=options
@@ -1,5 +1,5 @@
 from events import EventClass
-from PySide6.QtWidgets import QFileDialog
+from PySide6.QtWidgets import QFileDialog, QInputDialog
 from UI.Templates import customFileDialog
 import os
 
@@ -18,12 +18,15 @@ class MenuHandler(EventClass):
         File = mb.addMenu("&File")
         File.addAction("Save", self.onSave, "Ctrl+s")
         File.addAction("Load", self.onLoad, "Ctrl+l")
+        File.addAction("Load Archive", self.onLoadArchive)
 
         File.addAction("Load Dataset", self.onDatasetLoad, "Ctrl+d")
+        File.addAction("Load Sharded Dataset", self.onShardedDatasetLoad)
         File.addAction("Load Model", self.onModelLoad, "Ctrl+e")
 
         File.addAction("Load Zero Model", self.loadZeroModel, "Ctrl+0")
         File.addAction("Load Prediction", self.loadPrepredictedModel)
+        File.addAction("Predict All Models", self.sweepPredictions)
 
         # File.addAction("Preferences", self.onPreferences)
         # File.addAction("Exit", self.onExit)
@@ -58,6 +61,21 @@ class MenuHandler(EventClass):
             threaded=True,
         )
 
+    def onLoadArchive(self):
+        (path, _) = QFileDialog.getOpenFileName(
+            self.handler.window, filter="FFAST archive (*.ffast)"
+        )
+        if path is None or path.strip() == "":
+            return
+
+        self.handler.env.newTask(
+            self.handler.env.load,
+            args=(path,),
+            visual=True,
+            name=f"Loading {os.path.basename(path)}",
+            threaded=True,
+        )
+
     def onPreferences(self):
         pass
 
@@ -76,6 +94,23 @@ class MenuHandler(EventClass):
 
         env.taskLoadDataset(path, typ)
 
+    def onShardedDatasetLoad(self):
+        env = self.handler.env
+        fileTypes = list(env.datasetTypes.keys())
+        extensions = [
+            env.datasetTypes[x].datasetFileExtension for x in fileTypes
+        ]
+        paths, typ = customFileDialog(
+            self.handler.window,
+            fileTypes=fileTypes,
+            extensions=extensions,
+            multiple=True,
+        )
+        if paths is None:
+            return
+
+        env.taskLoadShardedDataset(sorted(paths), typ)
+
     def onModelLoad(self):
         env = self.handler.env
         fileTypes = list(env.modelTypes.keys())
@@ -83,16 +118,28 @@ class MenuHandler(EventClass):
         path, typ = customFileDialog(
             self.handler.window, fileTypes=fileTypes, extensions=extensions
         )
+        if typ not in env.modelTypes:
+            return
 
-        env.taskLoadModel(path, typ)
+        options = {}
+        for key, choices in env.modelTypes[typ].loadOptions.items():
+            value, ok = QInputDialog.getItem(
+                self.handler.window, f"Load {typ} model", key, choices
+            )
+            if not ok:
+                return
+            options[key] = value
+
+        env.taskLoadModel(path, typ, options=options)
 
     def loadPrepredictedModel(self):
         env = self.handler.env
         names = [x.getName() for x in env.getAllDatasets(excludeSubs=True)]
         keys = [x.fingerprint for x in env.getAllDatasets(excludeSubs=True)]
         extensions = ["*.npz"] * len(names)
+        extensions += ["*.npy"] * len(names)
         extensions += ["*"] * len(names)
-        names += names
+        names *= 3
 
         path, typ = customFileDialog(
             self.handler.window, fileTypes=names, extensions=extensions
@@ -100,6 +147,12 @@ class MenuHandler(EventClass):
         idx = names.index(typ)
         env.loadPrepredictedDataset(path, keys[idx])
 
+    def sweepPredictions(self):
+        env = self.handler.env
+        models = env.getAllModels(excludeGhosts=True)
+        for dataset in env.getAllDatasets(excludeSubs=True):
+            env.taskSweepPredictions(models, dataset)
+
     def newLoupe(self):
         self.handler.newLoupe()
 
@@ -0,0 +1,452 @@
+import json
+import logging
+import os
+import time
+import numpy as np
+from client.sessionArchive import isArchivePath
+
+logger = logging.getLogger("FFAST")
+
+# how often (in seconds) batch runs check their targets
+POLL_INTERVAL = 0.5
+# how often (in seconds) verbose batch runs print the task status
+STATUS_INTERVAL = 30
+
+DEFAULT_KEYS = ["energyError", "forcesError"]
+
+# written to save directories, see Environment.dumpProfile
+PROFILE_FILE = "profile.json"
+
+
+def loadInputs(env, datasets, models):
+    """
+    Loads datasets and models synchronously, in the calling thread.
+
+    Args:
+        env (HeadlessEnvironment): Running environment.
+        datasets (list): (datasetType, path) tuples.
+        models (list): (modelType, path) or (modelType, path, options)
+            tuples, see ModelLoader.loadOptions.
+
+    Returns:
+        (datasets, models, errors) tuple, errors is a list of messages for
+        inputs that could not be loaded.
+    """
+    loadedDatasets, loadedModels, errors = [], [], []
+
+    for datasetType, path in datasets:
+        if datasetType not in env.datasetTypes:
+            errors.append(
+                f"Unknown dataset type `{datasetType}`, available: "
+                f"{', '.join(env.datasetTypes)}"
+            )
+            continue
+        try:
+            dataset = env.loadDataset(path, datasetType)
+        except Exception as e:
+            logger.exception(f"Loading dataset `{path}` failed")
+            dataset, reason = None, str(e)
+        else:
+            reason = "see debug.log"
+
+        if dataset is None:
+            errors.append(f"Could not load dataset `{path}` ({reason})")
+        elif dataset not in loadedDatasets:
+            loadedDatasets.append(dataset)
+
+    for modelType, path, *options in models:
+        if modelType not in env.modelTypes:
+            errors.append(
+                f"Unknown model type `{modelType}`, available: "
+                f"{', '.join(env.modelTypes)}"
+            )
+            continue
+        try:
+            model = env.loadModel(
+                path, modelType, options=options[0] if options else None
+            )
+        except Exception as e:
+            logger.exception(f"Loading model `{path}` failed")
+            model, reason = None, str(e)
+        else:
+            reason = "see debug.log"
+
+        if model is None:
+            errors.append(f"Could not load model `{path}` ({reason})")
+        elif model not in loadedModels:
+            loadedModels.append(model)
+
+    return loadedDatasets, loadedModels, errors
+
+
+def getTargets(env, keys, datasets, models):
+    """
+    Expands DataType keys into (key, model, dataset) targets, one per
+    dataset for model independent types and one per model and dataset
+    otherwise.
+
+    Returns:
+        (targets, errors) tuple.
+    """
+    targets, errors = [], []
+    for key in keys:
+        dataType = env.getDataType(key)
+        if dataType is None:
+            errors.append(f"Unknown DataType key `{key}`")
+            continue
+
+        pairModels = models if dataType.modelDependent else [None]
+        for dataset in datasets:
+            for model in pairModels:
+                target = (key, model, dataset)
+                if target not in targets:
+                    targets.append(target)
+
+    return targets, errors
+
+
+def checkTargets(env, targets, dependencies, status):
+    """
+    Updates the status of unfinished targets in place, see waitForTargets.
+
+    Args:
+        dependencies (dict): target -> env.getDependencyKeys of the target.
+        status (dict): target -> "done" or "failed", for finished targets.
+    """
+    for target in targets:
+        if target in status:
+            continue
+
+        key, model, dataset = target
+        if env.hasData(key, model=model, dataset=dataset):
+            status[target] = "done"
+        elif dependencies[target] & env.failedGenerations:
+            status[target] = "failed"
+            for cacheKey in dependencies[target]:
+                env.generationQueue.discard(cacheKey)
+
+
+def waitForTargets(env, targets, timeout=None, verbose=False):
+    """
+    Waits until every target has data or failed. A target fails once the
+    generation of itself or any of its dependencies fails, it is then
+    removed from the generation queue instead of being retried.
+
+    Returns:
+        dict, target -> "done", "failed" or "timeout".
+    """
+    status = {}
+    t0 = lastStatus = time.time()
+    dependencies = {t: env.getDependencyKeys(*t) for t in targets}
+
+    while True:
+        checkTargets(env, targets, dependencies, status)
+        if len(status) == len(targets):
+            return status
+
+        if (timeout is not None) and (time.time() - t0 > timeout):
+            break
+
+        if verbose and (time.time() - lastStatus > STATUS_INTERVAL):
+            env.printTaskStatus()
+            lastStatus = time.time()
+
+        time.sleep(POLL_INTERVAL)
+
+    for target in targets:
+        status.setdefault(target, "timeout")
+    return status
+
+
+def errorMetrics(env, model, dataset):
+    """
+    Energy and force errors of a model on a dataset, from the error data if
+    generated and from the predictions otherwise. Nothing is generated.
+
+    Returns:
+        dict, or None if neither errors nor predictions are available.
+    """
+    metrics = {}
+    for name, key, getReference in (
+        ("energy", "energyError", dataset.getEnergies),
+        ("forces", "forcesError", dataset.getForces),
+    ):
+        if env.hasData(key, model=model, dataset=dataset):
+            diff = env.getData(key, model=model, dataset=dataset).get("diff")
+        elif env.hasData(name, model=model, dataset=dataset):
+            pred = env.getData(name, model=model, dataset=dataset).get(name)
+            diff = np.asarray(pred) - getReference()
+        else:
+            continue
+
+        diff = np.asarray(diff, dtype=np.float64)
+        metrics["nConfigs"] = len(diff)
+        metrics[f"{name}MAE"] = float(np.mean(np.abs(diff)))
+        metrics[f"{name}RMSE"] = float(np.sqrt(np.mean(diff**2)))
+
+    if len(metrics) == 0:
+        return None
+    return metrics
+
+
+METRICS_COLUMNS = [
+    "nConfigs",
+    "energyMAE",
+    "energyRMSE",
+    "forcesMAE",
+    "forcesRMSE",
+]
+
+
+STATUS_COLUMNS = ["key", "model", "dataset", "status"]
+
+
+def getStatusRows(targets, status):
+    return [
+        {
+            "key": key,
+            "model": "-" if model is None else model.getDisplayName(),
+            "dataset": dataset.getDisplayName(),
+            "status": status[(key, model, dataset)],
+        }
+        for key, model, dataset in targets
+    ]
+
+
+def getMetricsRows(env, models, datasets):
+    rows = []
+    for dataset in datasets:
+        for model in models:
+            metrics = errorMetrics(env, model, dataset)
+            if metrics is None:
+                continue
+            rows.append(
+                {
+                    "model": model.getDisplayName(),
+                    "dataset": dataset.getDisplayName(),
+                    **metrics,
+                }
+            )
+    return rows
+
+
+def formatTable(rows, columns):
+    def fmt(v):
+        if v is None:
+            return "-"
+        if isinstance(v, float):
+            return f"{v:.4g}"
+        return str(v)
+
+    cells = [[fmt(row.get(c)) for c in columns] for row in rows]
+    widths = [
+        max([len(c)] + [len(r[i]) for r in cells])
+        for i, c in enumerate(columns)
+    ]
+
+    lines = ["  ".join(c.ljust(w) for c, w in zip(columns, widths))]
+    lines.append("  ".join("-" * w for w in widths))
+    for r in cells:
+        lines.append("  ".join(v.ljust(w) for v, w in zip(r, widths)))
+    return "\n".join(lines)
+
+
+PROFILE_COLUMNS = [
+    "key",
+    "count",
+    "failed",
+    "wall",
+    "cpu",
+    "peak MB",
+    "output MB",
+]
+
+
+def getProfileRows(env):
+    return [
+        {
+            "key": key,
+            "count": s["count"],
+            "failed": s["failed"],
+            "wall": s["wallTotal"],
+            "cpu": s["cpuTotal"],
+            "peak MB": s["peakMemoryMax"] / 1024**2,
+            "output MB": s["outputBytesTotal"] / 1024**2,
+        }
+        for key, s in env.getProfile(summary=True).items()
+    ]
+
+
+def getProfilePath(saveDir):
+    """
+    Default profile path of a save, `profile.json` in save directories and
+    `<name>.profile.json` next to archives. None if not saved.
+    """
+    if saveDir is None:
+        return None
+    if isArchivePath(saveDir):
+        return f"{os.path.splitext(saveDir)[0]}.{PROFILE_FILE}"
+    return os.path.join(saveDir, PROFILE_FILE)
+
+
+def writeProfile(env, path):
+    rows = getProfileRows(env)
+    if len(rows) > 0:
+        print("\nProfile (seconds, peak memory increase):")
+        print(formatTable(rows, PROFILE_COLUMNS))
+    if path is not None:
+        env.dumpProfile(path)
+
+
+def runBatch(
+    env,
+    datasets,
+    models,
+    keys=None,
+    loadDir=None,
+    saveDir=None,
+    metricsPath=None,
+    profilePath=None,
+    timeout=None,
+    verbose=False,
+):
+    """
+    Loads the inputs, generates every key for every model and dataset
+    through the generation queue, prints a summary and saves the session.
+
+    Args:
+        env (HeadlessEnvironment): Running environment.
+        datasets (list): (datasetType, path) tuples.
+        models (list): (modelType, path) tuples.
+        keys (list, optional): DataType keys to generate. Defaults to
+            energy and force errors.
+        loadDir (str, optional): Save directory to load first, data already
+            in it is not generated again. Defaults to None.
+        saveDir (str, optional): Save directory, see Environment.save.
+            Defaults to None (not saved).
+        metricsPath (str, optional): JSON file for the metrics. Defaults
+            to None.
+        profilePath (str, optional): JSON file for the generation profile,
+            see Environment.getProfile. Defaults to getProfilePath of the
+            save.
+        timeout (float, optional): Seconds to wait for the results.
+            Defaults to None (no limit).
+        verbose (bool, optional): Print the task status periodically.
+
+    Returns:
+        int: Exit status, 0 if everything was generated, 1 if any target
+        failed or timed out, 2 if inputs could not be loaded.
+    """
+    keys = keys or DEFAULT_KEYS
+    if loadDir is not None:
+        env.load(loadDir)
+
+    loadedDatasets, loadedModels, errors = loadInputs(env, datasets, models)
+    targets, keyErrors = getTargets(env, keys, loadedDatasets, loadedModels)
+    errors += keyErrors
+    if len(errors) > 0:
+        for e in errors:
+            print(f"ERROR: {e}", flush=True)
+        return 2
+
+    t0 = time.time()
+    for key, model, dataset in targets:
+        env.addToGenerationQueue(key, model=model, dataset=dataset)
+
+    status = waitForTargets(env, targets, timeout=timeout, verbose=verbose)
+    elapsed = time.time() - t0
+
+    print(f"\nGenerated in {elapsed:.1f}s:", flush=True)
+    print(formatTable(getStatusRows(targets, status), STATUS_COLUMNS))
+
+    metricsRows = getMetricsRows(env, loadedModels, loadedDatasets)
+    if len(metricsRows) > 0:
+        print("\nMetrics:")
+        print(formatTable(metricsRows, ["model", "dataset"] + METRICS_COLUMNS))
+    print(flush=True)
+
+    if metricsPath is not None:
+        with open(metricsPath, "w") as f:
+            json.dump(metricsRows, f, indent=4)
+
+    if saveDir is not None:
+        if not isArchivePath(saveDir):
+            os.makedirs(saveDir, exist_ok=True)
+        env.save(saveDir)
+        print(f"Saved to {saveDir}", flush=True)
+
+    writeProfile(env, profilePath or getProfilePath(saveDir))
+
+    failed = [t for t, s in status.items() if s != "done"]
+    return 1 if len(failed) > 0 else 0
+
+
+BENCHMARK_COLUMNS = [
+    "model",
+    "dataset",
+    "dtype",
+    "time",
+    "rate",
+    "speedup",
+    "eMAE",
+    "eMax",
+    "fMAE",
+    "fMax",
+]
+
+
+def runPrecisionBenchmark(env, datasets, models, nConfigs=100):
+    """
+    Compares float32 and float64 inference of every model on every dataset,
+    see MACEModelLoader.benchmarkPrecision, and prints the results.
+
+    Args:
+        env (HeadlessEnvironment): Running environment.
+        datasets (list): (datasetType, path) tuples.
+        models (list): (modelType, path) tuples, models without a
+            benchmarkPrecision method are reported as errors.
+        nConfigs (int, optional): Configurations per dataset. Defaults to
+            100.
+
+    Returns:
+        int: Exit status, 0 if every benchmark ran, 1 if any failed, 2 if
+        inputs could not be loaded.
+    """
+    loadedDatasets, loadedModels, errors = loadInputs(env, datasets, models)
+    for model in loadedModels:
+        if not hasattr(model, "benchmarkPrecision"):
+            errors.append(
+                f"{model.getDisplayName()} has no precision benchmark"
+            )
+    if len(errors) > 0:
+        for e in errors:
+            print(f"ERROR: {e}", flush=True)
+        return 2
+
+    rows, failed = [], False
+    for model in loadedModels:
+        for dataset in loadedDatasets:
+            name = f"{model.getDisplayName()} on {dataset.getDisplayName()}"
+            try:
+                results = model.benchmarkPrecision(dataset, nConfigs=nConfigs)
+            except Exception:
+                logger.exception(f"Precision benchmark of {name} failed")
+                results = None
+            if results is None:
+                print(f"{name}: failed", flush=True)
+                failed = True
+                continue
+            for dtype, r in results.items():
+                rows.append(
+                    {
+                        "model": model.getDisplayName(),
+                        "dataset": dataset.getDisplayName(),
+                        "dtype": dtype,
+                        **r,
+                    }
+                )
+
+    if len(rows) > 0:
+        print("\nPrecision (seconds, configs/s, deltas to float64):")
+        print(formatTable(rows, BENCHMARK_COLUMNS), flush=True)
+    return 1 if failed else 0
@@ -0,0 +1,243 @@
+import logging
+import os
+import threading
+import time
+import numpy as np
+from config.userConfig import getConfig
+from events import setProgressWindow, clearProgressWindow
+
+logger = logging.getLogger("FFAST")
+
+# (model fingerprint, nAtoms) -> tuned batch size
+tunedBatchSizes = {}
+
+CALIBRATION_SIZES = [2**i for i in range(11)]
+
+# calibration stops once throughput falls this far below the best so far
+CALIBRATION_DROP = 0.8
+
+# one calibration at a time, they would skew each other's measurements
+calibrationLock = threading.Lock()
+
+
+def getRSS():
+    """Current resident set size of the process in bytes."""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError, AttributeError):
+        # no procfs (or no os.sysconf on Windows)
+        pass
+
+    try:
+        # POSIX only
+        import resource
+    except ImportError:
+        # no memory measurements (e.g. Windows), caps never apply
+        return 0
+
+    # no procfs, lifetime peak (in kB on Linux, bytes on macOS) instead
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def getMemoryCap():
+    """
+    RSS cap in bytes for batch size calibration, from the
+    `predictionMemoryCap` setting (MB) or half the physical memory.
+    """
+    cap = getConfig("predictionMemoryCap", None)
+    if cap is not None:
+        return cap * 1024**2
+
+    try:
+        return 0.5 * os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES")
+    except (OSError, ValueError, AttributeError):
+        return np.inf
+
+
+class RSSMonitor:
+    """
+    Samples the RSS in a background thread while active, to catch the peak
+    memory use of a prediction call.
+    """
+
+    def __init__(self, interval=0.005):
+        self.interval = interval
+        self.peak = 0
+
+    def __enter__(self):
+        self.peak = getRSS()
+        self.running = True
+        self.thread = threading.Thread(target=self.sample, daemon=True)
+        self.thread.start()
+        return self
+
+    def __exit__(self, *args):
+        self.running = False
+        self.thread.join()
+        self.peak = max(self.peak, getRSS())
+
+    def sample(self):
+        while self.running:
+            self.peak = max(self.peak, getRSS())
+            time.sleep(self.interval)
+
+
+def getBatchSize(model, nAtoms):
+    """
+    Batch size for the model at the given system size: the
+    `predictionBatchSize` setting, or the tuned one when set to "auto".
+
+    Returns:
+        int, or None if not tuned yet.
+    """
+    setting = getConfig("predictionBatchSize", "auto")
+    if setting != "auto":
+        return int(setting)
+
+    return tunedBatchSizes.get((model.fingerprint, nAtoms), None)
+
+
+def tunedPredict(model, dataset, indices=None, taskID=None):
+    """
+    Predicts energies and forces with the batch size given by
+    getBatchSize. If it has not been tuned yet, the first configurations are
+    predicted with increasing batch sizes while measuring throughput and
+    peak RSS, and the fastest size under the memory cap is remembered for
+    the (model, nAtoms) pair. Calibration results are kept, not discarded.
+
+    Calibrations run one at a time. Throughput and RSS are still measured
+    process-wide, so other tasks running meanwhile (e.g. a KDE or another
+    prediction) skew the tuned size, see `predictionBatchSize` to set it.
+
+    Returns:
+        (E, F) tuple, or None if cancelled.
+    """
+    if indices is None:
+        indices = np.arange(dataset.getN())
+
+    nAtoms = dataset.getNAtoms()
+    batchSize = getBatchSize(model, nAtoms)
+    if batchSize is not None:
+        return model.predict(
+            dataset, indices=indices, batchSize=batchSize, taskID=taskID
+        )
+
+    N = len(indices)
+    with calibrationLock:
+        # may have been tuned by another task in the meantime
+        batchSize = getBatchSize(model, nAtoms)
+        if batchSize is None:
+            res = calibrate(model, dataset, indices, taskID=taskID)
+            if res is None:
+                return None
+            start, batchSize, E, F = res
+        else:
+            start, E, F = 0, [], []
+
+    if start < N:
+        kwargs = {} if batchSize is None else {"batchSize": batchSize}
+        if taskID is not None:
+            setProgressWindow(taskID, start, N, N)
+        try:
+            res = model.predict(
+                dataset, indices=indices[start:], taskID=taskID, **kwargs
+            )
+        finally:
+            if taskID is not None:
+                clearProgressWindow(taskID)
+
+        if res is None:
+            return None
+
+        E.append(np.asarray(res[0]).flatten())
+        F.append(np.asarray(res[1]))
+
+    return np.concatenate(E), np.concatenate(F)
+
+
+def calibrate(model, dataset, indices, taskID=None):
+    """
+    Predicts the first configurations with increasing batch sizes, see
+    tunedPredict.
+
+    Returns:
+        (nPredicted, batch size or None, E blocks, F blocks) tuple, or None
+        if cancelled.
+    """
+    N, start = len(indices), 0
+    nAtoms = dataset.getNAtoms()
+    cap = getMemoryCap()
+    best, bestRate, E, F = None, 0, [], []
+
+    # construction and warm-up of lazily constructed models (see
+    # `lazyModelConstruction`) would otherwise be timed as the first step
+    model.ensureConstructed()
+
+    for size in CALIBRATION_SIZES:
+        # leave at least half the work for the tuned batch size
+        if start + size > N // 2:
+            break
+
+        if taskID is not None:
+            setProgressWindow(taskID, start, start + size, N)
+        try:
+            with RSSMonitor() as rss:
+                baseline = rss.peak
+                t0 = time.perf_counter()
+                res = model.predict(
+                    dataset,
+                    indices=indices[start : start + size],
+                    batchSize=size,
+                    taskID=taskID,
+                )
+                dt = time.perf_counter() - t0
+        finally:
+            if taskID is not None:
+                clearProgressWindow(taskID)
+
+        if res is None:
+            return None
+
+        E.append(np.asarray(res[0]).flatten())
+        F.append(np.asarray(res[1]))
+        start += size
+
+        rate = size / max(dt, 1e-9)
+        logger.debug(
+            f"Batch size {size}: {rate:.1f} configs/s, "
+            f"peak RSS {rss.peak / 1024**2:.0f} MB"
+        )
+
+        if rss.peak > cap:
+            break
+        if rate > bestRate:
+            best, bestRate = size, rate
+        elif rate < CALIBRATION_DROP * bestRate:
+            break
+
+        # doubling the batch roughly doubles its memory on top of the baseline
+        if rss.peak + (rss.peak - baseline) > cap:
+            break
+
+        if (taskID is not None) and (not model.env.tm.isTaskRunning(taskID)):
+            return None
+
+    if best is not None:
+        tunedBatchSizes[(model.fingerprint, nAtoms)] = best
+        logger.info(
+            f"Tuned {model.modelName} batch size for {nAtoms} atoms: {best} "
+            f"({bestRate:.1f} configs/s)"
+        )
+    elif start > 0:
+        # even the smallest batch went over the memory cap, remembered too
+        # so that it is not calibrated again on every prediction
+        best = CALIBRATION_SIZES[0]
+        tunedBatchSizes[(model.fingerprint, nAtoms)] = best
+        logger.warning(
+            f"{model.modelName} predictions of {nAtoms} atoms exceed the "
+            f"memory cap ({cap / 1024**2:.0f} MB) even one at a time, "
+            f"using batch size {best}"
+        )
+
+    return start, best, E, F
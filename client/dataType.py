@@ -1,6 +1,8 @@
 import logging
 import time
+import numpy as np
 from events import EventClass
+from config.userConfig import getConfig
 
 logger = logging.getLogger("FFAST")
 
@@ -32,6 +34,19 @@ class DataEntity:
     def keys(self):
         return list(self.data.keys())
 
+    def extend(self, **kwargs):
+        """
+        Appends per-config data (along the first axis), e.g. for new
+        configurations of a followed dataset.
+        """
+        data = dict(self.data)
+        for k, v in kwargs.items():
+            data[k] = np.concatenate([self.data[k], v], axis=0)
+
+        # swapping the dict at once so readers never see half-extended data
+        self.data = data
+        self.timestamp = time.time()
+
     def getSubEntity(self, indices):
         if indices is None:
             return self
@@ -77,6 +92,75 @@ class AtomFilteredEntity(DataEntity):
             return self.parent.get(key=key)[:, self.indices]
 
 
+class PartialDataEntity(DataEntity):
+    """
+    Per-config data known for only some configurations, with a validity
+    mask. Kept apart from the regular cache (see env.partialCache) until
+    every configuration is covered, so that full-dataset metrics never see
+    missing values.
+    """
+
+    def __init__(self, dataType, N):
+        super().__init__(dataType)
+        self.mask = np.zeros(N, dtype=bool)
+
+    def resize(self, N):
+        # followed datasets can grow while partially predicted
+        extra = N - len(self.mask)
+        if extra <= 0:
+            return
+
+        self.mask = np.concatenate([self.mask, np.zeros(extra, dtype=bool)])
+        for k, v in self.data.items():
+            pad = np.full((extra,) + v.shape[1:], np.nan, dtype=v.dtype)
+            self.data[k] = np.concatenate([v, pad], axis=0)
+
+    def missing(self, indices):
+        indices = np.unique(indices)
+        return indices[~self.mask[indices]]
+
+    def isComplete(self):
+        return bool(self.mask.all())
+
+    def getCoverage(self):
+        return self.mask.mean() if len(self.mask) > 0 else 1.0
+
+    def getRanges(self, missing=False):
+        """
+        Covered (or missing) configurations as [start, stop) ranges.
+
+        Returns:
+            (M, 2) int array.
+        """
+        mask = ~self.mask if missing else self.mask
+        edges = np.diff(np.concatenate([[0], mask.astype(np.int8), [0]]))
+        return np.stack(
+            [np.flatnonzero(edges == 1), np.flatnonzero(edges == -1)], axis=1
+        )
+
+    def fill(self, indices, **kwargs):
+        N = len(self.mask)
+        for k, v in kwargs.items():
+            v = np.asarray(v)
+            if k not in self.data:
+                self.data[k] = np.full(
+                    (N,) + v.shape[1:],
+                    np.nan,
+                    dtype=np.result_type(v.dtype, np.float32),
+                )
+            self.data[k][indices] = v
+
+        self.mask[indices] = True
+        self.timestamp = time.time()
+
+
+def rangesToIndices(ranges):
+    # inverse of PartialDataEntity.getRanges
+    if len(ranges) == 0:
+        return np.zeros(0, dtype=int)
+    return np.concatenate([np.arange(a, b) for a, b in ranges])
+
+
 class DataType(EventClass):
     modelDependent = False
     datasetDependent = False
@@ -87,6 +171,7 @@ class DataType(EventClass):
     iterable = False  # if True, results are per-config (e.g. forces, energies..., as opposed to distributions)
     atomFilterable = False  # if True, results are per-atom (e.g. forces)
     atomConstant = False  # if True, results are independent of atom filter (e.g. energy, kind of)
+    extendable = False  # if True, implements extendData (followed datasets)
 
     def __init__(self, env):
         super().__init__()
@@ -163,7 +248,8 @@ class DataType(EventClass):
                     + " successful"
                 )
 
-        return data is not None
+        # False: nothing generated, e.g. a cancelled or failed prediction
+        return (data is not None) and (data is not False)
 
     def checkDependencies(self, dataset=None, model=None):
         if self.dependencies is None:
@@ -231,6 +317,213 @@ class DataType(EventClass):
         de = DataEntity(self, *args, **kwargs)
         return de
 
+    def extendData(self, dataset=None, model=None, indices=None, taskID=None):
+        """
+        Appends data for new configurations of a followed dataset to the
+        already cached entity, instead of regenerating it entirely. Only
+        called for extendable (and iterable) DataTypes.
+
+        Args:
+            indices (array): Indices of the newly appended configurations.
+
+        Returns:
+            success (bool): If False, the cached entity gets deleted instead.
+        """
+        return False
+
+    def getDepth(self):
+        # length of the longest dependency chain, used to extend/generate
+        # data in dependency order
+        if not self.dependencies:
+            return 0
+
+        depths = []
+        for dep in self.dependencies:
+            dt = self.env.getDataType(dep)
+            depths.append(0 if dt is None else dt.getDepth())
+
+        return 1 + max(depths)
+
+
+def predictEnergyForces(env, model, dataset, indices=None, taskID=None):
+    """
+    Runs a singlePredict model, in several worker processes if the
+    `predictionWorkers` setting asks for it and the model can be rebuilt
+    from its file, otherwise with the (auto)tuned batch size. Full-dataset
+    predictions are checkpointed to disk every `predictionCheckpointSize`
+    configurations if set (null or 0, the default, disables checkpoints).
+    """
+    from client.batchTuner import tunedPredict
+
+    nWorkers = getConfig("predictionWorkers", 1)
+    blockSize = getConfig("predictionCheckpointSize", None) or 0
+
+    def predict(indices=None, taskID=None):
+        if (nWorkers > 1) and (model.getFactory() is not None):
+            from client.shardedPrediction import shardedPredict
+
+            return shardedPredict(
+                model,
+                dataset,
+                indices=indices,
+                nWorkers=nWorkers,
+                taskID=taskID,
+            )
+
+        return tunedPredict(model, dataset, indices=indices, taskID=taskID)
+
+    if (indices is not None) or (blockSize <= 0) or model.isGhost:
+        return predict(indices=indices, taskID=taskID)
+
+    from client.predictionCheckpoint import checkpointedPredict
+
+    key = env.getCacheKey("energy", model=model, dataset=dataset)
+    return checkpointedPredict(key, predict, dataset, blockSize, taskID=taskID)
+
+
+def predictPartial(env, model, dataset, indices, taskID=None):
+    """
+    Predicts energies and forces of a dataset at the given indices, skipping
+    configurations already predicted, and merges them into the dataset's
+    partial entity. Once every configuration is covered, the partial entity
+    is promoted to regular energy/forces cache entries.
+
+    Returns:
+        (E, F) at the given indices, or None if cancelled.
+    """
+    partial = getPartialPredictions(env, model, dataset)
+
+    missing = partial.missing(indices)
+    if len(missing) > 0:
+        res = predictEnergyForces(
+            env, model, dataset, indices=missing, taskID=taskID
+        )
+        if res is None:
+            return None
+        partial.fill(
+            missing, energy=np.asarray(res[0]).flatten(), forces=res[1]
+        )
+
+    e, f = partial.get("energy")[indices], partial.get("forces")[indices]
+    promotePartialPredictions(env, model, dataset)
+
+    return e, f
+
+
+def getPartialPredictions(env, model, dataset):
+    """
+    Sparse energy/forces predictions of a model on a root dataset, created
+    if needed and resized to the current dataset size.
+    """
+    key = env.getCacheKey("energy", model=model, dataset=dataset)
+    partial = env.partialCache.get(key, None)
+    if partial is None:
+        partial = PartialDataEntity(env.getDataType("energy"), dataset.getN())
+        env.partialCache[key] = partial
+    partial.resize(dataset.getN())
+
+    return partial
+
+
+def promotePartialPredictions(env, model, dataset):
+    """
+    Turns complete partial predictions into regular energy/forces cache
+    entries.
+
+    Returns:
+        bool: True if promoted.
+    """
+    key = env.getCacheKey("energy", model=model, dataset=dataset)
+    partial = env.partialCache.get(key, None)
+    if (partial is None) or not partial.isComplete():
+        return False
+
+    eData = env.getDataType("energy").newDataEntity(
+        energy=partial.get("energy")
+    )
+    fData = env.getDataType("forces").newDataEntity(
+        forces=partial.get("forces")
+    )
+    env.setData(eData, "energy", model=model, dataset=dataset)
+    env.setData(fData, "forces", model=model, dataset=dataset)
+    env.partialCache.pop(key, None)
+
+    return True
+
+
+def resolveRootIndices(dataset):
+    """
+    Root dataset of nested index-selected sub-datasets and the indices they
+    select in it. Atom filtered datasets are their own root.
+
+    Returns:
+        (dataset, indices) tuple, indices None for the whole dataset.
+    """
+    indices = None
+    while dataset.isSubDataset and not dataset.isAtomFiltered:
+        sub = np.asarray(dataset.indices)
+        if sub.dtype == bool:
+            sub = np.flatnonzero(sub)
+        indices = sub if indices is None else sub[indices]
+        dataset = dataset.parent
+
+    return dataset, indices
+
+
+def predictDataset(env, model, dataset, taskID=None):
+    """
+    Energy/forces predictions of a whole (sub)dataset. Index-selected
+    sub-datasets only predict what their root dataset is missing and share
+    its sparse cache, see predictPartial.
+    """
+    dataset, indices = resolveRootIndices(dataset)
+
+    if dataset.isSubDataset:
+        # atom filtered, predictions do not transfer to the root dataset
+        return predictEnergyForces(env, model, dataset, taskID=taskID)
+
+    if indices is None:
+        key = env.getCacheKey("energy", model=model, dataset=dataset)
+        if key not in env.partialCache:
+            return predictEnergyForces(env, model, dataset, taskID=taskID)
+        indices = np.arange(dataset.getN())
+
+    return predictPartial(env, model, dataset, indices, taskID=taskID)
+
+
+def extendPredictions(env, dataset, model, indices, taskID=None):
+    """
+    Predicts only the given (new) indices and appends them to the cached
+    energy/forces entities of the model/dataset pair.
+    """
+    eData = env.getData("energy", model=model, dataset=dataset)
+    fData = env.getData("forces", model=model, dataset=dataset)
+
+    # singlePredict models extend both entities at once, skip the second call
+    N = dataset.getN()
+    if ((eData is None) or (len(eData.get("energy")) >= N)) and (
+        (fData is None) or (len(fData.get("forces")) >= N)
+    ):
+        return True
+
+    if model.singlePredict:
+        res = predictEnergyForces(
+            env, model, dataset, indices=indices, taskID=taskID
+        )
+        if res is None:
+            return False
+        (e, f) = res
+    else:
+        e = model.predictE(dataset, indices=indices, taskID=taskID)
+        f = model.predictF(dataset, indices=indices, taskID=taskID)
+
+    if eData is not None:
+        eData.extend(energy=e)
+    if fData is not None:
+        fData.extend(forces=f)
+
+    return True
+
 
 class EnergyPredictionData(DataType):
     modelDependent = True
@@ -238,6 +531,7 @@ class EnergyPredictionData(DataType):
     key = "energy"
     iterable = True
     atomConstant = True
+    extendable = True
 
     def __init__(self, *args):
         super().__init__(*args)
@@ -246,7 +540,10 @@ class EnergyPredictionData(DataType):
         env = self.env
 
         if model.singlePredict:
-            (e, f) = model.predict(dataset, taskID=taskID)
+            res = predictDataset(env, model, dataset, taskID=taskID)
+            if res is None:
+                return False
+            (e, f) = res
             fData = self.newDataEntity(forces=f)
             env.setData(fData, "forces", model=model, dataset=dataset)
 
@@ -258,6 +555,11 @@ class EnergyPredictionData(DataType):
 
         return True
 
+    def extendData(self, dataset=None, model=None, indices=None, taskID=None):
+        return extendPredictions(
+            self.env, dataset, model, indices, taskID=taskID
+        )
+
 
 class ForcesPredictionData(DataType):
     modelDependent = True
@@ -265,6 +567,7 @@ class ForcesPredictionData(DataType):
     key = "forces"
     iterable = True
     atomFilterable = True
+    extendable = True
 
     def __init__(self, *args):
         super().__init__(*args)
@@ -273,7 +576,10 @@ class ForcesPredictionData(DataType):
         env = self.env
 
         if model.singlePredict:
-            (e, f) = model.predict(dataset, taskID=taskID)
+            res = predictDataset(env, model, dataset, taskID=taskID)
+            if res is None:
+                return False
+            (e, f) = res
             eData = self.newDataEntity(energy=e)
             env.setData(eData, "energy", model=model, dataset=dataset)
 
@@ -284,3 +590,8 @@ class ForcesPredictionData(DataType):
         env.setData(fData, "forces", model=model, dataset=dataset)
 
         return True
+
+    def extendData(self, dataset=None, model=None, indices=None, taskID=None):
+        return extendPredictions(
+            self.env, dataset, model, indices, taskID=taskID
+        )
@@ -3,13 +3,37 @@ from loaders.datasetLoader import (
     SubDataset,
     FrozenSubDataset,
     AtomFilteredDataset,
+    ShardedDataset,
 )
 from loaders.modelGhost import GhostModelLoader
+from loaders.remoteModel import RemoteModelLoader
+from loaders.prepredicted import (
+    openPrepredicted,
+    isNpyPair,
+    validatePrepredicted,
+    getPrepredictedKey,
+)
 from loaders.zeroModel import ZeroModelLoader
+from client.profiling import (
+    Profile,
+    ProfiledRun,
+    formatRecord,
+    getDataBytes,
+)
+from client.sessionArchive import (
+    SessionArchive,
+    ArchivedDataEntity,
+    ArchivedPartialDataEntity,
+    isArchivePath,
+)
 from tasks import TaskManager
 from client.dataType import DataEntity
-from utils import md5FromArraysAndStrings
-from client.dataType import SubDataEntity
+from utils import md5FromArraysAndStrings, getFileStamp
+from client.dataType import (
+    SubDataEntity,
+    PartialDataEntity,
+    rangesToIndices,
+)
 import logging
 import os, glob
 import numpy as np
@@ -17,10 +41,15 @@ import asyncio
 from utils import loadModules, mixColors
 import json
 import threading, time
+from concurrent.futures import Future, InvalidStateError, wait
 from modules.aseDataset import aseDatasetLoader
+from config.userConfig import getConfig
 
 logger = logging.getLogger("FFAST")
 
+# how often (in seconds) headless scripts check whether tasks are done
+WAIT_INTERVAL = 0.1
+
 
 class Environment(EventClass):
     """
@@ -40,6 +69,8 @@ class Environment(EventClass):
         self.datasets = {}
         self.models = {}
         self.cache = {}
+        # energy cache key -> PartialDataEntity, see dataType.predictPartial
+        self.partialCache = {}
         self.dataTypes = {}
         self.modelTypes = {}
         self.datasetTypes = {}
@@ -50,6 +81,20 @@ class Environment(EventClass):
 
         self.generationQueue = set()
         self.queuedTasks = set()
+        # cache keys whose last generation failed, see generateData
+        self.failedGenerations = set()
+        # real path -> SessionArchive, see saveArchive
+        self.archives = {}
+        # generation/prediction timings, see getProfile
+        self.profile = Profile()
+
+        # (real path, dataset type) -> (file stamp, fingerprint), used to
+        # detect datasets that are already loaded
+        self.datasetPathIndex = {}
+
+        # followed dataset key -> last seen file stamp, see follow mode
+        self.followedDatasets = {}
+        self.lastFollowCheck = 0
 
         # self.eventSubscribe("DATA_UPDATED", self.handleGenerationQueue)
         # self.eventSubscribe("GENERATION_QUEUE_CHANGED", self.handleGenerationQueue)
@@ -132,16 +177,16 @@ class Environment(EventClass):
         else:
             return list(self.models.values())
 
-    def taskLoadModel(self, path, modelType):
+    def taskLoadModel(self, path, modelType, options=None):
         self.newTask(
             self.loadModel,
-            args=(path, modelType),
+            args=(path, modelType, options),
             visual=True,
             name="Loading model",
             threaded=True,
         )
 
-    def loadModel(self, path, modelType, taskID=None):
+    def loadModel(self, path, modelType, options=None, taskID=None):
         if not os.path.exists(path):
             logger.error(f"Tried to load dataset, but path `{path}` not found")
             return None
@@ -152,7 +197,12 @@ class Environment(EventClass):
             )
             return None
 
-        model = self.modelTypes[modelType](self, path)
+        if getConfig("modelServer", None) is not None:
+            model = RemoteModelLoader(
+                self, path, self.modelTypes[modelType], options=options
+            )
+        else:
+            model = self.modelTypes[modelType](self, path, **(options or {}))
         if model is None:
             logging.warn(f"Model `{path}` did not load successfully")
             return
@@ -161,26 +211,37 @@ class Environment(EventClass):
         self.setNewModel(model)
         logging.info(f"Model `{path}` successfully loaded")
 
+        return model
+
     def loadPrepredictedDataset(self, path, datasetKey):
-        if "npz" in path:
-            d = np.load(path, allow_pickle=True)
-            E, F = d["E"], d["F"]
+        """
+        Loads energies and forces predicted outside of FFAST as a model
+        without file. npy pairs and uncompressed npz archives are memory
+        mapped, see loaders.prepredicted.
+        """
+        if ("npz" in path) or isNpyPair(path):
+            E, F, mapped = openPrepredicted(path)
         else:
             aseObject = aseDatasetLoader(path)
             E = aseObject.getEnergies()
             F = aseObject.getForces()
+            mapped = False
 
         dataset = self.getDataset(datasetKey)
-        eDataset = dataset.getEnergies()
-        if E.shape != eDataset.shape:
+        error = validatePrepredicted(E, F, dataset)
+        if error is not None:
             logger.error(
-                f"Shape mismatch when loading prepredicted model. Model energy shape: {E.shape}, dataset energy shape: {eDataset.shape}"
+                f"Could not load prepredicted model `{path}`: {error}"
             )
+            return
 
-        modelKey = md5FromArraysAndStrings(E, F)
+        modelKey = getPrepredictedKey(path, E, F)
+        if mapped:
+            logger.info(f"Prepredicted model `{path}` is memory-mapped")
 
         energyDataType = self.getDataType("energy")
-        energyDataEntity = energyDataType.newDataEntity(energy=E.flatten())
+        # reshape keeps memory maps as views, flatten would copy
+        energyDataEntity = energyDataType.newDataEntity(energy=E.reshape(-1))
         self.setData(
             energyDataEntity, "energy", model=modelKey, dataset=dataset
         )
@@ -264,16 +325,138 @@ class Environment(EventClass):
             )
             return None
 
-        dataset = self.datasetTypes[datasetType](path)
+        dataset = self.constructDataset(path, datasetType)
         if dataset is None:
             logging.warn(f"Dataset `{path}` did not load successfully")
             return
-        dataset.initialise()
+        if self.getDataset(dataset.fingerprint) is dataset:
+            logger.info(
+                f"Dataset `{path}` already loaded as {dataset.getDisplayName()}"
+            )
+            return dataset
 
         self.setNewDataset(dataset)
         logging.info(f"Dataset `{path}` successfully loaded")
         self.lookForGhosts()
 
+        return dataset
+
+    def constructDataset(self, path, datasetType):
+        """
+        Returns an initialised dataset for the path, reusing already loaded
+        instances: a repeat load of an unchanged file skips loading and
+        hashing entirely, and a file with the same content as a loaded
+        dataset (e.g. a copy) shares that dataset's instance and arrays.
+        """
+        indexKey = (os.path.realpath(path), datasetType)
+        stamp = getFileStamp(path)
+
+        entry = self.datasetPathIndex.get(indexKey, None)
+        if (entry is not None) and (entry[0] == stamp):
+            dataset = self.findDatasetInstance(entry[1])
+            if dataset is not None:
+                return dataset
+
+        dataset = self.datasetTypes[datasetType](path)
+        if dataset is None:
+            return None
+        dataset.initialise()
+
+        existing = self.findDatasetInstance(dataset.fingerprint)
+        if existing is not None:
+            logger.info(
+                f"Dataset `{path}` has the same content as `{existing.path}`, sharing the loaded instance"
+            )
+            dataset.onDelete()
+            dataset = existing
+
+        self.datasetPathIndex[indexKey] = (stamp, dataset.fingerprint)
+        return dataset
+
+    def findDatasetInstance(self, fingerprint):
+        # includes shards of sharded datasets, which are not registered
+        dataset = self.getDataset(fingerprint)
+        if dataset is not None:
+            return dataset
+
+        for dataset in list(self.datasets.values()):
+            if not dataset.isSharded:
+                continue
+            for shard in dataset.shards:
+                if shard.fingerprint == fingerprint:
+                    return shard
+
+        return None
+
+    def taskLoadShardedDataset(self, paths, datasetType):
+        self.newTask(
+            self.loadShardedDataset,
+            args=(paths, datasetType),
+            visual=True,
+            name="Loading sharded dataset",
+            threaded=True,
+        )
+
+    def loadShardedDataset(self, paths, datasetType, taskID=None):
+        """
+        Loads several files of the same molecule (all of type datasetType)
+        as one ShardedDataset, without concatenating them.
+        """
+        if datasetType not in self.datasetTypes:
+            logger.error(
+                f"Tried to load sharded dataset, but dataset type {datasetType} not recognised"
+            )
+            return None
+
+        shards = []
+        for i, path in enumerate(paths):
+            if not os.path.exists(path):
+                logger.error(
+                    f"Tried to load dataset shard, but path `{path}` not found"
+                )
+                return None
+
+            self.eventPush(
+                "TASK_PROGRESS",
+                taskID,
+                progMax=len(paths),
+                prog=i,
+                message=f"Loading shard {os.path.basename(path)}",
+                quiet=True,
+            )
+
+            shard = self.constructDataset(path, datasetType)
+            if shard is None:
+                logger.error(f"Dataset shard `{path}` did not load")
+                return None
+            shards.append(shard)
+
+        try:
+            dataset = ShardedDataset(shards)
+        except ValueError as e:
+            logger.error(f"Could not load sharded dataset: {e}")
+            return None
+        dataset.initialise()
+
+        existing = self.getDataset(dataset.fingerprint)
+        if existing is not None:
+            logger.info(
+                f"Sharded dataset already loaded as {existing.getDisplayName()}"
+            )
+            return existing
+
+        self.setNewDataset(dataset)
+        logging.info(f"Sharded dataset of {len(paths)} shards loaded")
+        self.lookForGhosts()
+
+        return dataset
+
+    def isShardFingerprint(self, key):
+        for dataset in self.datasets.values():
+            if dataset.isSharded and key in dataset.getShardFingerprints():
+                return True
+        return False
+
     def declareSubDataset(self, parent, model, idx, subName):
 
         # check if already exists
@@ -327,6 +510,156 @@ class Environment(EventClass):
         sub.initialise()
         self.setNewDataset(sub)
 
+    #############
+    ## FOLLOW MODE (GROWING DATASETS)
+    #############
+
+    def followDataset(self, key, state=True):
+        """
+        Toggles follow mode for a dataset: its file is watched and appended
+        configurations are ingested, extending cached data for the new
+        configurations only (see updateFollowedDataset).
+        """
+        dataset = self.getDataset(key)
+        if dataset is None:
+            return
+
+        if not dataset.followable:
+            logger.error(
+                f"Tried to follow dataset {dataset.getDisplayName()}, but its type does not support follow mode"
+            )
+            return
+
+        if state:
+            self.followedDatasets[key] = dataset.getFileStamp()
+            logger.info(f"Following dataset {dataset.getDisplayName()}")
+        else:
+            self.followedDatasets.pop(key, None)
+
+    def isFollowed(self, key):
+        return key in self.followedDatasets
+
+    async def handleFollowedDatasets(self):
+        if len(self.followedDatasets) == 0:
+            return
+
+        now = time.time()
+        if now - self.lastFollowCheck < getConfig("datasetFollowInterval"):
+            return
+        self.lastFollowCheck = now
+
+        for key, stamp in list(self.followedDatasets.items()):
+            dataset = self.getDataset(key)
+            if dataset is None:
+                del self.followedDatasets[key]
+                continue
+
+            # changes during a running update are picked up on the next check
+            taskKey = f"follow__{key}"
+            if self.tm.isTaskRunning(taskKey):
+                continue
+
+            newStamp = dataset.getFileStamp()
+            if newStamp == stamp:
+                continue
+
+            self.followedDatasets[key] = newStamp
+            self.newTask(
+                self.updateFollowedDataset,
+                args=(key,),
+                visual=True,
+                name="Following dataset",
+                threaded=True,
+                taskKey=taskKey,
+            )
+
+    def updateFollowedDataset(self, key, taskID=None):
+        dataset = self.getDataset(key)
+        if dataset is None:
+            return
+
+        nOld = dataset.getN()
+        nNew = dataset.readNewFrames()
+        if nNew == 0:
+            return
+
+        indices = np.arange(nOld, nOld + nNew)
+        logger.info(
+            f"Dataset {dataset.getDisplayName()} grew by {nNew} configurations (generation {dataset.generation})"
+        )
+        self.eventPush("DATASET_UPDATED", key)
+
+        # extend in dependency order, i.e. predictions before errors
+        entries = []
+        for cacheKey in list(self.cache.keys()):
+            (dataType, model, ds) = self.cacheKeyToComponents(
+                cacheKey, dataTypeObject=True
+            )
+            if (dataType is None) or (ds is not dataset):
+                continue
+            entries.append((dataType.getDepth(), cacheKey, dataType, model))
+        entries.sort(key=lambda x: x[0])
+
+        failed = set()
+        for _, cacheKey, dataType, model in entries:
+            if (taskID is not None) and (not self.tm.isTaskRunning(taskID)):
+                return
+
+            depKeys = [
+                self.getCacheKey(dep, model=model, dataset=dataset)
+                for dep in (dataType.dependencies or [])
+            ]
+
+            if cacheKey in self.queuedTasks:
+                # being generated right now, leave it to that task
+                failed.add(cacheKey)
+                continue
+
+            if dataType.modelDependent and ((model is None) or model.isGhost):
+                # prepredicted data cannot be extended, and keeping it at the
+                # old length would break everything generated from it
+                logger.warning(
+                    f"Cannot extend {cacheKey} of followed dataset, its model is not loaded"
+                )
+                failed.add(cacheKey)
+                self.cache.pop(cacheKey, None)
+                self.eventPush("DATA_UPDATED", cacheKey)
+                continue
+
+            extended = False
+            if (
+                dataType.iterable
+                and dataType.extendable
+                and not any(k in failed for k in depKeys)
+            ):
+                self.eventPush(
+                    "TASK_PROGRESS",
+                    taskID,
+                    message=f"Extending {dataType.key}",
+                    quiet=True,
+                )
+                extended = dataType.extendData(
+                    dataset=dataset,
+                    model=model,
+                    indices=indices,
+                    taskID=taskID,
+                )
+
+            if extended:
+                logger.info(f"Extended {cacheKey} by {nNew} configurations")
+            else:
+                # aggregates (distributions, metrics...) need a full rerun
+                failed.add(cacheKey)
+                self.cache.pop(cacheKey, None)
+
+            self.eventPush("DATA_UPDATED", cacheKey)
+
+        # atom-filtered views grow with their parent, their own data is stale
+        for sub in self.getAllDatasets(subOnly=True):
+            if sub.isAtomFiltered and sub.isDependentOn(dataset):
+                self.deleteCacheByDataset(sub.fingerprint)
+                self.eventPush("DATASET_UPDATED", sub.fingerprint)
+
     #############
     ## OBJECTS (MODELS & DATASETS)
     #############
@@ -347,6 +680,12 @@ class Environment(EventClass):
             if dataset.path == path:
                 return dataset.fingerprint
 
+        # other paths the same (shared) dataset was loaded from
+        realPath = os.path.realpath(path)
+        for (indexPath, _), (_, fp) in self.datasetPathIndex.items():
+            if (indexPath == realPath) and self.datasetExists(fp):
+                return fp
+
         for model in self.getAllModels():
             if model.path == path:
                 return model.fingerprint
@@ -459,6 +798,32 @@ class Environment(EventClass):
 
         return self.cache.get(cacheKey, None)
 
+    def assembleShardedData(self, dataType, model=None, dataset=None):
+        """
+        Builds per-config data of a sharded dataset from data cached for each
+        of its shards (e.g. predictions loaded from per-shard saves). Called
+        when generating, see generateData.
+
+        Returns:
+            success (bool): False if any shard is missing the data.
+        """
+        entities = []
+        for fp in dataset.getShardFingerprints():
+            key = dataType.getCacheKey(model=model, dataset=fp)
+            entity = self.cache.get(key, None)
+            if entity is None:
+                return False
+            entities.append(entity)
+
+        data = {
+            k: np.concatenate([e.get(k) for e in entities])
+            for k in entities[0].keys()
+        }
+        de = dataType.newDataEntity(**data)
+        self.setData(de, dataType.key, model=model, dataset=dataset)
+
+        return True
+
     def setData(self, dataEntity, dataTypeKey, model=None, dataset=None):
         dataType = self.getRegisteredDataType(dataTypeKey)
 
@@ -613,9 +978,47 @@ class Environment(EventClass):
             f"Generating data for key {cacheKey}, model = {sModel}, dataset = {sDataset}"
         )
 
-        generated = dataType.generateData(
-            model=model, dataset=dataset, taskID=taskID
+        run = ProfiledRun(
+            dataTypeKey, cacheKey=cacheKey, model=model, dataset=dataset
+        )
+        # per-shard data (e.g. from per-shard saves) is assembled instead
+        assemble = (
+            (dataset is not None) and dataset.isSharded and dataType.iterable
         )
+        try:
+            with run:
+                generated = assemble and self.assembleShardedData(
+                    dataType, model=model, dataset=dataset
+                )
+                if generated and (dataTypeKey == "energy"):
+                    # forces tasks of singlePredict models become energy
+                    # tasks, see taskGenerateData
+                    forcesDataType = self.getDataType("forces")
+                    self.assembleShardedData(
+                        forcesDataType, model=model, dataset=dataset
+                    )
+                if not generated:
+                    generated = dataType.generateData(
+                        model=model, dataset=dataset, taskID=taskID
+                    )
+        except Exception:
+            self.failedGenerations.add(cacheKey)
+            self.addProfileRecord(run)
+            raise
+
+        outputKeys = [cacheKey]
+        singlePredict = (model is not None) and model.singlePredict
+        if (dataTypeKey == "energy") and singlePredict:
+            # forces come with the energies
+            outputKeys.append(
+                self.getCacheKey("forces", model=model, dataset=dataset)
+            )
+        for key in outputKeys:
+            entity = self.cache.get(key, None)
+            if generated and (entity is not None):
+                run.record["outputBytes"] += getDataBytes(entity.data)
+        run.record["status"] = "done" if generated else "incomplete"
+        self.addProfileRecord(run, taskID=taskID)
 
         if (taskID is not None) and (not self.tm.isTaskRunning(taskID)):
             # check if the task was cancelled, in which case it's normal it
@@ -625,11 +1028,105 @@ class Environment(EventClass):
             # than sorry
             return
 
+        if generated:
+            self.failedGenerations.discard(cacheKey)
+        else:
+            self.failedGenerations.add(cacheKey)
+
         if (not generated) and (not isComponent):
             self.generationQueue.add(cacheKey)
             logger.info(f"Added {cacheKey} to generation queue")
             self.eventPush("GENERATION_QUEUE_CHANGED")
 
+    def taskSweepPredictions(self, models, dataset):
+        self.newTask(
+            self.sweepPredictions,
+            args=(models, dataset),
+            visual=True,
+            name="Prediction sweep",
+            threaded=True,
+        )
+
+    def sweepPredictions(self, models, dataset, taskID=None):
+        """
+        Energy/forces predictions of several models on one dataset, sharing
+        every read of the coordinates, see predictionSweep.sweepPredict.
+        """
+        from client.predictionSweep import sweepPredict
+
+        # keeps regular generation tasks from predicting the same pairs
+        keys = {
+            self.getCacheKey("energy", model=m, dataset=dataset) for m in models
+        }
+        keys -= self.queuedTasks
+        self.queuedTasks.update(keys)
+
+        run = ProfiledRun("predictionSweep", dataset=dataset)
+        run.record["model"] = ", ".join(m.getDisplayName() for m in models)
+        try:
+            with run:
+                done = sweepPredict(self, models, dataset, taskID=taskID)
+            run.record["status"] = "done" if done else "incomplete"
+            return done
+        finally:
+            self.queuedTasks.difference_update(keys)
+            self.addProfileRecord(run, taskID=taskID)
+
+    def addProfileRecord(self, run, taskID=None):
+        record = run.record
+        self.profile.add(record)
+        logger.info(
+            f"Profiled {record['cacheKey'] or record['key']}: "
+            f"{formatRecord(record)}"
+        )
+        self.eventPush("GENERATION_PROFILED", record, taskID)
+
+    def getProfile(self, key=None, summary=False):
+        """
+        Wall time, CPU time, peak memory increase, input sizes and output
+        size of every generation (by DataType key) and prediction sweep
+        (`predictionSweep`) so far, see client.profiling.
+
+        Args:
+            key (str, optional): Only records of this DataType key.
+                Defaults to None (all).
+            summary (bool, optional): Totals and maxima per DataType key
+                instead of the records. Defaults to False.
+
+        Returns:
+            list of record dicts, or dict if summary.
+        """
+        if summary:
+            return self.profile.getSummary()
+        return self.profile.getRecords(key=key)
+
+    def dumpProfile(self, path):
+        self.profile.dump(path)
+
+    def getDependencyKeys(self, dataTypeKey, model=None, dataset=None):
+        """
+        Cache keys of a DataType and everything it (recursively) depends on.
+        """
+        keys, todo = set(), [dataTypeKey]
+        while len(todo) > 0:
+            key = todo.pop()
+            dataType = self.getDataType(key)
+            if dataType is None:
+                continue
+
+            cacheKey = self.getCacheKey(key, model=model, dataset=dataset)
+            if cacheKey in keys:
+                continue
+            keys.add(cacheKey)
+
+            # forces of single-predict models are generated as energies
+            singlePredict = (model is not None) and model.singlePredict
+            if (key == "forces") and singlePredict:
+                todo.append("energy")
+            todo.extend(dataType.dependencies or [])
+
+        return keys
+
     def keyIsHaunted(self, dataTypeKey, model=None, dataset=None):
         if (model is not None) and (not model.isGhost):
             return False
@@ -756,7 +1253,18 @@ class Environment(EventClass):
     ## SAVE/LOAD
     #############
 
-    def save(self, path, taskID=None):
+    def save(self, path, keys=None, taskID=None):
+        """
+        Saves the cache and the names/paths of datasets and models.
+
+        Args:
+            path (str): Save directory.
+            keys (iterable, optional): Cache keys to (re)write, for
+                incremental saves. Defaults to None (everything).
+        """
+        if isArchivePath(path):
+            return self.saveArchive(path, keys=keys)
+
         if not os.path.exists(path):
             os.mkdir(path)
 
@@ -765,9 +1273,11 @@ class Environment(EventClass):
         if not os.path.exists(cacheDir):
             os.mkdir(cacheDir)
 
-        for key, entity in self.cache.items():
+        for key, entity in list(self.cache.items()):
             if isinstance(entity, SubDataEntity):
                 continue
+            if (keys is not None) and (key not in keys):
+                continue
 
             np.savez_compressed(
                 os.path.join(cacheDir, key),
@@ -776,21 +1286,86 @@ class Environment(EventClass):
                 **entity.data,
             )
 
-        ## GENERATE INFO
-        info = {"objects": {}}
+        ## SAVE SPARSE PREDICTIONS, see dataType.predictPartial
+        partialDir = os.path.join(path, "partial")
+        for key, partial in list(self.partialCache.items()):
+            if (keys is not None) and (key not in keys):
+                continue
+            if not partial.mask.any():
+                continue
+            if not os.path.exists(partialDir):
+                os.mkdir(partialDir)
+
+            ranges = partial.getRanges()
+            indices = rangesToIndices(ranges)
+            np.savez_compressed(
+                os.path.join(partialDir, key),
+                cacheKey=key,
+                N=len(partial.mask),
+                ranges=ranges,
+                **{k: v[indices] for k, v in partial.data.items()},
+            )
+
+        ## SAVE INFO
+        infoFile = os.path.join(path, "info.json")
+        with open(infoFile, "w") as f:
+            json.dump(self.getSaveInfo(), f, indent=4)
+
+    def getSaveInfo(self):
+        # dataset/model names and paths, keeping objects of loaded saves
+        # that are not loaded themselves
+        info = {"objects": dict(self.info.get("objects", {}))}
         objects = self.getAllDatasets(excludeSubs=True) + self.getAllModels()
         for o in objects:
             info["objects"][o.fingerprint] = {
                 "name": o.getName(),
                 "path": o.path,
             }
+            if isinstance(o, ShardedDataset):
+                # see loadShardedObjects
+                info["objects"][o.fingerprint].update(
+                    shards=[shard.path for shard in o.shards],
+                    shardType=o.shards[0].datasetName,
+                )
 
-        # dataset/model names and paths
+        return info
 
-        ## SAVE INFO
-        infoFile = os.path.join(path, "info.json")
-        with open(infoFile, "w") as f:
-            json.dump(info, f, indent=4)
+    def getArchive(self, path):
+        key = os.path.realpath(path)
+        if key not in self.archives:
+            self.archives[key] = SessionArchive(path)
+        return self.archives[key]
+
+    def saveArchive(self, path, keys=None):
+        """
+        Saves to a single-file session archive (see client.sessionArchive),
+        appending only entities that are not in it yet or changed since.
+        """
+        archive = self.getArchive(path)
+
+        entities = {}
+        for key, entity in list(self.cache.items()):
+            if isinstance(entity, SubDataEntity):
+                continue
+            if (keys is not None) and (key not in keys):
+                continue
+
+            # unchanged since saved (or loaded from the archive)
+            entry = archive.getEntry(key)
+            if (entry is not None) and entry["timestamp"] == entity.timestamp:
+                continue
+            entities[key] = entity
+
+        partials = {
+            k: p for k, p in self.partialCache.items() if p.mask.any()
+        }
+        archive.write(
+            entities,
+            partials=partials,
+            info=self.getSaveInfo(),
+            codec=getConfig("sessionArchiveCodec", "zlib"),
+        )
+        logger.info(f"Saved {len(entities)} new entities to {path}")
 
     def taskLoad(self, path):
         self.newTask(
@@ -802,6 +1377,9 @@ class Environment(EventClass):
         )
 
     def load(self, path, taskID=None):
+        if isArchivePath(path):
+            return self.loadArchive(path)
+
         # LOAD INFO (names etc)
         infoFile = os.path.join(path, "info.json")
         if os.path.exists(infoFile):
@@ -826,10 +1404,89 @@ class Environment(EventClass):
             self.cache[cacheKey] = de
             self.eventPush("DATA_UPDATED", cacheKey)
 
+        ## LOAD SPARSE PREDICTIONS, merged with those already loaded
+        partialDir = os.path.join(path, "partial")
+        for npzPath in glob.glob(os.path.join(partialDir, "*.npz")):
+            d = dict(np.load(npzPath))
+            cacheKey = str(d.pop("cacheKey"))
+            N = int(d.pop("N"))
+            indices = rangesToIndices(d.pop("ranges"))
+
+            partial = self.partialCache.get(cacheKey, None)
+            if partial is None:
+                partial = PartialDataEntity(self.getDataType("energy"), N)
+                self.partialCache[cacheKey] = partial
+            partial.resize(N)
+            partial.fill(indices, **d)
+
+        self.lookForGhosts()
+
+    def loadArchive(self, path):
+        """
+        Loads the index of a session archive, entities and sparse
+        predictions are only read from it when first accessed (see
+        sessionArchive.ArchivedDataEntity and ArchivedPartialDataEntity).
+        """
+        archive = self.getArchive(path)
+        archive.readIndex()
+        self.loadInfo(archive.index["info"])
+
+        for cacheKey, entry in archive.index["entries"].items():
+            dataType = self.getDataType(entry["dataTypeKey"])
+            if dataType is None:
+                raise ValueError(
+                    f"Tried to load data of type `{entry['dataTypeKey']}`, but no such type registered."
+                )
+
+            self.cache[cacheKey] = ArchivedDataEntity(
+                dataType, archive, cacheKey
+            )
+            self.eventPush("DATA_UPDATED", cacheKey)
+
+        for cacheKey in archive.index["partials"]:
+            partial = self.partialCache.get(cacheKey, None)
+            if partial is None:
+                self.partialCache[cacheKey] = ArchivedPartialDataEntity(
+                    self.getDataType("energy"), archive, cacheKey
+                )
+                continue
+
+            # merged with the one already loaded
+            N, ranges, data = archive.readPartial(cacheKey)
+            partial.resize(N)
+            partial.fill(rangesToIndices(ranges), **data)
+
         self.lookForGhosts()
 
     def loadInfo(self, info):
+        # objects of several loaded saves add up
+        objects = {**self.info.get("objects", {}), **info.get("objects", {})}
         self.info.update(info)
+        self.info["objects"] = objects
+        self.loadShardedObjects(info.get("objects", {}))
+
+    def loadShardedObjects(self, objects):
+        """
+        Reloads the sharded datasets of a save from their shard files, their
+        data is keyed by fingerprints that no single file has.
+        """
+        for fingerprint, o in objects.items():
+            if ("shards" not in o) or self.datasetExists(fingerprint):
+                continue
+
+            missing = [p for p in o["shards"] if not os.path.exists(p)]
+            if len(missing) > 0:
+                logger.warning(
+                    f"Could not reload sharded dataset {o['name']}, "
+                    f"missing shards {missing}"
+                )
+                continue
+
+            dataset = self.loadShardedDataset(o["shards"], o["shardType"])
+            if (dataset is not None) and (dataset.fingerprint != fingerprint):
+                logger.warning(
+                    f"Shards of {o['name']} changed since they were saved"
+                )
 
     def saveDataset(self, dataset, datasetType, form, path, taskID=None):
         self.eventPush(
@@ -853,7 +1510,9 @@ class Environment(EventClass):
             )
             return
 
-        datasetClass.saveDataset(dataset, path, format=form, taskID=taskID)
+        datasetClass.saveDataset(
+            dataset, path, format=form, taskID=taskID, env=self
+        )
 
     def taskSaveDataset(self, dataset, datasetType, form, path):
         self.newTask(
@@ -885,7 +1544,10 @@ class Environment(EventClass):
             if (
                 (dataKey == "forces" or dataKey == "energy")
                 and (modelKey not in self.models)
-                and self.datasetExists(datasetKey)
+                and (
+                    self.datasetExists(datasetKey)
+                    or self.isShardFingerprint(datasetKey)
+                )
             ):
                 model = GhostModelLoader(self, modelKey)
                 model.initialise()
@@ -911,6 +1573,10 @@ class HeadlessEnvironment(Environment, threading.Thread):
         threading.Thread.__init__(self)
         self.loop = None
 
+        # cache key -> (futures, dependency cache keys), see generate
+        self.pendingFutures = {}
+        self.futuresLock = threading.Lock()
+
     def run(self):
         self.loop = asyncio.new_event_loop()
         asyncio.set_event_loop(self.loop)
@@ -921,52 +1587,171 @@ class HeadlessEnvironment(Environment, threading.Thread):
         while not self.quitReady:
             await self.eventHandle()
             await self.handleGenerationQueue()
+            await self.handleFollowedDatasets()
             await taskManager.eventHandle()
             await taskManager.handleTaskQueue()
+            self.handleFutures()
             await asyncio.sleep(0.1)
 
         await self.eventHandle()
         await taskManager.eventHandle()
+        self.handleFutures()
+        self.cancelFutures()
 
     def headlessQuit(self):
         self.quitReady = True
 
-    def waitForTasks(self, verbose=False, dt=5):
+    def generate(self, dataTypeKey, model=None, dataset=None):
+        """
+        Generates data through the generation queue, without blocking.
+
+        Returns:
+            concurrent.futures.Future resolving to the DataEntity once it
+            and its dependencies are generated, or failing with a
+            RuntimeError if any of them fails to generate. Use
+            asyncio.wrap_future to await it, and gather to wait for many.
+        """
+        future = Future()
+        cacheKey = self.getCacheKey(dataTypeKey, model=model, dataset=dataset)
+        if cacheKey is None:
+            future.set_exception(
+                KeyError(f"No cache key for DataType `{dataTypeKey}`")
+            )
+            return future
+
+        if self.hasData(dataTypeKey, model=model, dataset=dataset):
+            future.set_result(
+                self.getData(dataTypeKey, model=model, dataset=dataset)
+            )
+            return future
+
+        with self.futuresLock:
+            if cacheKey not in self.pendingFutures:
+                dependencies = self.getDependencyKeys(
+                    dataTypeKey, model=model, dataset=dataset
+                )
+                self.pendingFutures[cacheKey] = ([], dependencies)
+            futures, dependencies = self.pendingFutures[cacheKey]
+            futures.append(future)
+            # retried, earlier failures would fail the future right away
+            self.failedGenerations.difference_update(dependencies)
+
+        self.addToGenerationQueue(dataTypeKey, model=model, dataset=dataset)
+        return future
+
+    def gather(self, *futures, timeout=None):
+        """
+        Waits for futures of generate, e.g.
+            env.gather(*[env.generate("forces", m, d) for m in models])
+
+        Returns:
+            list of DataEntity, in order. Raises the exception of the first
+            failed future, or TimeoutError.
+        """
+        done, notDone = wait(futures, timeout=timeout)
+        if len(notDone) > 0:
+            raise TimeoutError(f"{len(notDone)} generations not done in time")
+        return [f.result() for f in futures]
+
+    def handleFutures(self):
+        # futures are resolved outside of the lock, their callbacks may
+        # call generate
+        resolved = []
+        with self.futuresLock:
+            for cacheKey, (futures, dependencies) in list(
+                self.pendingFutures.items()
+            ):
+                (dataTypeKey, model, dataset) = self.cacheKeyToComponents(
+                    cacheKey
+                )
+                futures[:] = [f for f in futures if not f.done()]
+
+                if self.hasData(dataTypeKey, model=model, dataset=dataset):
+                    de = self.getData(
+                        dataTypeKey, model=model, dataset=dataset
+                    )
+                    resolved += [(f, de, None) for f in futures]
+                    futures.clear()
+                elif dependencies & self.failedGenerations:
+                    failed = sorted(dependencies & self.failedGenerations)
+                    e = RuntimeError(f"Could not generate {failed}")
+                    resolved += [(f, None, e) for f in futures]
+                    futures.clear()
+                    # failed dependencies would otherwise be retried
+                    self.generationQueue.difference_update(dependencies)
+
+                if len(futures) == 0:
+                    del self.pendingFutures[cacheKey]
+
+        for future, result, exception in resolved:
+            try:
+                if exception is None:
+                    future.set_result(result)
+                else:
+                    future.set_exception(exception)
+            except InvalidStateError:
+                # cancelled by the caller in the meantime
+                pass
+
+    def cancelFutures(self):
+        with self.futuresLock:
+            futures = [f for fs, _ in self.pendingFutures.values() for f in fs]
+            self.pendingFutures.clear()
+
+        for future in futures:
+            future.cancel()
+
+    def isBusy(self):
         tm = self.tm
-        while (
+        return (
             (tm.taskQueue.qsize() > 0)
             or (len(tm.runningTasks) > 0)
             or (len(self.generationQueue) > 0)
-        ) and not self.quitReady:
-            if verbose:
-                print("-" * 20)
-                lTaskQueue = tm.taskQueue.qsize()
-                if lTaskQueue > 0:
-                    print(f"{lTaskQueue} tasks queued.\n")
-
-                lRunningTasks = len(tm.runningTasks)
-                if lRunningTasks > 0:
-                    print(f"{lRunningTasks} tasks running:")
-                    for taskID in tm.runningTasks:
-                        task = tm.getTask(taskID)
-                        prog = "?%"
-                        if task["progress"] is not None:
-                            prog = f'{task["progress"]*100:.0f}%'
-
-                        print(
-                            f'{prog:<4} {task["name"]:<20}  {task["progressMessage"]}'
-                        )
-                    print()
+        )
 
-                lGenQueue = len(self.generationQueue)
-                if lGenQueue > 0:
-                    print(f"{lGenQueue} tasks in generation queue:")
-                    for i in self.generationQueue:
-                        print(i)
+    def waitForTasks(self, verbose=False, dt=5):
+        """
+        Waits until no task is queued or running and the generation queue
+        is empty, printing the task status every `dt` seconds if verbose.
+        """
+        lastStatus = 0
+        while self.isBusy() and not self.quitReady:
+            if verbose and (time.time() - lastStatus >= dt):
+                self.printTaskStatus()
+                lastStatus = time.time()
+
+            time.sleep(WAIT_INTERVAL)
+
+    def printTaskStatus(self):
+        tm = self.tm
+        print("-" * 20)
+        lTaskQueue = tm.taskQueue.qsize()
+        if lTaskQueue > 0:
+            print(f"{lTaskQueue} tasks queued.\n")
+
+        lRunningTasks = len(tm.runningTasks)
+        if lRunningTasks > 0:
+            print(f"{lRunningTasks} tasks running:")
+            for taskID in list(tm.runningTasks):
+                task = tm.getTask(taskID)
+                if task is None:
+                    continue
+                prog = "?%"
+                if task["progress"] is not None:
+                    prog = f'{task["progress"]*100:.0f}%'
+
+                print(
+                    f'{prog:<4} {task["name"]:<20}  {task["progressMessage"]}'
+                )
+            print()
 
-                print(flush=True)
+        lGenQueue = len(self.generationQueue)
+        if lGenQueue > 0:
+            print(f"{lGenQueue} tasks in generation queue:")
+            for i in list(self.generationQueue):
+                print(i)
 
-            time.sleep(dt)
+        print(flush=True)
 
 
 def startHeadlessEnvironment():
@@ -0,0 +1,316 @@
+import csv
+import json
+import logging
+import os
+import time
+from config.userConfig import config
+from client.batchRun import (
+    DEFAULT_KEYS,
+    METRICS_COLUMNS,
+    POLL_INTERVAL,
+    PROFILE_FILE,
+    STATUS_INTERVAL,
+    checkTargets,
+    formatTable,
+    getMetricsRows,
+    getTargets,
+    loadInputs,
+    writeProfile,
+)
+
+logger = logging.getLogger("FFAST")
+
+# rough in-memory copies of a dataset's coordinates per cell (coordinates,
+# reference and predicted forces, force errors)
+CELL_MEMORY_FACTOR = 4
+
+
+class ManifestError(Exception):
+    pass
+
+
+def readManifest(path):
+    """
+    Reads a JSON or TOML (Python >= 3.11 or the tomli package) manifest:
+
+        {
+            "datasets": [{"type": "sGDML", "path": "train.npz"}],
+            "models": [
+                {"type": "MACE", "path": "a.model"},
+                {"type": "MACE", "path": "b.model",
+                    "options": {"precision": "float32"}}
+            ],
+            "data": ["energyError", "forcesError"],
+            "output": "results",
+            "resources": {"cores": 32, "memory": 64000, "threads": 4}
+        }
+
+    Relative paths are relative to the manifest. `data` defaults to energy
+    and force errors, `output` to `<manifest name>_results`. Resources:
+        cores: Cores to use. Defaults to all.
+        memory: Memory budget in MB. Defaults to `predictionMemoryCap`, or
+            half the physical memory.
+        threads: Torch threads per cell. Defaults to sharing the cores
+            between all cells.
+        workers: Prediction worker processes per cell, see
+            `predictionWorkers`. Defaults to 1.
+        cellMemory: Memory estimate per cell in MB, overrides the estimate
+            from the dataset size.
+
+    Returns:
+        dict, the normalised manifest.
+    """
+    with open(path, "rb") as f:
+        if path.endswith(".toml"):
+            try:
+                import tomllib
+            except ImportError:
+                try:
+                    import tomli as tomllib
+                except ImportError:
+                    raise ManifestError(
+                        "TOML manifests need Python >= 3.11 or tomli"
+                    )
+            manifest = tomllib.load(f)
+        else:
+            manifest = json.load(f)
+
+    root = os.path.dirname(os.path.abspath(path))
+
+    def entries(name):
+        out = []
+        for e in manifest.get(name, []):
+            if ("type" not in e) or ("path" not in e):
+                raise ManifestError(f"{name} entries need a type and a path")
+            out.append(
+                (
+                    e["type"],
+                    os.path.join(root, e["path"]),
+                    e.get("options", None),
+                )
+            )
+        return out
+
+    datasets, models = entries("datasets"), entries("models")
+    if (len(datasets) == 0) or (len(models) == 0):
+        raise ManifestError("manifests need at least a dataset and a model")
+
+    name = os.path.splitext(os.path.basename(path))[0]
+    output = manifest.get("output", f"{name}_results")
+
+    return {
+        "datasets": [(t, p) for t, p, _ in datasets],
+        "models": models,
+        "data": manifest.get("data", DEFAULT_KEYS),
+        "output": os.path.join(root, output),
+        "resources": manifest.get("resources", {}),
+    }
+
+
+def getBudget(resources, nCells):
+    """
+    Returns:
+        (threads per cell, maximum concurrent cells, memory budget in bytes)
+    """
+    from client.batchTuner import getMemoryCap
+
+    cores = resources.get("cores", None) or os.cpu_count() or 1
+    workers = max(1, resources.get("workers", 1))
+    threads = resources.get("threads", None)
+    if threads is None:
+        threads = max(1, cores // max(1, nCells * workers))
+
+    concurrent = max(1, cores // (threads * workers))
+    memory = resources.get("memory", None)
+    memory = getMemoryCap() if memory is None else memory * 1024**2
+
+    return threads, concurrent, memory
+
+
+def estimateCellMemory(dataset, resources):
+    if resources.get("cellMemory", None) is not None:
+        return resources["cellMemory"] * 1024**2
+    return CELL_MEMORY_FACTOR * dataset.getN() * dataset.getNAtoms() * 3 * 8
+
+
+class Cell:
+    def __init__(self, env, model, dataset, targets):
+        self.model = model
+        self.dataset = dataset
+        self.targets = targets
+        self.dependencies = {t: env.getDependencyKeys(*t) for t in targets}
+        self.status = {}
+        self.t0 = None
+        self.elapsed = None
+        self.memory = 0
+
+    def isCached(self, env):
+        return all(
+            env.hasData(k, model=m, dataset=d) for k, m, d in self.targets
+        )
+
+    def start(self, env):
+        self.t0 = time.time()
+        for key, model, dataset in self.targets:
+            env.addToGenerationQueue(key, model=model, dataset=dataset)
+
+    def update(self, env):
+        checkTargets(env, self.targets, self.dependencies, self.status)
+        if len(self.status) < len(self.targets):
+            return False
+
+        self.elapsed = time.time() - self.t0
+        return True
+
+    def getCacheKeys(self, env):
+        keys = set().union(*self.dependencies.values())
+        return {k for k in keys if k in env.cache}
+
+    def getStatus(self):
+        if self.t0 is None:
+            return "cached"
+        if len(self.status) < len(self.targets):
+            return "timeout"
+        if all(s == "done" for s in self.status.values()):
+            return "done"
+        return "failed"
+
+
+def runGrid(env, manifest, timeout=None, verbose=False):
+    """
+    Evaluates every model on every dataset of a manifest (see readManifest).
+    Cells (model/dataset pairs) run concurrently through the generation
+    queue, as many as the core budget allows and only while the memory
+    budget has room for their estimated size. Finished cells are saved to
+    the output directory right away, and cells already in the output
+    directory are skipped, so an interrupted grid resumes where it stopped.
+    A consolidated metrics table is written to `metrics.csv` and
+    `metrics.json` in the output directory, the generation profile (see
+    Environment.getProfile) to `profile.json`.
+
+    Returns:
+        int: Exit status, 0 if every cell is done, 1 if any cell failed or
+        timed out, 2 if inputs could not be loaded.
+    """
+    from client.batchTuner import getRSS
+    from loaders.modelLoader import configureTorchRuntime
+
+    output, resources = manifest["output"], manifest["resources"]
+    if os.path.exists(os.path.join(output, "info.json")):
+        print(f"Resuming from {output}", flush=True)
+        env.load(output)
+
+    # models are constructed (and warmed up) once the thread budget is
+    # known, see below
+    lazy = config.get("lazyModelConstruction", False)
+    config["lazyModelConstruction"] = True
+    try:
+        datasets, models, errors = loadInputs(
+            env, manifest["datasets"], manifest["models"]
+        )
+    finally:
+        config["lazyModelConstruction"] = lazy
+    _, keyErrors = getTargets(env, manifest["data"], [], [])
+    errors += keyErrors
+    if len(errors) > 0:
+        for e in errors:
+            print(f"ERROR: {e}", flush=True)
+        return 2
+
+    cells = []
+    for dataset in datasets:
+        for model in models:
+            targets, _ = getTargets(env, manifest["data"], [dataset], [model])
+            cells.append(Cell(env, model, dataset, targets))
+
+    pending = [c for c in cells if not c.isCached(env)]
+    threads, concurrent, memoryBudget = getBudget(resources, len(pending))
+    config["torchThreads"] = threads
+    config["predictionWorkers"] = max(1, resources.get("workers", 1))
+    configureTorchRuntime(threads=threads)
+    for model in models:
+        try:
+            model.ensureConstructed()
+        except Exception as e:
+            logger.exception(f"Constructing {model.getDisplayName()} failed")
+            errors.append(f"Could not load model `{model.path}` ({e})")
+    if len(errors) > 0:
+        for e in errors:
+            print(f"ERROR: {e}", flush=True)
+        return 2
+    print(
+        f"{len(cells)} cells, {len(cells) - len(pending)} cached, "
+        f"up to {concurrent} at a time",
+        flush=True,
+    )
+
+    os.makedirs(output, exist_ok=True)
+    running = []
+    baseline = getRSS()
+    t0 = lastStatus = time.time()
+    while (len(pending) > 0) or (len(running) > 0):
+        for cell in list(running):
+            if cell.update(env):
+                running.remove(cell)
+                env.save(output, keys=cell.getCacheKeys(env))
+                print(
+                    f"{cell.model.getDisplayName()} on "
+                    f"{cell.dataset.getDisplayName()}: {cell.getStatus()} "
+                    f"({cell.elapsed:.1f}s)",
+                    flush=True,
+                )
+
+        while (len(pending) > 0) and (len(running) < concurrent):
+            cell = pending[0]
+            cell.memory = estimateCellMemory(cell.dataset, resources)
+            reserved = sum(c.memory for c in running)
+            if (len(running) > 0) and (
+                baseline + reserved + cell.memory > memoryBudget
+            ):
+                break
+            pending.pop(0)
+            cell.start(env)
+            running.append(cell)
+
+        if (timeout is not None) and (time.time() - t0 > timeout):
+            break
+
+        if verbose and (time.time() - lastStatus > STATUS_INTERVAL):
+            env.printTaskStatus()
+            lastStatus = time.time()
+
+        time.sleep(POLL_INTERVAL)
+
+    rows = [
+        {
+            "model": c.model.getDisplayName(),
+            "dataset": c.dataset.getDisplayName(),
+            "status": c.getStatus(),
+            "time": c.elapsed,
+        }
+        for c in cells
+    ]
+    print(f"\nGrid finished in {time.time() - t0:.1f}s:")
+    print(formatTable(rows, ["model", "dataset", "status", "time"]))
+
+    metricsRows = getMetricsRows(env, models, datasets)
+    writeMetrics(output, metricsRows)
+    if len(metricsRows) > 0:
+        print("\nMetrics:")
+        print(formatTable(metricsRows, ["model", "dataset"] + METRICS_COLUMNS))
+    writeProfile(env, os.path.join(output, PROFILE_FILE))
+    print(f"\nResults in {output}", flush=True)
+
+    failed = [c for c in cells if c.getStatus() not in ("done", "cached")]
+    return 1 if len(failed) > 0 else 0
+
+
+def writeMetrics(output, rows):
+    columns = ["model", "dataset"] + METRICS_COLUMNS
+    with open(os.path.join(output, "metrics.csv"), "w", newline="") as f:
+        writer = csv.DictWriter(f, fieldnames=columns)
+        writer.writeheader()
+        writer.writerows(rows)
+
+    with open(os.path.join(output, "metrics.json"), "w") as f:
+        json.dump(rows, f, indent=4)
@@ -0,0 +1,366 @@
+import argparse
+import json
+import logging
+import os
+import secrets
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from multiprocessing import resource_tracker, shared_memory
+from multiprocessing.connection import Client, Listener
+import numpy as np
+
+logger = logging.getLogger("FFAST")
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# how long (in seconds) to wait for an autostarted server to accept
+STARTUP_TIMEOUT = 30
+
+# per-user secret clients authenticate with, see getAuthKey
+DEFAULT_KEY_FILE = os.path.join("~", ".ffast", "modelServer.key")
+AUTH_KEY_BYTES = 32
+
+PIPE_PREFIX = "\\\\.\\pipe\\"
+
+
+def parseAddress(address):
+    """
+    Unix socket path, or `\\\\.\\pipe\\name` named pipe on Windows.
+    Requests can load arbitrary model code, so the server is only reachable
+    from this node: TCP addresses and remote pipes are refused.
+
+    Raises:
+        ValueError: If the address is not a local socket or pipe.
+    """
+    if address.startswith("\\\\"):
+        if not address.startswith(PIPE_PREFIX):
+            raise ValueError(f"`{address}` is not a local named pipe")
+        return address
+
+    if sys.platform == "win32":
+        raise ValueError(
+            f"`{address}` is not a named pipe, e.g. `{PIPE_PREFIX}ffast`"
+        )
+    host, sep, port = address.rpartition(":")
+    if sep and port.isdigit() and ("/" not in address):
+        raise ValueError(
+            f"TCP model server addresses (`{address}`) are not supported, "
+            "use a unix socket path"
+        )
+    return os.path.expanduser(address)
+
+
+def getAuthKey():
+    """
+    Reads the secret shared by the server and its clients from
+    `modelServerKeyFile` (defaults to ~/.ffast/modelServer.key), generating
+    it on first use. The file is only accessible by the user.
+
+    Raises:
+        PermissionError: If other users can access the key file.
+    """
+    from config.userConfig import getConfig
+
+    path = getConfig("modelServerKeyFile", None) or DEFAULT_KEY_FILE
+    path = os.path.expanduser(path)
+
+    if not os.path.exists(path):
+        folder = os.path.dirname(os.path.abspath(path))
+        os.makedirs(folder, mode=0o700, exist_ok=True)
+        # mkstemp creates the file with 0600, linking it into place fails
+        # if another process created a key in the meantime
+        fd, tmp = tempfile.mkstemp(dir=folder)
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(secrets.token_bytes(AUTH_KEY_BYTES))
+            os.link(tmp, path)
+            logger.info(f"Generated model server key {path}")
+        except FileExistsError:
+            pass
+        finally:
+            os.remove(tmp)
+
+    if os.name == "posix":
+        st = os.stat(path)
+        if (st.st_uid != os.getuid()) or (st.st_mode & 0o077):
+            raise PermissionError(
+                f"Model server key `{path}` must only be accessible by its "
+                "owner (chmod 600)"
+            )
+
+    with open(path, "rb") as f:
+        key = f.read()
+    if len(key) == 0:
+        raise ValueError(f"Model server key `{path}` is empty")
+    return key
+
+
+def startModelServer(address):
+    """
+    Starts a model server in a new, detached process, so that it outlives
+    the session that started it and can be shared with later ones.
+    """
+    logger.info(f"Starting model server at {address}")
+    return subprocess.Popen(
+        [sys.executable, "-m", "client.modelServer", "--address", address],
+        cwd=ROOT,
+        start_new_session=True,
+        # logs go to debug.log, the server must not hold on to our output
+        stdin=subprocess.DEVNULL,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+    )
+
+
+def connectModelServer(address, autostart=False):
+    """
+    Connects to the model server at the address, starting one first if
+    none is running and `autostart` is set.
+
+    Returns:
+        multiprocessing Connection.
+    """
+    addr = parseAddress(address)
+    try:
+        return Client(addr, authkey=getAuthKey())
+    except (ConnectionRefusedError, FileNotFoundError):
+        if not autostart:
+            raise
+
+    process = startModelServer(address)
+    t0 = time.time()
+    while True:
+        time.sleep(0.2)
+        try:
+            return Client(addr, authkey=getAuthKey())
+        except (ConnectionRefusedError, FileNotFoundError):
+            if process.poll() is not None:
+                raise ConnectionError("Model server exited on startup")
+            if time.time() - t0 > STARTUP_TIMEOUT:
+                raise
+
+
+def attachShared(name):
+    # the client owns (and unlinks) the segment, this process must not
+    # clean it up on exit
+    shm = shared_memory.SharedMemory(name=name)
+    try:
+        resource_tracker.unregister(shm._name, "shared_memory")
+    except Exception:
+        pass
+    return shm
+
+
+class ModelServer:
+    """
+    Hosts models in their own process and serves predictions to any
+    number of FFAST sessions on the same node. Models are shared between
+    clients loading the same file with the same options and dropped once
+    the last client disconnects.
+
+    Only clients holding the user's key (see getAuthKey) can connect, over
+    a unix socket or local named pipe (see parseAddress), requests are
+    unpickled and can load any model code.
+
+    Every request is a tuple `(command, *args)` answered with
+    `("ok", result)` or `("error", message)`:
+        ("load", factory): Builds the model from a ModelFactory.
+        ("predict", key, names, N, nAtoms, start, stop, z, lattice,
+            batchSize): Predicts rows [start, stop) of the coordinates in
+            shared memory and writes energies and forces into shared memory.
+        ("ping",)
+        ("shutdown",)
+    """
+
+    def __init__(self, listener):
+        from client.shardedPrediction import WorkerEnvironment
+
+        self.listener = listener
+        self.env = WorkerEnvironment(threading.Event())
+        self.models = {}
+        self.refCounts = {}
+        self.predictLocks = {}
+        self.lock = threading.Lock()
+        self.running = True
+
+    def serve(self):
+        while self.running:
+            try:
+                conn = self.listener.accept()
+            except OSError:
+                if not self.running:
+                    break
+                logger.exception("Model server failed to accept client")
+                continue
+
+            threading.Thread(
+                target=self.handleClient, args=(conn,), daemon=True
+            ).start()
+
+    def stop(self):
+        self.running = False
+        self.listener.close()
+
+    def handleClient(self, conn):
+        keys = []
+        try:
+            while True:
+                try:
+                    request = conn.recv()
+                except (EOFError, OSError):
+                    break
+
+                cmd, args = request[0], request[1:]
+                try:
+                    if cmd == "load":
+                        res = self.load(*args)
+                        keys.append(res["key"])
+                    elif cmd == "predict":
+                        res = self.predict(*args)
+                    elif cmd == "ping":
+                        res = None
+                    elif cmd == "shutdown":
+                        conn.send(("ok", None))
+                        self.stop()
+                        break
+                    else:
+                        raise ValueError(f"Unknown command `{cmd}`")
+                except Exception as e:
+                    logger.exception(f"Model server request `{cmd}` failed")
+                    conn.send(("error", f"{type(e).__name__}: {e}"))
+                else:
+                    conn.send(("ok", res))
+        finally:
+            conn.close()
+            for key in keys:
+                self.release(key)
+
+    def load(self, factory):
+        from config.userConfig import getConfig
+        from events import doNothing
+
+        options = json.dumps(factory.options, sort_keys=True)
+        path = os.path.abspath(factory.path)
+        key = f"{factory.className}:{path}:{options}"
+
+        with self.lock:
+            if key not in self.models:
+                model = factory(self.env)
+                # progress is reported by the client, per request
+                model.eventPush = doNothing
+                model.fingerprint = model.getCachedFingerprint()
+                if model.usesTorch and getConfig("torchWarmUp", True):
+                    model.warmUp()
+
+                self.models[key] = model
+                self.predictLocks[key] = threading.Lock()
+                self.refCounts[key] = 0
+                logger.info(f"Model server loaded {key}")
+
+            model = self.models[key]
+            self.refCounts[key] += 1
+
+        return {
+            "key": key,
+            "fingerprint": model.fingerprint,
+            "modelName": model.modelName,
+            "info": model.getInfo(),
+        }
+
+    def release(self, key):
+        with self.lock:
+            if key not in self.refCounts:
+                return
+            self.refCounts[key] -= 1
+            if self.refCounts[key] > 0:
+                return
+
+            model = self.models.pop(key)
+            del self.refCounts[key], self.predictLocks[key]
+
+        model.onDelete()
+        logger.info(f"Model server released {key}")
+
+    def predict(self, key, names, N, nAtoms, start, stop, z, lattice, size):
+        from client.shardedPrediction import ArrayDataset
+
+        with self.lock:
+            model = self.models[key]
+            predictLock = self.predictLocks[key]
+
+        shms = {k: attachShared(v) for k, v in names.items()}
+        try:
+            R = np.ndarray(
+                (N, nAtoms, 3), dtype=np.float64, buffer=shms["R"].buf
+            )
+            E = np.ndarray((N,), dtype=np.float64, buffer=shms["E"].buf)
+            F = np.ndarray(
+                (N, nAtoms, 3), dtype=np.float64, buffer=shms["F"].buf
+            )
+            dataset = ArrayDataset(R[start:stop].copy(), z, lattice)
+
+            with predictLock:
+                if model.singlePredict:
+                    e, f = model.predict(dataset, batchSize=size)
+                else:
+                    e, f = model.predictE(dataset), model.predictF(dataset)
+
+            E[start:stop] = np.asarray(e).flatten()
+            F[start:stop] = np.asarray(f).reshape(stop - start, nAtoms, 3)
+            del R, E, F
+        finally:
+            for shm in shms.values():
+                shm.close()
+
+
+def main():
+    from config.userConfig import getConfig
+    from utils import setupLogger
+
+    parser = argparse.ArgumentParser(description="FFAST model server")
+    parser.add_argument(
+        "--address",
+        default=getConfig("modelServer", None),
+        help="unix socket path (or named pipe on Windows), defaults to "
+        "`modelServer`",
+    )
+    args = parser.parse_args()
+    if args.address is None:
+        parser.error("no address given and `modelServer` is not set")
+
+    setupLogger()
+    try:
+        addr = parseAddress(args.address)
+    except ValueError as e:
+        parser.error(str(e))
+    authKey = getAuthKey()
+
+    if os.path.exists(addr):
+        try:
+            Client(addr, authkey=authKey).close()
+        except (ConnectionRefusedError, FileNotFoundError):
+            # left behind by a server that did not shut down cleanly
+            os.remove(addr)
+        else:
+            parser.error(f"a model server is already running at {addr}")
+
+    # the socket file is only accessible by the user
+    umask = os.umask(0o177)
+    try:
+        listener = Listener(addr, authkey=authKey)
+    finally:
+        os.umask(umask)
+    logger.info(f"Model server listening at {args.address}")
+
+    server = ModelServer(listener)
+    try:
+        server.serve()
+    except KeyboardInterrupt:
+        server.stop()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,253 @@
+import itertools
+import logging
+import numpy as np
+from scipy.spatial import cKDTree
+
+logger = logging.getLogger("FFAST")
+
+# frames are processed in chunks so that temporary (chunk, nAtoms, nAtoms, 3)
+# arrays stay below this many elements
+DENSE_CHUNK_ELEMENTS = 2**24
+
+# above this many atoms, neighbour lists switch from the dense all-pairs
+# search to a spatial tree (O(N) pairs per frame instead of O(N^2))
+DENSE_MAX_ATOMS = 200
+
+
+def latticeToMatrix(lattice):
+    """
+    Converts a lattice into a 3x3 matrix and its inverse. Rows are lattice
+    vectors (same convention as ASE's `cell`, sGDML files store columns and
+    are transposed on load).
+
+    Args:
+        lattice (array): 3x3 lattice, or None.
+
+    Returns:
+        (L, Linv) tuple, or None if the lattice is missing (including
+        `array(None)` or anything without 9 elements) or degenerate (i.e.
+        the system is treated as non-periodic).
+    """
+    if lattice is None:
+        return None
+
+    L = np.asarray(lattice)
+    if L.size != 9:
+        return None
+    L = L.astype(float).reshape(3, 3)
+    if abs(np.linalg.det(L)) < 1e-8:
+        return None
+
+    return L, np.linalg.inv(L)
+
+
+def cellHeights(L):
+    # perpendicular width of the cell along each lattice vector
+    volume = abs(np.linalg.det(L))
+    areas = np.linalg.norm(np.cross(L[[1, 2, 0]], L[[2, 0, 1]]), axis=1)
+    return volume / areas
+
+
+def frameChunks(nFrames, elementsPerFrame):
+    step = max(1, DENSE_CHUNK_ELEMENTS // max(1, elementsPerFrame))
+    for start in range(0, nFrames, step):
+        yield slice(start, min(start + step, nFrames))
+
+
+def minimumImage(dr, lattice):
+    """
+    Applies the minimum image convention to displacement vectors.
+
+    Args:
+        dr (array): (..., 3) array of displacement vectors.
+        lattice (array): 3x3 lattice (rows are lattice vectors) or None.
+
+    Returns:
+        dr (array): Wrapped displacement vectors, same shape as input.
+    """
+    lat = latticeToMatrix(lattice)
+    if lat is None:
+        return dr
+
+    L, Linv = lat
+    frac = dr @ Linv
+    return (frac - np.round(frac)) @ L
+
+
+def distanceMatrices(R, lattice=None):
+    """
+    Full distance matrices, vectorized over frames and periodic-aware.
+
+    Args:
+        R (array): Nx3 or MxNx3 array of coordinates.
+        lattice (array, optional): 3x3 lattice. Defaults to None.
+
+    Returns:
+        D (array): NxN or MxNxN array of (minimum image) distances.
+    """
+    R = np.asarray(R)
+    single = R.ndim == 2
+    if single:
+        R = R[None]
+
+    nFrames, nAtoms, _ = R.shape
+    lat = latticeToMatrix(lattice)
+    D = np.empty((nFrames, nAtoms, nAtoms))
+
+    for s in frameChunks(nFrames, nAtoms * nAtoms * 3):
+        dr = R[s, None, :, :] - R[s, :, None, :]
+        if lat is not None:
+            frac = dr @ lat[1]
+            dr = (frac - np.round(frac)) @ lat[0]
+        D[s] = np.sqrt(np.einsum("fijk,fijk->fij", dr, dr))
+
+    if single:
+        return D[0]
+    return D
+
+
+def pairDistances(R, lattice=None):
+    """
+    Condensed pairwise distances (same ordering as scipy's `pdist`),
+    vectorized over frames and periodic-aware.
+
+    Args:
+        R (array): MxNx3 array of coordinates.
+        lattice (array, optional): 3x3 lattice. Defaults to None.
+
+    Returns:
+        D (array): Mx(N*(N-1)/2) array of (minimum image) distances.
+    """
+    R = np.asarray(R)
+    nFrames, nAtoms, _ = R.shape
+    idxI, idxJ = np.triu_indices(nAtoms, k=1)
+    lat = latticeToMatrix(lattice)
+    D = np.empty((nFrames, len(idxI)))
+
+    for s in frameChunks(nFrames, len(idxI) * 3):
+        dr = R[s][:, idxJ] - R[s][:, idxI]
+        if lat is not None:
+            frac = dr @ lat[1]
+            dr = (frac - np.round(frac)) @ lat[0]
+        D[s] = np.sqrt(np.einsum("fpk,fpk->fp", dr, dr))
+
+    return D
+
+
+def denseNeighbours(R, cutoff, lat):
+    nFrames, nAtoms, _ = R.shape
+    notSelf = ~np.eye(nAtoms, dtype=bool)
+    frames, idxI, idxJ, offsets = [], [], [], []
+
+    for s in frameChunks(nFrames, nAtoms * nAtoms * 3):
+        dr = R[s, None, :, :] - R[s, :, None, :]
+        if lat is None:
+            shift = None
+        else:
+            frac = dr @ lat[1]
+            shift = -np.round(frac)
+            dr = (frac + shift) @ lat[0]
+
+        d2 = np.einsum("fijk,fijk->fij", dr, dr)
+        f, i, j = np.nonzero((d2 < cutoff**2) & notSelf)
+
+        frames.append(f + s.start)
+        idxI.append(i)
+        idxJ.append(j)
+        if shift is None:
+            offsets.append(np.zeros((len(f), 3), dtype=int))
+        else:
+            offsets.append(shift[f, i, j].astype(int))
+
+    return (
+        np.concatenate(frames),
+        np.concatenate(idxI),
+        np.concatenate(idxJ),
+        np.concatenate(offsets),
+    )
+
+
+def treeNeighbours(r, cutoff, lat):
+    nAtoms = len(r)
+
+    if lat is None:
+        pairs = cKDTree(r).query_pairs(cutoff, output_type="ndarray")
+        idxI = np.concatenate([pairs[:, 0], pairs[:, 1]])
+        idxJ = np.concatenate([pairs[:, 1], pairs[:, 0]])
+        return idxI, idxJ, np.zeros((len(idxI), 3), dtype=int)
+
+    # wrap into the cell, then search against every periodic image that can
+    # fall within the cutoff
+    L, Linv = lat
+    frac = r @ Linv
+    wrap = np.floor(frac)
+    rWrapped = (frac - wrap) @ L
+
+    nImages = np.ceil(cutoff / cellHeights(L)).astype(int)
+    shifts = np.array(
+        list(itertools.product(*[range(-n, n + 1) for n in nImages]))
+    )
+    images = (rWrapped[None] + (shifts @ L)[:, None]).reshape(-1, 3)
+
+    sdm = cKDTree(rWrapped).sparse_distance_matrix(
+        cKDTree(images), cutoff, output_type="ndarray"
+    )
+    idxI, k = sdm["i"], sdm["j"]
+    idxJ, shift = k % nAtoms, shifts[k // nAtoms]
+
+    keep = ~((idxI == idxJ) & ~shift.any(axis=1))
+    idxI, idxJ, shift = idxI[keep], idxJ[keep], shift[keep]
+
+    # express offsets relative to the original (unwrapped) coordinates
+    offsets = (shift - wrap[idxJ] + wrap[idxI]).astype(int)
+
+    return idxI, idxJ, offsets
+
+
+def neighbourList(R, cutoff, lattice=None):
+    """
+    Finds all ordered pairs (i, j), i != j, within the cutoff, i.e.
+    |r_j + offset @ lattice - r_i| < cutoff. Small systems use a dense
+    all-pairs search vectorized over frames, larger or strongly periodic
+    ones a spatial tree over the periodic images.
+
+    Args:
+        R (array): Nx3 or MxNx3 array of coordinates.
+        cutoff (float): Neighbour cutoff, same units as R.
+        lattice (array, optional): 3x3 lattice. Defaults to None.
+
+    Returns:
+        frameIdx (array): Frame index of every pair.
+        idxI (array): Index of the central atom of every pair.
+        idxJ (array): Index of the neighbouring atom of every pair.
+        offsets (array): nPairsx3 integer lattice offsets applied to atom j.
+    """
+    R = np.asarray(R)
+    if R.ndim == 2:
+        R = R[None]
+
+    nFrames, nAtoms, _ = R.shape
+    lat = latticeToMatrix(lattice)
+
+    dense = nAtoms <= DENSE_MAX_ATOMS
+    if (lat is not None) and (cutoff >= 0.5 * np.min(cellHeights(lat[0]))):
+        # several images of the same atom can be within the cutoff
+        dense = False
+
+    if dense:
+        return denseNeighbours(R, cutoff, lat)
+
+    frames, idxI, idxJ, offsets = [], [], [], []
+    for f in range(nFrames):
+        i, j, o = treeNeighbours(R[f], cutoff, lat)
+        frames.append(np.full(len(i), f))
+        idxI.append(i)
+        idxJ.append(j)
+        offsets.append(o)
+
+    return (
+        np.concatenate(frames),
+        np.concatenate(idxI),
+        np.concatenate(idxJ),
+        np.concatenate(offsets),
+    )
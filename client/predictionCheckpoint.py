@@ -0,0 +1,138 @@
+import logging
+import os
+import shutil
+import numpy as np
+from events import setProgressWindow, clearProgressWindow
+
+logger = logging.getLogger("FFAST")
+
+# in the repository, wherever FFAST is started from
+CHECKPOINT_DIR = os.path.join(
+    os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+    "temp",
+    "checkpoints",
+)
+
+
+class PredictionCheckpoint:
+    """
+    Partial (E, F) predictions of a model/dataset pair, stored on disk as
+    one npz file per block of configurations so that a cancelled, crashed
+    or preempted generation can resume from the first missing index.
+    """
+
+    def __init__(self, key, N, nAtoms):
+        self.path = os.path.join(CHECKPOINT_DIR, key)
+        self.N = N
+        self.nAtoms = nAtoms
+
+    def blockPath(self, start, stop):
+        return os.path.join(self.path, f"{start:012d}_{stop:012d}.npz")
+
+    def load(self):
+        """
+        Loads all blocks contiguous from index 0.
+
+        Returns:
+            nDone (int): Number of configurations already predicted.
+            E (list): Energy blocks.
+            F (list): Forces blocks.
+        """
+        if not os.path.isdir(self.path):
+            return 0, [], []
+
+        blocks = {}
+        for name in os.listdir(self.path):
+            if not name.endswith(".npz"):
+                continue
+            try:
+                start, stop = map(int, name[:-4].split("_"))
+            except ValueError:
+                continue
+            blocks[start] = (stop, os.path.join(self.path, name))
+
+        nDone, E, F = 0, [], []
+        while nDone in blocks:
+            stop, path = blocks[nDone]
+            try:
+                d = np.load(path)
+                e, f = d["E"], d["F"]
+            except Exception as err:
+                logger.warning(f"Ignoring unreadable checkpoint {path}: {err}")
+                break
+
+            if (len(e) != stop - nDone) or (f.shape[1:] != (self.nAtoms, 3)):
+                logger.warning(f"Ignoring mismatching checkpoint {path}")
+                break
+
+            E.append(e)
+            F.append(f)
+            nDone = stop
+
+        return nDone, E, F
+
+    def save(self, start, E, F):
+        os.makedirs(self.path, exist_ok=True)
+        stop = start + len(E)
+
+        # write then rename, a block is either complete or not there at all
+        tmp = os.path.join(self.path, f"{start:012d}.tmp.npz")
+        np.savez(tmp, E=E, F=F)
+        os.replace(tmp, self.blockPath(start, stop))
+
+    def clear(self):
+        if os.path.isdir(self.path):
+            shutil.rmtree(self.path, ignore_errors=True)
+
+
+def checkpointedPredict(key, predict, dataset, blockSize, taskID=None):
+    """
+    Predicts a whole dataset block by block, persisting every block and
+    resuming from existing ones. Progress is reported relative to the
+    remaining work.
+
+    Args:
+        key (str): Cache key the checkpoint is stored under.
+        predict (func): Called with `indices` and `taskID` kwargs, returns
+            (E, F) or None if cancelled.
+        dataset (DatasetLoader): Dataset to predict.
+        blockSize (int): Number of configurations per checkpoint block.
+        taskID (optional): Task ID. Defaults to None.
+
+    Returns:
+        (E, F) tuple, or None if cancelled.
+    """
+    N = dataset.getN()
+    checkpoint = PredictionCheckpoint(key, N, dataset.getNAtoms())
+    nDone, E, F = checkpoint.load()
+
+    if nDone > 0:
+        logger.info(
+            f"Resuming predictions for {key} from checkpoint at {nDone}/{N}"
+        )
+
+    for start in range(nDone, N, blockSize):
+        stop = min(start + blockSize, N)
+        if taskID is not None:
+            setProgressWindow(taskID, start - nDone, stop - nDone, N - nDone)
+
+        try:
+            res = predict(indices=np.arange(start, stop), taskID=taskID)
+        finally:
+            if taskID is not None:
+                clearProgressWindow(taskID)
+
+        if res is None:
+            return None
+
+        e, f = np.asarray(res[0]).flatten(), np.asarray(res[1])
+        checkpoint.save(start, e, f)
+        E.append(e)
+        F.append(f)
+
+    checkpoint.clear()
+
+    if len(E) == 0:
+        return np.zeros(0), np.zeros((0, dataset.getNAtoms(), 3))
+
+    return np.concatenate(E), np.concatenate(F)
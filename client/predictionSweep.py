@@ -0,0 +1,172 @@
+import logging
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+from config.userConfig import getConfig
+from client.dataType import (
+    getPartialPredictions,
+    promotePartialPredictions,
+    resolveRootIndices,
+)
+from client.shardedPrediction import ArrayDataset
+
+logger = logging.getLogger("FFAST")
+
+# torch's intra-op threads are process-wide, they are shared by all running
+# sweeps and restored once the last one is done, see limitTorchThreads
+sweepThreadLock = threading.Lock()
+sweepThreadUsers = 0
+sweepThreadsBefore = None
+
+
+def getCoreBudget():
+    budget = getConfig("sweepCoreBudget", None)
+    return budget or os.cpu_count() or 1
+
+
+def sweepPredict(env, models, dataset, taskID=None):
+    """
+    Predicts energies and forces of several models on one dataset, reading
+    every block of `sweepBlockSize` configurations once and handing it to
+    all models. Up to `sweepCoreBudget` cores (all by default) are shared by
+    models running concurrently. Each block's results go into the models'
+    sparse prediction caches (see dataType.predictPartial), so a cancelled
+    sweep keeps what it already predicted. A model's predictions are
+    promoted to regular energy/forces entries as soon as they are complete.
+
+    Args:
+        env (Environment): Environment.
+        models (list): Models, ghost and non-singlePredict ones are skipped.
+        dataset (DatasetLoader): Dataset, or an index-selected sub-dataset.
+        taskID (optional): Task ID. Defaults to None.
+
+    Returns:
+        bool: False if cancelled or the dataset cannot be swept.
+    """
+    from client.batchTuner import tunedPredict
+
+    root, indices = resolveRootIndices(dataset)
+    if root.isSubDataset:
+        logger.error("Prediction sweeps need index-selected or root datasets")
+        return False
+
+    if indices is None:
+        indices = np.arange(root.getN())
+    indices = np.unique(indices)
+
+    models = [m for m in models if m.singlePredict and not m.isGhost]
+    models = [
+        m for m in models if not env.hasData("energy", model=m, dataset=root)
+    ]
+    if len(models) == 0:
+        return True
+
+    partials = {m: getPartialPredictions(env, m, root) for m in models}
+    z, lattice = root.getElements(), root.getLattice()
+
+    blockSize = getConfig("sweepBlockSize", 1000)
+    blocks = [
+        indices[i : i + blockSize] for i in range(0, len(indices), blockSize)
+    ]
+
+    budget = getCoreBudget()
+    nConcurrent = max(1, min(len(models), budget))
+    restoreThreads = limitTorchThreads(models, max(1, budget // nConcurrent))
+
+    logger.info(
+        f"Sweeping {len(models)} models over {len(indices)} configurations "
+        f"of {root.getName()}, {nConcurrent} at a time"
+    )
+
+    def predictBlock(model, block, R):
+        missing = partials[model].missing(block)
+        if len(missing) == 0:
+            return
+
+        # both sorted, positions of the missing configurations in the block
+        rows = np.searchsorted(block, missing)
+        blockData = ArrayDataset(R[rows], z, lattice, root.fingerprint)
+        res = tunedPredict(model, blockData)
+        partials[model].fill(
+            missing, energy=np.asarray(res[0]).flatten(), forces=res[1]
+        )
+
+    try:
+        with ThreadPoolExecutor(max_workers=nConcurrent) as pool:
+            for i, block in enumerate(blocks):
+                todo = [m for m in models if len(partials[m].missing(block))]
+                if len(todo) > 0:
+                    # read once, shared by every model
+                    R = np.asarray(root.getCoordinates(indices=block))
+
+                    futures = {
+                        m: pool.submit(predictBlock, m, block, R) for m in todo
+                    }
+                    for model, future in futures.items():
+                        try:
+                            future.result()
+                        except Exception:
+                            logger.exception(
+                                f"Sweep prediction of {model.getName()} "
+                                "failed, removing it from the sweep"
+                            )
+                            models.remove(model)
+
+                if taskID is not None:
+                    env.eventPush(
+                        "TASK_PROGRESS",
+                        taskID,
+                        progMax=len(blocks),
+                        prog=i + 1,
+                        message=f"Prediction sweep ({len(models)} models)",
+                        quiet=True,
+                        percent=True,
+                    )
+
+                    if not env.tm.isTaskRunning(taskID):
+                        return False
+
+    finally:
+        restoreThreads()
+        for model, partial in partials.items():
+            if not partial.mask.any():
+                key = env.getCacheKey("energy", model=model, dataset=root)
+                env.partialCache.pop(key, None)
+            else:
+                promotePartialPredictions(env, model, root)
+
+    return True
+
+
+def limitTorchThreads(models, threads):
+    """
+    Sets torch's intra-op threads for the duration of a sweep. Overlapping
+    sweeps keep the limit set by the first one, the setting from before it
+    is restored when the last one ends, in whatever order they end.
+
+    Returns:
+        Function ending this sweep's use of the limit.
+    """
+    global sweepThreadUsers, sweepThreadsBefore
+
+    if not any(m.usesTorch for m in models):
+        return lambda: None
+
+    import torch
+
+    with sweepThreadLock:
+        if sweepThreadUsers == 0:
+            sweepThreadsBefore = torch.get_num_threads()
+            torch.set_num_threads(threads)
+        sweepThreadUsers += 1
+
+    def restore():
+        global sweepThreadUsers
+
+        with sweepThreadLock:
+            sweepThreadUsers -= 1
+            if sweepThreadUsers == 0:
+                torch.set_num_threads(sweepThreadsBefore)
+
+    return restore
@@ -0,0 +1,148 @@
+import json
+import logging
+import threading
+import time
+import numpy as np
+from client.batchTuner import RSSMonitor
+
+logger = logging.getLogger("FFAST")
+
+# RSS sampling interval (in seconds) while a generation is profiled
+PROFILE_RSS_INTERVAL = 0.02
+
+SUMMARY_FIELDS = ["wall", "cpu", "threadCPU", "peakMemory", "outputBytes"]
+
+
+def getDataBytes(data):
+    """Summed nbytes of the arrays in a DataEntity's data dict."""
+    total = 0
+    for v in data.values():
+        if isinstance(v, np.ndarray):
+            total += v.nbytes
+        elif isinstance(v, (list, tuple)):
+            total += sum(a.nbytes for a in v if isinstance(a, np.ndarray))
+    return total
+
+
+def formatBytes(n):
+    for unit in ("B", "kB", "MB"):
+        if abs(n) < 1024:
+            return f"{n:.0f} {unit}" if unit == "B" else f"{n:.1f} {unit}"
+        n /= 1024
+    return f"{n:.1f} GB"
+
+
+def formatRecord(record):
+    """Short one-line description, e.g. `2.3s, CPU 4.1s, +120.0 MB`."""
+    text = f"{record['wall']:.2f}s, CPU {record['cpu']:.2f}s"
+    text += f", +{formatBytes(record['peakMemory'])}"
+    if record["outputBytes"] > 0:
+        text += f", {formatBytes(record['outputBytes'])} out"
+    return text
+
+
+class ProfiledRun:
+    """
+    Measures one generation or prediction: wall time, CPU time of the
+    process and of the calling thread, peak RSS increase (sampled, see
+    batchTuner.RSSMonitor) and the given input sizes. The output size
+    and status ("done", "incomplete", e.g. missing dependencies or
+    cancelled, or "failed") are set by the caller once the result is known.
+
+    CPU time and memory are process-wide, generations running at the same
+    time are included. Prediction worker processes are not. Nested runs
+    (e.g. a DataType generating a dependency inline) include each other.
+    """
+
+    def __init__(self, key, cacheKey=None, model=None, dataset=None):
+        self.record = {
+            "key": key,
+            "cacheKey": cacheKey,
+            "model": None if model is None else model.getDisplayName(),
+            "dataset": None,
+            "nConfigs": None,
+            "nAtoms": None,
+            "start": None,
+            "wall": 0.0,
+            "cpu": 0.0,
+            "threadCPU": 0.0,
+            "peakMemory": 0,
+            "outputBytes": 0,
+            "status": "failed",
+        }
+        if dataset is not None:
+            self.record["dataset"] = dataset.getDisplayName()
+            self.record["nConfigs"] = dataset.getN()
+            self.record["nAtoms"] = dataset.getNAtoms()
+
+    def __enter__(self):
+        self.rss = RSSMonitor(interval=PROFILE_RSS_INTERVAL).__enter__()
+        self.baseline = self.rss.peak
+        self.record["start"] = time.time()
+        self.t0 = time.perf_counter()
+        self.cpu0 = time.process_time()
+        self.threadCPU0 = time.thread_time()
+        return self
+
+    def __exit__(self, *args):
+        self.record["wall"] = time.perf_counter() - self.t0
+        self.record["cpu"] = time.process_time() - self.cpu0
+        self.record["threadCPU"] = time.thread_time() - self.threadCPU0
+        self.rss.__exit__(*args)
+        self.record["peakMemory"] = max(0, self.rss.peak - self.baseline)
+
+
+class Profile:
+    """
+    Records of profiled runs (see ProfiledRun), in the order they finished.
+    Thread-safe, generations run in worker threads.
+    """
+
+    def __init__(self):
+        self.records = []
+        self.lock = threading.Lock()
+
+    def add(self, record):
+        with self.lock:
+            self.records.append(record)
+
+    def clear(self):
+        with self.lock:
+            self.records = []
+
+    def getRecords(self, key=None):
+        with self.lock:
+            records = list(self.records)
+        if key is not None:
+            records = [r for r in records if r["key"] == key]
+        return records
+
+    def getSummary(self):
+        """
+        Returns:
+            dict, DataType key -> count and total/max of SUMMARY_FIELDS,
+            sorted by total wall time (slowest first).
+        """
+        summary = {}
+        for r in self.getRecords():
+            s = summary.setdefault(
+                r["key"], {"count": 0, "failed": 0, "incomplete": 0}
+            )
+            s["count"] += 1
+            if r["status"] != "done":
+                s[r["status"]] += 1
+            for field in SUMMARY_FIELDS:
+                s[f"{field}Total"] = s.get(f"{field}Total", 0) + r[field]
+                s[f"{field}Max"] = max(s.get(f"{field}Max", 0), r[field])
+
+        order = sorted(summary, key=lambda k: -summary[k]["wallTotal"])
+        return {k: summary[k] for k in order}
+
+    def dump(self, path):
+        with open(path, "w") as f:
+            json.dump(
+                {"summary": self.getSummary(), "records": self.getRecords()},
+                f,
+                indent=4,
+            )
+        logger.info(f"Wrote generation profile to {path}")
@@ -0,0 +1,290 @@
+import json
+import logging
+import os
+import pickle
+import struct
+import threading
+import time
+import zlib
+import numpy as np
+from client.dataType import DataEntity, PartialDataEntity, rangesToIndices
+
+logger = logging.getLogger("FFAST")
+
+ARCHIVE_EXTENSION = ".ffast"
+MAGIC = b"FFASTARC"
+VERSION = 1
+# magic, version
+HEADER = struct.Struct("<8sI")
+# magic, index offset, index length
+FOOTER = struct.Struct("<8sQQ")
+CODECS = ["zlib", "raw"]
+
+
+def isArchivePath(path):
+    return path.endswith(ARCHIVE_EXTENSION)
+
+
+def emptyIndex():
+    return {"info": {}, "entries": {}, "partials": {}}
+
+
+class SessionArchive:
+    """
+    Single-file alternative to save directories. Arrays are stored one
+    after the other, followed by a JSON index (cache key -> DataType key,
+    timestamp and, per array, offset, size, dtype, shape and codec) and a
+    fixed-size footer pointing to the index:
+
+        header | arrays... | index | footer
+
+    Reading the index only takes the footer and the index, and entities
+    are read individually (see ArchivedDataEntity). Saving again appends
+    new or changed entities and a new index after the old footer, the file
+    is never rewritten. Replaced entities and old indices stay behind as
+    dead space until the session is saved to a new archive.
+
+    Codecs: "zlib" (level 1) or "raw", raw arrays are memory-mapped when
+    read. Object arrays are pickled.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.index = emptyIndex()
+
+        if os.path.exists(path):
+            self.readIndex()
+
+    def readIndex(self):
+        with open(self.path, "rb") as f:
+            magic, version = HEADER.unpack(f.read(HEADER.size))
+            if magic != MAGIC:
+                raise ValueError(f"`{self.path}` is not an FFAST archive")
+            if version > VERSION:
+                raise ValueError(
+                    f"Archive `{self.path}` has version {version}, only "
+                    f"versions up to {VERSION} are supported"
+                )
+
+            f.seek(-FOOTER.size, os.SEEK_END)
+            magic, offset, length = FOOTER.unpack(f.read(FOOTER.size))
+            if magic != MAGIC:
+                raise ValueError(f"Archive `{self.path}` is truncated")
+
+            f.seek(offset)
+            self.index = json.loads(f.read(length).decode("utf8"))
+
+    def keys(self):
+        return list(self.index["entries"].keys())
+
+    def getEntry(self, key):
+        return self.index["entries"].get(key, None)
+
+    def write(self, entities, partials=None, info=None, codec="zlib"):
+        """
+        Appends entities and writes the new index.
+
+        Args:
+            entities (dict): Cache key -> DataEntity.
+            partials (dict, optional): Cache key -> PartialDataEntity,
+                replacing all stored partials (unchanged ones are not
+                written again). Defaults to None (kept).
+            info (dict, optional): Session info, see Environment.save.
+            codec (str, optional): One of CODECS. Defaults to "zlib".
+        """
+        if codec not in CODECS:
+            raise ValueError(f"Unknown archive codec `{codec}`, use {CODECS}")
+
+        with self.lock:
+            new = not os.path.exists(self.path)
+            with open(self.path, "wb" if new else "r+b") as f:
+                if new:
+                    f.write(HEADER.pack(MAGIC, VERSION))
+                f.seek(0, os.SEEK_END)
+                end = f.tell()
+
+                try:
+                    for key, entity in entities.items():
+                        self.index["entries"][key] = {
+                            "dataTypeKey": entity.dataType.key,
+                            "timestamp": entity.timestamp,
+                            "arrays": self.writeArrays(f, entity.data, codec),
+                        }
+
+                    if partials is not None:
+                        previous = self.index["partials"]
+                        self.index["partials"] = {}
+                        for key, partial in partials.items():
+                            entry = previous.get(key, None)
+                            if (entry is not None) and (
+                                entry["timestamp"] == partial.timestamp
+                            ):
+                                self.index["partials"][key] = entry
+                                continue
+
+                            ranges = partial.getRanges()
+                            indices = rangesToIndices(ranges)
+                            data = {
+                                k: v[indices] for k, v in partial.data.items()
+                            }
+                            data["ranges"] = ranges
+                            self.index["partials"][key] = {
+                                "N": len(partial.mask),
+                                "timestamp": partial.timestamp,
+                                "arrays": self.writeArrays(f, data, codec),
+                            }
+
+                    if info is not None:
+                        self.index["info"] = info
+
+                    index = json.dumps(self.index).encode("utf8")
+                    offset = f.tell()
+                    f.write(index)
+                    f.write(FOOTER.pack(MAGIC, offset, len(index)))
+                except BaseException:
+                    if new:
+                        # a header alone is not a readable archive
+                        f.close()
+                        os.remove(self.path)
+                        self.index = emptyIndex()
+                    else:
+                        # leaves the previous index (and footer) valid
+                        f.truncate(end)
+                        self.readIndex()
+                    raise
+
+    def writeArrays(self, f, data, codec):
+        meta = {}
+        for name, arr in data.items():
+            arr = np.asarray(arr)
+            if arr.dtype.hasobject:
+                c, raw = "pickle", pickle.dumps(arr)
+            else:
+                c, raw = codec, np.ascontiguousarray(arr).tobytes()
+                if codec == "zlib":
+                    raw = zlib.compress(raw, 1)
+
+            meta[name] = {
+                "offset": f.tell(),
+                "nbytes": len(raw),
+                "dtype": arr.dtype.str,
+                "shape": list(arr.shape),
+                "codec": c,
+            }
+            f.write(raw)
+        return meta
+
+    def readArray(self, meta):
+        codec, shape = meta["codec"], tuple(meta["shape"])
+        dtype = np.dtype(meta["dtype"])
+
+        if (codec == "raw") and (meta["nbytes"] > 0) and (len(shape) > 0):
+            return np.memmap(
+                self.path,
+                dtype=dtype,
+                mode="r",
+                offset=meta["offset"],
+                shape=shape,
+            )
+
+        with open(self.path, "rb") as f:
+            f.seek(meta["offset"])
+            raw = f.read(meta["nbytes"])
+
+        if codec == "pickle":
+            return pickle.loads(raw)
+        if codec == "zlib":
+            raw = zlib.decompress(raw)
+        return np.frombuffer(bytearray(raw), dtype=dtype).reshape(shape)
+
+    def readArrays(self, meta):
+        return {name: self.readArray(m) for name, m in meta.items()}
+
+    def readEntity(self, key):
+        return self.readArrays(self.index["entries"][key]["arrays"])
+
+    def readPartial(self, key):
+        """
+        Returns:
+            (N, ranges, data) tuple, see PartialDataEntity.getRanges.
+        """
+        entry = self.index["partials"][key]
+        data = self.readArrays(entry["arrays"])
+        ranges = data.pop("ranges")
+        return entry["N"], ranges, data
+
+    def readPartialRanges(self, key):
+        """
+        Returns:
+            (N, ranges) tuple, without reading the partial's data.
+        """
+        entry = self.index["partials"][key]
+        return entry["N"], self.readArray(entry["arrays"]["ranges"])
+
+
+class ArchivedDataEntity(DataEntity):
+    """
+    DataEntity of a session archive, reading its arrays from the archive
+    the first time they are accessed.
+    """
+
+    def __init__(self, dataType, archive, key):
+        self.dataType = dataType
+        self.archive = archive
+        self.key = key
+        self.loadedData = None
+        self.timestamp = archive.getEntry(key)["timestamp"]
+
+    @property
+    def data(self):
+        if self.loadedData is None:
+            t0 = time.time()
+            self.loadedData = self.archive.readEntity(self.key)
+            logger.debug(
+                f"Read {self.key} from {self.archive.path} in "
+                f"{time.time() - t0:.3f}s"
+            )
+        return self.loadedData
+
+    @data.setter
+    def data(self, data):
+        self.loadedData = data
+
+
+class ArchivedPartialDataEntity(PartialDataEntity):
+    """
+    PartialDataEntity of a session archive. Its validity mask is read right
+    away, its arrays the first time they are accessed.
+    """
+
+    def __init__(self, dataType, archive, key):
+        self.dataType = dataType
+        self.archive = archive
+        self.key = key
+        self.loadedData = None
+        self.timestamp = archive.index["partials"][key]["timestamp"]
+
+        self.N, ranges = archive.readPartialRanges(key)
+        self.mask = np.zeros(self.N, dtype=bool)
+        self.mask[rangesToIndices(ranges)] = True
+
+    @property
+    def data(self):
+        if self.loadedData is None:
+            # laid out as stored, resize pads it if the mask grew since
+            N, ranges, data = self.archive.readPartial(self.key)
+            indices = rangesToIndices(ranges)
+            self.loadedData = {}
+            for k, v in data.items():
+                self.loadedData[k] = np.full(
+                    (N,) + v.shape[1:],
+                    np.nan,
+                    dtype=np.result_type(v.dtype, np.float32),
+                )
+                self.loadedData[k][indices] = v
+        return self.loadedData
+
+    @data.setter
+    def data(self, data):
+        self.loadedData = data
@@ -0,0 +1,241 @@
+import json
+import logging
+import os
+import time
+import numpy as np
+from client.batchRun import PROFILE_FILE, writeProfile
+from client.dataType import (
+    predictPartial,
+    promotePartialPredictions,
+    rangesToIndices,
+)
+from client.profiling import ProfiledRun
+from client.sessionArchive import isArchivePath
+
+logger = logging.getLogger("FFAST")
+
+SHARD_INFO_FILE = "shard.json"
+
+
+def parseShard(spec):
+    """
+    Parses `k/N`, the k-th (from 0) of N shards.
+
+    Returns:
+        (k, N) tuple.
+    """
+    try:
+        k, N = (int(x) for x in spec.split("/"))
+    except ValueError:
+        raise ValueError(f"Shard `{spec}` is not of the form k/N")
+    if not (0 <= k < N):
+        raise ValueError(f"Shard `{spec}` needs 0 <= k < N")
+    return k, N
+
+
+def getShardRange(N, k, count):
+    # same contiguous split as shardedPrediction.shardedPredict
+    bounds = np.linspace(0, N, count + 1).astype(int)
+    return int(bounds[k]), int(bounds[k + 1])
+
+
+def runShard(env, datasets, models, shard, saveDir, profilePath=None):
+    """
+    Predicts the energies and forces of one shard (a contiguous slice) of
+    every dataset with every model and saves them as sparse predictions
+    (see dataType.predictPartial), together with a `shard.json` describing
+    the shard, for mergeShards, and the prediction profile.
+
+    Args:
+        env (HeadlessEnvironment): Running environment.
+        datasets (list): Loaded datasets.
+        models (list): Loaded models.
+        shard (tuple): (k, N), see parseShard.
+        saveDir (str): Save directory.
+        profilePath (str, optional): JSON file for the prediction profile.
+            Defaults to `profile.json` in the save directory.
+
+    Returns:
+        int: Exit status, 0 if every prediction succeeded, 1 otherwise.
+    """
+    k, count = shard
+    info = {"shard": [k, count], "partials": {}}
+    failed = []
+
+    for dataset in datasets:
+        start, stop = getShardRange(dataset.getN(), k, count)
+        indices = np.arange(start, stop)
+
+        for model in models:
+            name = f"{model.getDisplayName()} on {dataset.getDisplayName()}"
+            key = env.getCacheKey("energy", model=model, dataset=dataset)
+            if not model.singlePredict:
+                logger.error(f"Shard runs need singlePredict models ({name})")
+                failed.append(name)
+                continue
+
+            t0 = time.time()
+            run = ProfiledRun("energy", cacheKey=key, model=model)
+            run.record.update(
+                dataset=dataset.getDisplayName(),
+                nConfigs=len(indices),
+                nAtoms=dataset.getNAtoms(),
+            )
+            try:
+                with run:
+                    res = predictPartial(env, model, dataset, indices)
+            except Exception:
+                logger.exception(f"Shard prediction of {name} failed")
+                res = None
+            if res is not None:
+                run.record["status"] = "done"
+                run.record["outputBytes"] = sum(
+                    np.asarray(a).nbytes for a in res
+                )
+            env.addProfileRecord(run)
+
+            if res is None:
+                failed.append(name)
+                print(f"{name}: failed", flush=True)
+                continue
+
+            info["partials"][key] = {
+                "model": model.fingerprint,
+                "modelPath": model.path,
+                "dataset": dataset.fingerprint,
+                "datasetPath": dataset.path,
+                "N": dataset.getN(),
+                "range": [start, stop],
+            }
+            print(
+                f"{name}: configurations [{start}, {stop}) of "
+                f"{dataset.getN()} ({time.time() - t0:.1f}s)",
+                flush=True,
+            )
+
+    os.makedirs(saveDir, exist_ok=True)
+    env.save(saveDir)
+    with open(os.path.join(saveDir, SHARD_INFO_FILE), "w") as f:
+        json.dump(info, f, indent=4)
+    print(f"Shard {k}/{count} saved to {saveDir}", flush=True)
+    writeProfile(env, profilePath or os.path.join(saveDir, PROFILE_FILE))
+
+    return 1 if len(failed) > 0 else 0
+
+
+def checkShards(shardInfos):
+    """
+    Checks that shard saves belong together: the same number of shards,
+    each shard exactly once, the same fingerprints for the same model and
+    dataset files and, for every prediction, the same dataset size and
+    non-overlapping ranges.
+
+    Args:
+        shardInfos (list): (save directory, its shard.json content) tuples.
+
+    Returns:
+        list of error messages.
+    """
+    errors = []
+    counts = {info["shard"][1] for _, info in shardInfos}
+    if len(counts) > 1:
+        errors.append(f"Shards of different splits: N = {sorted(counts)}")
+        return errors
+    count = counts.pop()
+
+    seen = {}
+    for path, info in shardInfos:
+        k = info["shard"][0]
+        if k in seen:
+            errors.append(f"Shard {k} given twice: {seen[k]} and {path}")
+        seen[k] = path
+    missing = sorted(set(range(count)) - set(seen))
+    if len(missing) > 0:
+        errors.append(f"Missing shards {missing} of {count}")
+
+    partials, fingerprints = {}, {}
+    for path, info in shardInfos:
+        for key, p in info["partials"].items():
+            partials.setdefault(key, []).append((path, p))
+            for kind in ("model", "dataset"):
+                fps = fingerprints.setdefault(p[f"{kind}Path"], set())
+                fps.add(p[kind])
+
+    for path, fps in fingerprints.items():
+        if len(fps) > 1:
+            errors.append(f"`{path}` differs between shards (modified?)")
+
+    for key, entries in partials.items():
+        sizes = {p["N"] for _, p in entries}
+        if len(sizes) > 1:
+            errors.append(
+                f"{key}: dataset sizes differ between shards {sorted(sizes)}"
+            )
+            continue
+
+        ranges = sorted(
+            (p["range"][0], p["range"][1], path) for path, p in entries
+        )
+        for (a0, a1, aPath), (b0, b1, bPath) in zip(ranges, ranges[1:]):
+            if b0 < a1:
+                errors.append(
+                    f"{key}: [{a0}, {a1}) of {aPath} overlaps "
+                    f"[{b0}, {b1}) of {bPath}"
+                )
+
+    return errors
+
+
+def mergeShards(env, shardDirs, outDir):
+    """
+    Merges shard saves of runShard into one regular save directory. The
+    shards are checked with checkShards, and every merged prediction has
+    to cover its whole dataset, in which case it is saved as regular
+    energy/forces data. Incomplete ones (e.g. a model that failed in one
+    of the shards) are reported and kept as sparse predictions.
+
+    Returns:
+        int: Exit status, 0 if complete, 1 if incomplete, 2 if the shards
+        do not belong together.
+    """
+    shardInfos = []
+    for path in shardDirs:
+        infoPath = os.path.join(path, SHARD_INFO_FILE)
+        if not os.path.exists(infoPath):
+            print(f"ERROR: {path} is not a shard save (no {SHARD_INFO_FILE})")
+            return 2
+        with open(infoPath) as f:
+            shardInfos.append((path, json.load(f)))
+
+    errors = checkShards(shardInfos)
+    if len(errors) > 0:
+        for e in errors:
+            print(f"ERROR: {e}", flush=True)
+        return 2
+
+    for path in shardDirs:
+        env.load(path)
+
+    incomplete = 0
+    for key, partial in list(env.partialCache.items()):
+        # the fingerprints are enough, models and datasets are not loaded
+        _, model, dataset = key.split("__")
+        if promotePartialPredictions(env, model, dataset):
+            print(f"{key}: complete", flush=True)
+            continue
+
+        incomplete += 1
+        missing = partial.getRanges(missing=True)
+        nMissing = len(rangesToIndices(missing))
+        print(
+            f"{key}: {nMissing} of {len(partial.mask)} configurations "
+            f"missing, {missing.tolist()}",
+            flush=True,
+        )
+
+    if not isArchivePath(outDir):
+        os.makedirs(outDir, exist_ok=True)
+    env.save(outDir)
+    print(f"Merged {len(shardDirs)} shards into {outDir}", flush=True)
+
+    return 1 if incomplete > 0 else 0
@@ -0,0 +1,280 @@
+import importlib.util
+import logging
+import os
+import sys
+import time
+import multiprocessing as mp
+from multiprocessing import shared_memory
+import numpy as np
+
+logger = logging.getLogger("FFAST")
+
+# how often (in seconds) the parent process merges worker progress
+POLL_INTERVAL = 0.2
+
+
+class ModelFactory:
+    """
+    Picklable recipe to rebuild a model inside a worker process. Model types
+    are loaded from their module files (see utils.loadModules) and therefore
+    cannot be pickled by reference, so the source file is re-executed in the
+    worker instead.
+    """
+
+    def __init__(
+        self, sourcePath, className, path, fingerprint=None, options=None
+    ):
+        self.sourcePath = sourcePath
+        self.className = className
+        self.path = path
+        self.fingerprint = fingerprint
+        self.options = options or {}
+
+    def __call__(self, env):
+        name = os.path.basename(self.sourcePath).replace(".py", "")
+        spec = importlib.util.spec_from_file_location(
+            f"module_{name}", self.sourcePath
+        )
+        mod = importlib.util.module_from_spec(spec)
+        sys.modules[spec.name] = mod
+        spec.loader.exec_module(mod)
+
+        model = getattr(mod, self.className)(env, self.path, **self.options)
+        # skips initialise(), fingerprinting can be as slow as loading
+        model.fingerprint = self.fingerprint
+        model.loaded = True
+
+        # warming up would only delay the actual work
+        model.ensureConstructed(warmUp=False)
+        return model
+
+
+class ArrayDataset:
+    """
+    Minimal stand-in for a DatasetLoader inside worker processes, exposing
+    only what the predict methods of models need.
+    """
+
+    isSubDataset = False
+
+    def __init__(self, R, z, lattice=None, fingerprint=None):
+        self.R = R
+        self.z = z
+        self.lattice = lattice
+        self.fingerprint = fingerprint
+
+    def getN(self):
+        return len(self.R)
+
+    def getNAtoms(self):
+        return self.R.shape[1]
+
+    def getCoordinates(self, indices=None):
+        if indices is None:
+            return self.R
+        return self.R[indices]
+
+    def getElements(self):
+        return self.z
+
+    def getLattice(self):
+        return self.lattice
+
+
+class WorkerTaskManager:
+    def __init__(self, cancelEvent):
+        self.cancelEvent = cancelEvent
+
+    def isTaskRunning(self, taskID):
+        return not self.cancelEvent.is_set()
+
+
+class WorkerEnvironment:
+    def __init__(self, cancelEvent):
+        self.tm = WorkerTaskManager(cancelEvent)
+
+
+def shardView(name, start, stop, rowShape):
+    # view on rows [start, stop) of a shared (N, *rowShape) float64 array
+    shm = shared_memory.SharedMemory(name=name)
+    rowSize = int(np.prod(rowShape, dtype=int))
+    flat = np.ndarray((shm.size // 8,), dtype=np.float64, buffer=shm.buf)
+    return shm, flat[start * rowSize : stop * rowSize].reshape(
+        (stop - start,) + rowShape
+    )
+
+
+def predictShard(
+    factory,
+    k,
+    shard,
+    names,
+    nAtoms,
+    z,
+    lattice,
+    progress=None,
+    status=None,
+    cancel=None,
+    nThreads=1,
+):
+    from loaders.modelLoader import configureTorchRuntime
+
+    configureTorchRuntime(threads=nThreads)
+    start, stop = shard
+
+    shms, arrays = [], {}
+    for key, rowShape in (("R", (nAtoms, 3)), ("E", ()), ("F", (nAtoms, 3))):
+        shm, arrays[key] = shardView(names[key], start, stop, rowShape)
+        shms.append(shm)
+
+    try:
+        model = factory(WorkerEnvironment(cancel))
+
+        def reportProgress(event, taskID, progMax=None, prog=None, **kwargs):
+            if (event == "TASK_PROGRESS") and progMax:
+                progress[k] = prog / progMax
+
+        # progress events are merged by the parent process instead
+        model.eventPush = reportProgress
+
+        dataset = ArrayDataset(
+            arrays["R"].copy(),
+            z,
+            lattice,
+            fingerprint=f"{factory.fingerprint}_{k}",
+        )
+        if model.singlePredict:
+            res = model.predict(dataset, taskID=k)
+        else:
+            res = (
+                model.predictE(dataset, taskID=k),
+                model.predictF(dataset, taskID=k),
+            )
+
+        if (res is None) or (res[0] is None) or (res[1] is None):
+            return
+
+        arrays["E"][:] = np.asarray(res[0]).flatten()
+        arrays["F"][:] = np.asarray(res[1]).reshape(arrays["F"].shape)
+        progress[k] = 1
+        status[k] = 1
+
+    finally:
+        arrays.clear()
+        for shm in shms:
+            shm.close()
+
+
+def shardedPredict(model, dataset, indices=None, nWorkers=2, taskID=None):
+    """
+    Predicts energies and forces by splitting the configurations into
+    contiguous shards, each handled by a separate worker process holding its
+    own copy of the model. Coordinates and results live in shared memory so
+    that only the model factory and shard bounds are pickled.
+
+    Workers are started with the `spawn` method, so scripts using this
+    (headless runs) need the usual `if __name__ == "__main__":` guard.
+
+    Args:
+        model (ModelLoader): Model providing a factory, see getFactory.
+        dataset (DatasetLoader): Dataset to predict.
+        indices (array, optional): Configuration indices. Defaults to None.
+        nWorkers (int, optional): Number of worker processes. Defaults to 2.
+        taskID (optional): Task to report merged progress to and check for
+            cancellation. Defaults to None.
+
+    Returns:
+        (E, F) tuple, or None if cancelled or any worker failed.
+    """
+    factory = model.getFactory()
+    if factory is None:
+        logger.error(f"Model {model.getName()} cannot be rebuilt in workers")
+        return None
+
+    if indices is None:
+        R = dataset.getCoordinates()
+    else:
+        R = dataset.getCoordinates(indices=indices)
+    R = np.asarray(R, dtype=np.float64)
+
+    N, nAtoms, _ = R.shape
+    nWorkers = max(1, min(nWorkers, N))
+    bounds = np.linspace(0, N, nWorkers + 1).astype(int)
+    shards = list(zip(bounds[:-1], bounds[1:]))
+    nThreads = max(1, (os.cpu_count() or 1) // nWorkers)
+
+    ctx = mp.get_context("spawn")
+    progress = ctx.Array("d", nWorkers, lock=False)
+    status = ctx.Array("i", nWorkers, lock=False)
+    cancel = ctx.Event()
+
+    shms = {
+        "R": shared_memory.SharedMemory(create=True, size=max(1, R.nbytes)),
+        "E": shared_memory.SharedMemory(create=True, size=max(1, N * 8)),
+        "F": shared_memory.SharedMemory(create=True, size=max(1, R.nbytes)),
+    }
+    names = {k: v.name for k, v in shms.items()}
+    np.ndarray(R.shape, dtype=np.float64, buffer=shms["R"].buf)[:] = R
+
+    z, lattice = dataset.getElements(), dataset.getLattice()
+    processes = []
+    try:
+        for k, shard in enumerate(shards):
+            p = ctx.Process(
+                target=predictShard,
+                args=(factory, k, shard, names, nAtoms, z, lattice),
+                kwargs=dict(
+                    progress=progress,
+                    status=status,
+                    cancel=cancel,
+                    nThreads=nThreads,
+                ),
+                daemon=True,
+            )
+            p.start()
+            processes.append(p)
+
+        sizes = np.diff(bounds)
+        while any(p.is_alive() for p in processes):
+            time.sleep(POLL_INTERVAL)
+            if taskID is None:
+                continue
+
+            model.eventPush(
+                "TASK_PROGRESS",
+                taskID,
+                progMax=N,
+                prog=int(np.dot(sizes, progress[:])),
+                message=f"{model.modelName} predictions ({nWorkers} workers)",
+                quiet=True,
+                percent=True,
+            )
+
+            if not model.env.tm.isTaskRunning(taskID):
+                cancel.set()
+                for p in processes:
+                    p.join(timeout=5)
+                    if p.is_alive():
+                        p.terminate()
+                return None
+
+        if not all(status[:]):
+            failed = [k for k in range(nWorkers) if not status[k]]
+            logger.error(
+                f"Sharded {model.modelName} prediction failed for shards "
+                f"{failed}, see worker output"
+            )
+            return None
+
+        E = np.ndarray((N,), dtype=np.float64, buffer=shms["E"].buf).copy()
+        F = np.ndarray(R.shape, dtype=np.float64, buffer=shms["F"].buf).copy()
+        return E, F
+
+    finally:
+        for p in processes:
+            if p.is_alive():
+                p.terminate()
+            p.join()
+        for shm in shms.values():
+            shm.close()
+            shm.unlink()
@@ -4,6 +4,9 @@ import logging
 logger = logging.getLogger("FFAST")
 subs = defaultdict(list)
 
+# taskID -> stack of (start, stop, total), see setProgressWindow
+progressWindows = {}
+
 # WANTED TO MAKE THEM ONLY ABLE TO HAPPEN ONCE PER CYCLE
 # FOR NOW IM STAGGERING INSIDE THE WIDGET REFRESH THINGY
 # REFRESH_EVENTS = ["WIDGET_REFRESH", "WIDGET_VISUAL_REFRESH"]
@@ -13,6 +16,39 @@ def doNothing(*args):
     pass
 
 
+def setProgressWindow(taskID, start, stop, total):
+    """
+    Maps TASK_PROGRESS events of a task onto [start, stop] out of `total`,
+    e.g. for a model predicting one block of a larger job that only knows
+    about its own progress. Windows nest: a window set while another one is
+    active is relative to it. Every call needs a matching
+    clearProgressWindow.
+    """
+    progressWindows.setdefault(taskID, []).append((start, stop, total))
+
+
+def clearProgressWindow(taskID):
+    windows = progressWindows.get(taskID, None)
+    if windows:
+        windows.pop()
+    if not windows:
+        progressWindows.pop(taskID, None)
+
+
+def windowProgress(taskID, kwargs):
+    prog, progMax = kwargs.get("prog"), kwargs.get("progMax")
+    if (prog is None) or (not progMax):
+        return kwargs
+
+    for start, stop, total in reversed(progressWindows[taskID]):
+        prog = start + (stop - start) * prog / progMax
+        progMax = total
+
+    kwargs = dict(kwargs)
+    kwargs["prog"], kwargs["progMax"] = prog, progMax
+    return kwargs
+
+
 class EventClass:
     """
     Main EventClass, to be inherited by any object that has an independent event loop (i.e. the UI Handler and the Environment).
@@ -54,6 +90,13 @@ class EventClass:
         if not quiet:
             logger.debug(f"Event pushed: {event} by {type(self)}")
 
+        if (
+            (event == "TASK_PROGRESS")
+            and args
+            and (args[0] in progressWindows)
+        ):
+            kwargs = windowProgress(args[0], kwargs)
+
         for obj, func, asynchronous in subs[event]:
             obj.eventQueue.append(
                 (event, func, asynchronous, quiet, args, kwargs)
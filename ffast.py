@@ -0,0 +1,321 @@
+"""
+Command-line entry point for headless FFAST runs, e.g.
+
+    python -m ffast run --dataset sGDML data/train.npz \\
+        --model MACE models/a.model --model MACE models/b.model \\
+        --data energyError forcesError --save out/ --workers 4
+
+or, for a model x dataset grid described by a JSON/TOML manifest (see
+client.gridRun.readManifest),
+
+    python -m ffast grid manifest.toml
+
+or split over several nodes with `run --shard k/N` and merged with
+
+    python -m ffast merge merged/ shard0/ shard1/ ...
+
+or, to compare float32 and float64 inference of MACE models,
+
+    python -m ffast benchmark --dataset sGDML data/test.npz \\
+        --model MACE models/a.model --configs 100
+
+`python -m ffast` works from the repository root, `python path/to/ffast.py`
+from anywhere. Run `python -m ffast <command> --help` for all options.
+"""
+
+import argparse
+import os
+import sys
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+
+
+def addRunArguments(parser):
+    parser.add_argument(
+        "--dataset",
+        nargs=2,
+        action="append",
+        default=[],
+        metavar=("TYPE", "PATH"),
+        help="dataset to load, e.g. `--dataset sGDML train.npz` (repeatable)",
+    )
+    parser.add_argument(
+        "--model",
+        nargs=2,
+        action="append",
+        default=[],
+        metavar=("TYPE", "PATH"),
+        help="model to load, e.g. `--model MACE a.model` (repeatable)",
+    )
+    parser.add_argument(
+        "--data",
+        nargs="+",
+        default=None,
+        metavar="KEY",
+        help="DataType keys to generate, defaults to energyError forcesError",
+    )
+    parser.add_argument(
+        "--load",
+        default=None,
+        help="save directory (or .ffast archive) to start from",
+    )
+    parser.add_argument(
+        "--save",
+        default=None,
+        help="save directory, or .ffast file for a single-file archive",
+    )
+    parser.add_argument(
+        "--metrics", default=None, help="write the metrics to a JSON file"
+    )
+    parser.add_argument(
+        "--profile",
+        default=None,
+        help="write the generation profile to a JSON file, defaults to "
+        "profile.json in the --save directory (or next to the archive)",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=None,
+        help="prediction worker processes (`predictionWorkers`)",
+    )
+    parser.add_argument(
+        "--threads",
+        type=int,
+        default=None,
+        help="torch threads per process (`torchThreads`)",
+    )
+    parser.add_argument(
+        "--timeout",
+        type=float,
+        default=None,
+        help="give up after this many seconds (exit status 1)",
+    )
+    parser.add_argument(
+        "--verbose",
+        action="store_true",
+        help="print the task status periodically",
+    )
+    parser.add_argument(
+        "--shard",
+        default=None,
+        metavar="K/N",
+        help="only predict energies and forces of the k-th (from 0) of N "
+        "slices of each dataset, see the merge command",
+    )
+
+
+def absolutePaths(args):
+    # paths are given relative to the caller, FFAST runs from its root
+    args.dataset = [(t, os.path.abspath(p)) for t, p in args.dataset]
+    args.model = [(t, os.path.abspath(p)) for t, p in args.model]
+    for name in ("load", "save", "metrics", "profile"):
+        if getattr(args, name) is not None:
+            setattr(args, name, os.path.abspath(getattr(args, name)))
+
+
+def applyBudget(args):
+    from config.userConfig import config
+
+    if args.workers is not None:
+        config["predictionWorkers"] = args.workers
+    if args.threads is not None:
+        config["torchThreads"] = args.threads
+
+
+def run(args):
+    from client.batchRun import runBatch
+    from client.environment import startHeadlessEnvironment
+
+    applyBudget(args)
+    env = startHeadlessEnvironment()
+    try:
+        if args.shard is not None:
+            return runShardBatch(env, args)
+        return runBatch(
+            env,
+            args.dataset,
+            args.model,
+            keys=args.data,
+            loadDir=args.load,
+            saveDir=args.save,
+            metricsPath=args.metrics,
+            profilePath=args.profile,
+            timeout=args.timeout,
+            verbose=args.verbose,
+        )
+    finally:
+        env.headlessQuit()
+        env.join()
+
+
+def runShardBatch(env, args):
+    from client.batchRun import loadInputs
+    from client.shardRun import runShard
+
+    datasets, models, errors = loadInputs(env, args.dataset, args.model)
+    if len(errors) > 0:
+        for e in errors:
+            print(f"ERROR: {e}", flush=True)
+        return 2
+
+    return runShard(
+        env, datasets, models, args.shard, args.save, profilePath=args.profile
+    )
+
+
+def benchmark(args):
+    from client.batchRun import runPrecisionBenchmark
+    from client.environment import startHeadlessEnvironment
+
+    applyBudget(args)
+    env = startHeadlessEnvironment()
+    try:
+        return runPrecisionBenchmark(
+            env, args.dataset, args.model, nConfigs=args.configs
+        )
+    finally:
+        env.headlessQuit()
+        env.join()
+
+
+def merge(args):
+    from client.environment import startHeadlessEnvironment
+    from client.shardRun import mergeShards
+
+    env = startHeadlessEnvironment()
+    try:
+        return mergeShards(env, args.shards, args.out)
+    finally:
+        env.headlessQuit()
+        env.join()
+
+
+def grid(args):
+    from client.environment import startHeadlessEnvironment
+    from client.gridRun import ManifestError, readManifest, runGrid
+
+    try:
+        manifest = readManifest(args.manifest)
+    except (OSError, ValueError, ManifestError) as e:
+        print(f"ERROR: could not read manifest `{args.manifest}`: {e}")
+        return 2
+
+    env = startHeadlessEnvironment()
+    try:
+        return runGrid(
+            env, manifest, timeout=args.timeout, verbose=args.verbose
+        )
+    finally:
+        env.headlessQuit()
+        env.join()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="ffast", description="FFAST")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    runParser = commands.add_parser(
+        "run", help="generate data for datasets and models, headless"
+    )
+    addRunArguments(runParser)
+
+    gridParser = commands.add_parser(
+        "grid", help="evaluate the model x dataset grid of a manifest"
+    )
+    gridParser.add_argument("manifest", help="JSON or TOML manifest")
+    gridParser.add_argument(
+        "--timeout",
+        type=float,
+        default=None,
+        help="give up after this many seconds (exit status 1)",
+    )
+    gridParser.add_argument(
+        "--verbose",
+        action="store_true",
+        help="print the task status periodically",
+    )
+
+    mergeParser = commands.add_parser(
+        "merge", help="merge the saves of `run --shard` into one save"
+    )
+    mergeParser.add_argument("out", help="save directory of the result")
+    mergeParser.add_argument("shards", nargs="+", help="shard save dirs")
+
+    benchmarkParser = commands.add_parser(
+        "benchmark", help="compare float32 and float64 inference of models"
+    )
+    benchmarkParser.add_argument(
+        "--dataset",
+        nargs=2,
+        action="append",
+        default=[],
+        metavar=("TYPE", "PATH"),
+        help="dataset to predict, e.g. `--dataset sGDML test.npz`",
+    )
+    benchmarkParser.add_argument(
+        "--model",
+        nargs=2,
+        action="append",
+        default=[],
+        metavar=("TYPE", "PATH"),
+        help="model to benchmark, e.g. `--model MACE a.model` (repeatable)",
+    )
+    benchmarkParser.add_argument(
+        "--configs",
+        type=int,
+        default=100,
+        help="configurations per dataset, spread out (default 100)",
+    )
+    benchmarkParser.add_argument(
+        "--threads",
+        type=int,
+        default=None,
+        help="torch threads per process (`torchThreads`)",
+    )
+    benchmarkParser.set_defaults(workers=None)
+
+    args = parser.parse_args(argv)
+    if args.command == "run":
+        absolutePaths(args)
+    elif args.command == "benchmark":
+        args.dataset = [(t, os.path.abspath(p)) for t, p in args.dataset]
+        args.model = [(t, os.path.abspath(p)) for t, p in args.model]
+    elif args.command == "grid":
+        args.manifest = os.path.abspath(args.manifest)
+    elif args.command == "merge":
+        args.out = os.path.abspath(args.out)
+        args.shards = [os.path.abspath(p) for p in args.shards]
+
+    os.chdir(ROOT)
+    sys.path.insert(0, ROOT)
+
+    if args.command == "run":
+        if len(args.dataset) == 0:
+            runParser.error("at least one --dataset is required")
+        if args.shard is not None:
+            from client.shardRun import parseShard
+
+            try:
+                args.shard = parseShard(args.shard)
+            except ValueError as e:
+                runParser.error(str(e))
+            if (args.save is None) or args.save.endswith(".ffast"):
+                runParser.error("--shard needs a --save directory")
+            if args.data is not None:
+                runParser.error("--shard only predicts energies and forces")
+    elif args.command == "benchmark":
+        if (len(args.dataset) == 0) or (len(args.model) == 0):
+            benchmarkParser.error("--dataset and --model are required")
+
+    commandFuncs = {
+        "run": run,
+        "grid": grid,
+        "merge": merge,
+        "benchmark": benchmark,
+    }
+    return commandFuncs[args.command](args)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
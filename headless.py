@@ -14,10 +14,8 @@ env.waitForTasks(verbose=True)
 d = env.getDatasetFromPath(dpath)
 m = env.getModelFromPath(mpath)
 
-env.addToGenerationQueue("forces", model=m, dataset=d)
-env.waitForTasks(verbose=True)
-
-de = env.getData("forces", model=m, dataset=d)
+# blocks until the forces are generated, see also env.gather
+de = env.generate("forces", model=m, dataset=d).result()
 
 env.save("maceGraphene")
 
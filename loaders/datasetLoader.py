@@ -1,22 +1,21 @@
 from collections import Counter
 import numpy as np
 import os
-from utils import md5FromArraysAndStrings, removeExtension
+from utils import md5FromArraysAndStrings, removeExtension, getFileStamp
 import logging
 from events import EventClass
-from scipy.spatial.distance import pdist
 from config.userConfig import getConfig
 from utils import hexToRGB
 from config.atoms import zIntToZStr, zStrToZInt
 from config.atoms import covalentBonds
-from scipy.spatial import distance_matrix
 from utils import cleanBondIdxsArray
+from client.neighbours import pairDistances, distanceMatrices
 
 logger = logging.getLogger("FFAST")
 GLOBAL_DATASETS_COUNTER = 0
 
 
-def toDistance(R):
+def toDistance(R, lattice=None):
     shape = R.shape
     try:
         dim = shape[2]
@@ -25,13 +24,49 @@ def toDistance(R):
     if shape[1] < 2:
         return
 
-    y = []
+    return pairDistances(R, lattice=lattice)
 
-    for i in range(len(R)):  ##goes through samples
-        y.append(pdist(R[i]))
 
-    y = np.array(y)
-    return y
+def chunkIndices(N, chunkSize=None):
+    """
+    Splits range(N) into consecutive index arrays, used to stream datasets
+    (e.g. when exporting) without materialising them in full.
+
+    Args:
+        N (int): Number of configurations.
+        chunkSize (int, optional): Configurations per chunk. Defaults to the
+            `datasetExportChunkSize` config.
+    """
+    if chunkSize is None:
+        chunkSize = getConfig("datasetExportChunkSize")
+    chunkSize = max(1, int(chunkSize))
+
+    for start in range(0, N, chunkSize):
+        yield np.arange(start, min(start + chunkSize, N))
+
+
+def reportChunkProgress(env, taskID, prog, progMax, message):
+    """
+    Pushes a TASK_PROGRESS event for chunked dataset operations.
+
+    Returns:
+        running (bool): False if the task was cancelled and the caller
+            should abort.
+    """
+    if (env is None) or (taskID is None):
+        return True
+
+    env.eventPush(
+        "TASK_PROGRESS",
+        taskID,
+        progMax=progMax,
+        prog=prog,
+        message=message,
+        quiet=True,
+        percent=True,
+    )
+
+    return env.tm.isTaskRunning(taskID)
 
 
 class DatasetLoader(EventClass):
@@ -45,8 +80,11 @@ class DatasetLoader(EventClass):
 
     isSubDataset = False
     isAtomFiltered = False
+    isSharded = False
     isGhost = False
     frozen = False
+    followable = False  # if True, implements readNewFrames (see follow mode)
+    generation = 0  # incremented every time new frames are appended
 
     def __init__(self, path):
         self.path = path
@@ -140,9 +178,13 @@ class DatasetLoader(EventClass):
             "loupeBondsLenience"
         )
 
+    def getLattice(self):
+        # non-periodic unless overwritten by specific dataset types
+        return None
+
     def getPDist(self, indices=None):
         R = self.getCoordinates(indices=indices)
-        return toDistance(R)
+        return toDistance(R, lattice=self.getLattice())
 
     def getDisplayName(self):
         tag = ""
@@ -161,11 +203,31 @@ class DatasetLoader(EventClass):
         pass
 
     def getBaseInfo(self):
-        return [
+        info = [
             ("N. conf.", f"{self.getN()}"),
             ("N. atoms", f"{self.getNAtoms()}"),
             ("Chem. form.", self.getChemicalFormula()),
         ]
+        if self.generation > 0:
+            info.append(("Generation", f"{self.generation}"))
+
+        return info
+
+    def getFileStamp(self):
+        # used by follow mode to detect changes in the underlying file
+        return getFileStamp(self.path)
+
+    def readNewFrames(self):
+        """
+        Follow mode: ingests configurations appended to the file since it
+        was (last) read. The fingerprint is kept as is, so cached data stays
+        valid and only needs to be extended by the new configurations.
+        To be overwritten by followable dataset types.
+
+        Returns:
+            nNew (int): Number of new configurations.
+        """
+        return 0
 
     def getInfo(self):
         # specific info to be overwritten by specific dataset types
@@ -177,7 +239,7 @@ class DatasetLoader(EventClass):
 
     def getBondMatrix(self, index):
         r = self.getCoordinates(index)
-        d = distance_matrix(r, r)
+        d = distanceMatrices(r, lattice=self.getLattice())
 
         return d < self.bondSizes
 
@@ -440,7 +502,7 @@ class AtomFilteredDataset(DatasetLoader):
 
     def getPDist(self, indices=None):
         R = self.getCoordinates(indices=indices)
-        return toDistance(R)
+        return toDistance(R, lattice=self.getLattice())
 
     def getNAtoms(self):
         return len(self.indices)
@@ -469,3 +531,113 @@ class AtomFilteredDataset(DatasetLoader):
             return False
 
         return self.parent is obj
+
+
+class ShardedDataset(DatasetLoader):
+    """
+    Presents several shard datasets of the same molecule as one dataset,
+    without concatenating them. Configurations are routed to their shard via
+    a precomputed offset index, and the fingerprint combines the shard
+    fingerprints so per-shard cached data can be reused (see env.getData).
+    """
+
+    loadeeType = "dataset"
+    isSharded = True
+
+    datasetName = "Sharded"
+    datasetType = "ShardedDataset"
+
+    def __init__(self, shards):
+        super().__init__(";".join([s.path for s in shards]))
+
+        if len(shards) == 0:
+            raise ValueError("ShardedDataset needs at least one shard")
+
+        z = shards[0].getElements()
+        for shard in shards[1:]:
+            if not np.array_equal(shard.getElements(), z):
+                raise ValueError(
+                    f"Shard `{shard.path}` does not have the same elements as `{shards[0].path}`"
+                )
+
+        self.shards = shards
+        self.offsets = np.cumsum([0] + [s.getN() for s in shards])
+        self.N = int(self.offsets[-1])
+
+    def getShardFingerprints(self):
+        return [s.fingerprint for s in self.shards]
+
+    def getFingerprint(self):
+        return md5FromArraysAndStrings(*self.getShardFingerprints())
+
+    def initialise(self):
+        super().initialise()
+
+        name = removeExtension(os.path.basename(self.shards[0].path))
+        self.setName(f"{name} [{len(self.shards)} shards]")
+
+    def locate(self, indices):
+        """
+        Converts global indices into (shard index, local index) arrays.
+        """
+        shardIdx = np.searchsorted(self.offsets, indices, side="right") - 1
+        return shardIdx, indices - self.offsets[shardIdx]
+
+    def gather(self, getter, indices):
+        if indices is None:
+            return np.concatenate([getter(s)() for s in self.shards])
+
+        if np.isscalar(indices):
+            shardIdx, localIdx = self.locate(int(indices))
+            return getter(self.shards[shardIdx])(indices=localIdx)
+
+        indices = np.asarray(indices)
+        if indices.dtype == bool:
+            indices = np.flatnonzero(indices)
+        indices = np.where(indices < 0, indices + self.N, indices)
+
+        shardIdx, localIdx = self.locate(indices)
+        out = None
+        for i in np.unique(shardIdx):
+            mask = shardIdx == i
+            arr = getter(self.shards[i])(indices=localIdx[mask])
+            if out is None:
+                out = np.empty((len(indices),) + arr.shape[1:], arr.dtype)
+            out[mask] = arr
+
+        if out is None:
+            arr = getter(self.shards[0])(indices=np.arange(1))
+            out = np.empty((0,) + arr.shape[1:], arr.dtype)
+
+        return out
+
+    def getN(self):
+        return self.N
+
+    def getNAtoms(self):
+        return self.shards[0].getNAtoms()
+
+    def getChemicalFormula(self):
+        return self.shards[0].getChemicalFormula()
+
+    def getElements(self):
+        return self.shards[0].getElements()
+
+    def getLattice(self):
+        return self.shards[0].getLattice()
+
+    def getCoordinates(self, indices=None):
+        return self.gather(lambda s: s.getCoordinates, indices)
+
+    def getEnergies(self, indices=None):
+        return self.gather(lambda s: s.getEnergies, indices)
+
+    def getForces(self, indices=None):
+        return self.gather(lambda s: s.getForces, indices)
+
+    def getInfo(self):
+        return [("N. shards", f"{len(self.shards)}")]
+
+    def onDelete(self):
+        for shard in self.shards:
+            shard.onDelete()
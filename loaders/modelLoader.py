@@ -2,13 +2,189 @@ import os
 from events import EventClass
 from utils import removeExtension
 import torch
+import contextlib
+import functools
+import json
 import logging
+import threading
+import time
 import numpy as np
 from config.userConfig import getConfig
-from utils import hexToRGB
+from utils import hexToRGB, getFileStamp
 
 logger = logging.getLogger("FFAST")
 GLOBAL_MODELS_COUNTER = 0
+TORCH_RUNTIME_CONFIGURED = False
+
+FINGERPRINT_CACHE_PATH = os.path.join(
+    os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+    "temp",
+    "fingerprints.json",
+)
+fingerprintCacheLock = threading.Lock()
+
+
+def configureTorchRuntime(threads=None):
+    """
+    Applies the torch thread settings once per process: `torchThreads`
+    intra-op and `torchInteropThreads` inter-op threads (None keeps torch's
+    defaults). Inter-op threads can only be set before torch first runs
+    anything in parallel.
+
+    Args:
+        threads (int, optional): Overrides `torchThreads`, e.g. for worker
+            processes sharing the cores. Defaults to None.
+    """
+    global TORCH_RUNTIME_CONFIGURED
+    if TORCH_RUNTIME_CONFIGURED:
+        return
+    TORCH_RUNTIME_CONFIGURED = True
+
+    if threads is None:
+        threads = getConfig("torchThreads", None)
+    if threads:
+        torch.set_num_threads(threads)
+
+    interop = getConfig("torchInteropThreads", None)
+    if interop:
+        try:
+            torch.set_num_interop_threads(interop)
+        except RuntimeError as e:
+            logger.warning(f"Could not set torch inter-op threads: {e}")
+
+    logger.info(
+        f"Torch runtime: {torch.get_num_threads()} intra-op, "
+        f"{torch.get_num_interop_threads()} inter-op threads"
+    )
+
+
+# threadpoolctl limits are process-wide, they are shared by all running
+# predictions and restored once the last one is done, see blasLimits
+blasLimitLock = threading.Lock()
+blasLimitUsers = 0
+blasLimiter = None
+
+
+@contextlib.contextmanager
+def blasLimits():
+    """
+    Limits numpy's BLAS threads to `torchBlasThreads` while torch runs, so
+    the two thread pools do not oversubscribe the cores. Needs the optional
+    threadpoolctl package, does nothing without it. The limit is applied
+    when the first prediction starts and the original limits are restored
+    when the last one running ends. The limit is process-wide, i.e. it also
+    applies to numpy work of other tasks meanwhile (clustering, KDEs...),
+    hence off (None) unless set.
+    """
+    global blasLimitUsers, blasLimiter
+
+    limit = getConfig("torchBlasThreads", None)
+    try:
+        from threadpoolctl import threadpool_limits
+    except ImportError:
+        limit = None
+
+    if not limit:
+        yield
+        return
+
+    with blasLimitLock:
+        if blasLimitUsers == 0:
+            blasLimiter = threadpool_limits(limits=limit, user_api="blas")
+        blasLimitUsers += 1
+
+    try:
+        yield
+    finally:
+        with blasLimitLock:
+            blasLimitUsers -= 1
+            if blasLimitUsers == 0:
+                blasLimiter.restore_original_limits()
+                blasLimiter = None
+
+
+def torchInference(predict):
+    """
+    Decorator for the predict method of torch-based loaders, running it in
+    the shared inference runtime: configured thread pools, limited BLAS
+    threads and, for models that do not need autograd (i.e. forces not
+    obtained as gradients), torch.inference_mode. The model is constructed
+    first if needed, outside of inference mode.
+    """
+
+    @functools.wraps(predict)
+    def wrapper(self, *args, **kwargs):
+        self.ensureConstructed()
+        configureTorchRuntime()
+        if self.needsGradients:
+            mode = torch.enable_grad()
+        else:
+            mode = torch.inference_mode()
+
+        with blasLimits(), mode:
+            return predict(self, *args, **kwargs)
+
+    return wrapper
+
+
+def freezeTorchModule(module):
+    """
+    Scripts (if needed) and freezes a module with TorchScript.
+
+    Returns:
+        The frozen module, or None if the model does not support it.
+    """
+    try:
+        if not isinstance(module, torch.jit.ScriptModule):
+            module = torch.jit.script(module)
+        return torch.jit.freeze(module.eval())
+    except Exception as e:
+        logger.warning(f"TorchScript freezing failed, keeping model: {e}")
+        return None
+
+
+def readFingerprintCache():
+    try:
+        with open(FINGERPRINT_CACHE_PATH) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def getCachedFingerprint(key, stamp):
+    """
+    Fingerprint stored under the key, if the file stamp (see
+    utils.getFileStamp) still matches the one it was computed for.
+
+    Returns:
+        str, or None if missing or stale.
+    """
+    with fingerprintCacheLock:
+        entry = readFingerprintCache().get(key, None)
+
+    if (entry is None) or (stamp is None):
+        return None
+    if tuple(entry["stamp"]) != tuple(stamp):
+        return None
+    return entry["fingerprint"]
+
+
+def setCachedFingerprint(key, stamp, fingerprint):
+    if stamp is None:
+        return
+
+    with fingerprintCacheLock:
+        cache = readFingerprintCache()
+        cache[key] = {"stamp": list(stamp), "fingerprint": fingerprint}
+
+        try:
+            os.makedirs(os.path.dirname(FINGERPRINT_CACHE_PATH), exist_ok=True)
+            tmp = f"{FINGERPRINT_CACHE_PATH}.tmp"
+            with open(tmp, "w") as f:
+                json.dump(cache, f)
+            os.replace(tmp, FINGERPRINT_CACHE_PATH)
+        except OSError as e:
+            logger.warning(f"Could not write fingerprint cache: {e}")
 
 
 class ModelLoader(EventClass):
@@ -26,6 +202,8 @@ class ModelLoader(EventClass):
         super().__init__()
         self.env = env
         self.path = path
+        # re-entrant, the warm-up after construction predicts
+        self.constructLock = threading.RLock()
 
         global GLOBAL_MODELS_COUNTER
 
@@ -39,12 +217,20 @@ class ModelLoader(EventClass):
     fingerprint = None
     loadeeType = "model"
     loaded = False
+    constructed = False
     isGhost = False
     singlePredict = False
     modelName = "N/A"
     modelFileExtension = "*"
     name = "?"
 
+    # load-time options (constructor kwargs) and their choices, e.g.
+    # {"precision": ["native", "float32"]}
+    loadOptions = {}
+
+    usesTorch = False  # if True, prepared with the torch runtime on load
+    needsGradients = True  # forces from autograd, no torch.inference_mode
+
     def setName(self, name):
         if name == "":
             return self.setName(self.name)
@@ -59,14 +245,147 @@ class ModelLoader(EventClass):
         return self.name
 
     def initialise(self):
-        self.fingerprint = self.getFingerprint()
-
         name = removeExtension(os.path.basename(self.path))
         self.setName(name)
 
+        self.fingerprint = self.getCachedFingerprint()
+
+        # lazy construction defers the warm-up (see prepareRuntime) to the
+        # first prediction
+        if not getConfig("lazyModelConstruction", False):
+            self.ensureConstructed()
+
+    def getFingerprintCacheKey(self):
+        options = json.dumps(self.getOptions(), sort_keys=True)
+        path = os.path.abspath(self.path)
+        return f"{type(self).__name__}:{path}:{options}"
+
+    def getCachedFingerprint(self):
+        """
+        The model fingerprint, read from the fingerprint cache when the model
+        file did not change since it was last computed (same path, mtime and
+        size), so that no model has to be constructed just to match cached
+        predictions or ghost models.
+        """
+        key = self.getFingerprintCacheKey()
+        stamp = getFileStamp(self.path)
+        fp = getCachedFingerprint(key, stamp)
+
+        if fp is None:
+            fp = self.getFingerprint()
+            setCachedFingerprint(key, stamp, fp)
+        return fp
+
+    # to be overwritten, heavy construction (calculators, torch modules...)
+    # deferred until the model is first needed
+    def construct(self):
+        pass
+
+    def ensureConstructed(self, warmUp=True):
+        """
+        Constructs the model if it was not yet, see construct. Called at load
+        unless `lazyModelConstruction` is set, and at the start of every
+        prediction.
+        """
+        with self.constructLock:
+            if self.constructed:
+                return
+
+            t0 = time.perf_counter()
+            self.construct()
+            self.constructed = True
+            logger.debug(
+                f"Constructed {self.modelName} model {self.name} in "
+                f"{time.perf_counter() - t0:.1f}s"
+            )
+
+            if self.usesTorch:
+                self.prepareRuntime(warmUp=warmUp)
+
+    # to be overwritten by torch-based loaders
+    def getTorchModule(self):
+        return None
+
+    def setTorchModule(self, module):
+        pass
+
+    def getWarmUpElements(self):
+        # methane, any element the model supports will do
+        return np.array([6, 1, 1, 1, 1])
+
+    def prepareRuntime(self, warmUp=True):
+        """
+        Puts the torch module in evaluation mode without parameter
+        gradients, freezes it with TorchScript if the model is listed in
+        `torchFreezeModels` and runs a warm-up prediction (`torchWarmUp`),
+        so that first-call overhead is paid at load rather than inside the
+        first prediction task.
+        """
+        configureTorchRuntime()
+
+        module = self.getTorchModule()
+        if module is not None:
+            module.eval()
+            for param in module.parameters():
+                param.requires_grad_(False)
+
+            if self.modelName in getConfig("torchFreezeModels", []):
+                frozen = freezeTorchModule(module)
+                if frozen is not None:
+                    self.setTorchModule(frozen)
+                    logger.info(f"Froze {self.modelName} model {self.name}")
+
+        if warmUp and getConfig("torchWarmUp", True):
+            self.warmUp()
+
+    def warmUp(self):
+        from client.shardedPrediction import ArrayDataset
+
+        z = self.getWarmUpElements()
+        if z is None:
+            return
+
+        # two slightly different configurations of a loose chain
+        r = np.arange(len(z))[:, None] * np.array([1.1, 0.4, 0.2])
+        R = np.stack([r, r * 1.05])
+
+        try:
+            self.predict(ArrayDataset(R, z), batchSize=2)
+        except Exception as e:
+            logger.warning(f"Warm-up of {self.modelName} model failed: {e}")
+
     def onDelete(self):
         pass
 
+    def getOptions(self):
+        """
+        Load options the model was constructed with, see loadOptions.
+        """
+        return {}
+
+    def getFactory(self):
+        """
+        Picklable factory rebuilding this model in another process, used for
+        sharded (multi-process) predictions.
+
+        Returns:
+            ModelFactory, or None if the model is not backed by a file.
+        """
+        import inspect
+        from client.shardedPrediction import ModelFactory
+
+        if self.isGhost or not os.path.isfile(self.path):
+            return None
+
+        cls = type(self)
+        return ModelFactory(
+            inspect.getfile(cls),
+            cls.__name__,
+            self.path,
+            self.fingerprint,
+            options=self.getOptions(),
+        )
+
     # to be overwritten
     def getInfo(self):
         return []
@@ -77,21 +396,160 @@ class ModelLoader(EventClass):
 
 
 class ModelLoaderACE(ModelLoader):
+    """
+    Base class for graph-based models (MACE, Nequip...) shipped with an ASE
+    calculator. Subclasses that set `cutoff` and implement `predictBatch`
+    run many configurations per forward pass on graphs built directly from
+    the coordinate arrays, all others go through the calculator one
+    configuration at a time.
+    """
+
     modelName = "?"
+    cutoff = None
+    usesTorch = True
+    # set when predictBatch turned out incompatible with the installed
+    # model package, see predict
+    batchDisabled = False
 
     def __init__(self, env, path):
         super().__init__(env, path)
 
-    def predict(self, dataset, indices=None, batchSize=1, taskID=None):
-        from ase import Atoms
+    def getTorchModule(self):
+        return self.calculator.model
 
+    def setTorchModule(self, module):
+        self.calculator.model = module
+        if hasattr(self.calculator, "models"):
+            self.calculator.models = [module]
+
+    @torchInference
+    def predict(self, dataset, indices=None, batchSize=50, taskID=None):
         if indices is None:
             R = dataset.getCoordinates()
         else:
             R = dataset.getCoordinates(indices=indices)
 
+        from client.neighbours import latticeToMatrix
+
         z = dataset.getElements()
-        lattice = dataset.getLattice()
+        # missing or degenerate lattices are non-periodic
+        lat = latticeToMatrix(dataset.getLattice())
+        lattice = None if lat is None else lat[0]
+
+        if not self.canPredictBatch():
+            return self.predictSerial(R, z, lattice, taskID=taskID)
+
+        E, F = np.empty(len(R)), np.empty(R.shape)
+        for start in range(0, len(R), batchSize):
+            idx = slice(start, start + batchSize)
+            graph = self.batchGraph(R[idx], lattice)
+            try:
+                E[idx], F[idx] = self.predictBatch(graph, z)
+            except (AttributeError, KeyError, TypeError, ImportError) as e:
+                # batched inputs rely on the internals of the model package,
+                # the calculator is the safe fallback if those changed
+                logger.warning(
+                    f"{self.modelName} batched inference is incompatible "
+                    f"with the installed package ({e}), falling back to "
+                    "per-configuration predictions"
+                )
+                self.batchDisabled = True
+                res = self.predictSerial(R[start:], z, lattice, taskID=taskID)
+                if res is None:
+                    return None
+                E[start:], F[start:] = res
+                return E, F
+            except Exception as e:
+                # e.g. out of memory, only this batch goes through the
+                # calculator
+                logger.warning(
+                    f"{self.modelName} batched inference failed ({e}), "
+                    "predicting this batch per configuration"
+                )
+                E[idx], F[idx] = self.predictSerial(R[idx], z, lattice)
+
+            if taskID is not None:
+                self.eventPush(
+                    "TASK_PROGRESS",
+                    taskID,
+                    progMax=len(R),
+                    prog=min(start + batchSize, len(R)),
+                    message=f"{self.modelName} batch predictions",
+                    quiet=True,
+                    percent=True,
+                )
+
+                if not self.env.tm.isTaskRunning(taskID):
+                    return None
+
+        return E, F
+
+    def batchGraph(self, R, lattice=None):
+        """
+        Builds the disjoint union of the graphs of several configurations.
+        Edges point from the central atom (first row of `edgeIndex`) to the
+        neighbour, whose position is shifted by `unitShifts @ lattice`.
+
+        Args:
+            R (array): MxNx3 array of coordinates.
+            lattice (array, optional): 3x3 lattice. Defaults to None.
+
+        Returns:
+            dict: Numpy arrays `positions`, `edgeIndex`, `unitShifts`,
+                `shifts`, `cell` (Mx3x3), `batch` and `ptr`, plus the
+                `periodic` flag.
+        """
+        from client.neighbours import neighbourList
+
+        nFrames, nAtoms, _ = R.shape
+        frameIdx, idxI, idxJ, offsets = neighbourList(
+            R, self.cutoff, lattice=lattice
+        )
+
+        if lattice is None:
+            cell = np.zeros((3, 3))
+        else:
+            cell = np.asarray(lattice, dtype=float).reshape(3, 3)
+
+        return {
+            "positions": R.reshape(-1, 3),
+            "edgeIndex": np.stack(
+                [frameIdx * nAtoms + idxI, frameIdx * nAtoms + idxJ]
+            ),
+            "unitShifts": offsets.astype(float),
+            "shifts": offsets @ cell,
+            "cell": np.tile(cell, (nFrames, 1, 1)),
+            "batch": np.repeat(np.arange(nFrames), nAtoms),
+            "ptr": np.arange(nFrames + 1) * nAtoms,
+            "periodic": lattice is not None,
+        }
+
+    def canPredictBatch(self):
+        overridden = type(self).predictBatch is not ModelLoaderACE.predictBatch
+        return (
+            (self.cutoff is not None) and overridden and not self.batchDisabled
+        )
+
+    # to be overwritten
+    def predictBatch(self, graph, z):
+        """
+        Runs a single forward pass over a graph built by `batchGraph`.
+        Abstract hook, only used if the subclass overrides it and sets
+        `cutoff` (see canPredictBatch). It may raise AttributeError,
+        KeyError, TypeError or ImportError if the model package's internals
+        are not what it expects, which disables batching for the session.
+
+        Args:
+            graph (dict): Output of `batchGraph`.
+            z (array): Atomic numbers of a single configuration.
+
+        Returns:
+            (E, F) tuple of shape (M,) and (M, N, 3).
+        """
+        raise NotImplementedError
+
+    def predictSerial(self, R, z, lattice=None, taskID=None):
+        from ase import Atoms
 
         E, F = [], []
         for i in range(len(R)):
@@ -107,13 +565,13 @@ class ModelLoaderACE(ModelLoader):
             F.append(atoms.get_forces())
             E.append(atoms.get_potential_energy())
 
-            if (taskID is not None) and (i % batchSize == 0):
+            if taskID is not None:
                 self.eventPush(
                     "TASK_PROGRESS",
                     taskID,
                     progMax=len(R),
                     prog=i,
-                    message=f"{self.modelName} batch predictions",
+                    message=f"{self.modelName} predictions",
                     quiet=True,
                     percent=True,
                 )
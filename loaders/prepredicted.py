@@ -0,0 +1,154 @@
+import hashlib
+import logging
+import os
+import struct
+import zipfile
+import numpy as np
+from config.userConfig import getConfig
+from utils import md5FromArraysAndStrings, getFileStamp
+
+logger = logging.getLogger("FFAST")
+
+# size of a zip local file header before the (variable) name and extra field
+ZIP_LOCAL_HEADER_SIZE = 30
+
+
+def readNpyHeader(f):
+    version = np.lib.format.read_magic(f)
+    if version == (1, 0):
+        return np.lib.format.read_array_header_1_0(f)
+    return np.lib.format.read_array_header_2_0(f)
+
+
+def mapNpzEntry(path, key):
+    """
+    Memory-maps an array of an npz archive, which only works if the entry
+    is stored uncompressed (np.savez, not np.savez_compressed).
+
+    Returns:
+        Read-only np.memmap, or None if the entry is compressed or cannot
+        be mapped (e.g. object arrays).
+    """
+    with zipfile.ZipFile(path) as zf:
+        info = zf.getinfo(f"{key}.npy")
+    if info.compress_type != zipfile.ZIP_STORED:
+        return None
+
+    with open(path, "rb") as f:
+        f.seek(info.header_offset)
+        header = f.read(ZIP_LOCAL_HEADER_SIZE)
+        nameLength, extraLength = struct.unpack("<HH", header[26:30])
+        f.seek(
+            info.header_offset
+            + ZIP_LOCAL_HEADER_SIZE
+            + nameLength
+            + extraLength
+        )
+        shape, fortran, dtype = readNpyHeader(f)
+        offset = f.tell()
+
+    if dtype.hasobject:
+        return None
+
+    return np.memmap(
+        path,
+        dtype=dtype,
+        mode="r",
+        shape=shape,
+        offset=offset,
+        order="F" if fortran else "C",
+    )
+
+
+def npyPairPaths(path):
+    # `<prefix>E.npy` and `<prefix>F.npy`, either can be given
+    prefix = path[:-5]
+    return f"{prefix}E.npy", f"{prefix}F.npy"
+
+
+def isNpyPair(path):
+    return path.endswith("E.npy") or path.endswith("F.npy")
+
+
+def openPrepredicted(path):
+    """
+    Opens prepredicted energies and forces without reading them, as
+    memory maps where possible:
+        - `<prefix>E.npy` + `<prefix>F.npy` pairs (either path can be given)
+        - uncompressed npz archives with `E` and `F` entries
+    Compressed npz entries are decompressed into memory.
+
+    Returns:
+        (E, F, mapped) tuple, mapped is True if both arrays are memory maps.
+    """
+    if isNpyPair(path):
+        ePath, fPath = npyPairPaths(path)
+        E = np.load(ePath, mmap_mode="r")
+        F = np.load(fPath, mmap_mode="r")
+        return E, F, True
+
+    arrays = {}
+    for key in ("E", "F"):
+        arrays[key] = mapNpzEntry(path, key)
+        if arrays[key] is None:
+            logger.info(
+                f"Entry {key} of {path} is compressed, loading it into memory"
+            )
+            arrays[key] = np.load(path, allow_pickle=True)[key]
+
+    mapped = all(isinstance(x, np.memmap) for x in arrays.values())
+    return arrays["E"], arrays["F"], mapped
+
+
+def validatePrepredicted(E, F, dataset):
+    """
+    Checks the shapes of prepredicted energies and forces against a dataset,
+    using array metadata only.
+
+    Returns:
+        error (str), or None if valid.
+    """
+    N, nAtoms = dataset.getN(), dataset.getNAtoms()
+
+    if (E.ndim == 0) or (E.shape[0] != N) or (np.prod(E.shape[1:]) != 1):
+        return f"energy shape {E.shape} does not match {N} configurations"
+
+    if F.shape != (N, nAtoms, 3):
+        return (
+            f"forces shape {F.shape} does not match dataset shape "
+            f"{(N, nAtoms, 3)}"
+        )
+
+    return None
+
+
+def chunkedMD5(arr, chunkSize):
+    # same digest as hashlib.md5(arr.ravel()), streamed chunk by chunk
+    md5 = hashlib.md5()
+    flat = arr.reshape(len(arr), -1) if arr.ndim > 1 else arr
+    for start in range(0, len(flat), chunkSize):
+        md5.update(np.ascontiguousarray(flat[start : start + chunkSize]).data)
+    return md5
+
+
+def getPrepredictedKey(path, E, F):
+    """
+    Model key of prepredicted results. With `prepredictedChecksum` set, the
+    content checksum of E and F, computed in chunks of
+    `datasetExportChunkSize` configurations (identical to hashing them in
+    full, as done before memory-mapping). Otherwise derived from the file
+    identity (path, mtime, size) and the shapes, without reading any data.
+    """
+    if not getConfig("prepredictedChecksum", True):
+        stamps = [str(getFileStamp(p)) for p in npyPairPaths(path)]
+        if not isNpyPair(path):
+            stamps = [str(getFileStamp(path))]
+        return md5FromArraysAndStrings(
+            os.path.abspath(path), *stamps, str(E.shape), str(F.shape)
+        )
+
+    chunkSize = max(1, int(getConfig("datasetExportChunkSize")))
+    fp = hashlib.md5()
+    for arr in (E, F):
+        fp.update(chunkedMD5(arr, chunkSize).digest())
+    return fp.hexdigest()
@@ -0,0 +1,194 @@
+from loaders.modelLoader import ModelLoader
+from config.userConfig import getConfig
+from multiprocessing import shared_memory
+import inspect
+import json
+import logging
+import os
+import threading
+import numpy as np
+
+logger = logging.getLogger("FFAST")
+
+
+class RemoteModelLoader(ModelLoader):
+    """
+    Proxy for a model hosted by a model server process (see
+    client.modelServer), which owns the model and its backend (torch...).
+    Coordinates and predictions are exchanged through shared memory, only
+    small requests go through the socket. If the server goes away,
+    predictions fail instead of the session, and the next prediction
+    reconnects.
+    """
+
+    singlePredict = True
+
+    def __init__(self, env, path, modelType, options=None, address=None):
+        """
+        Args:
+            path (str): Path to the model file, as seen by the server.
+            modelType (type): ModelLoader subclass the server builds.
+            options (dict, optional): Load options, see
+                ModelLoader.loadOptions. Defaults to None.
+            address (str, optional): Server address. Defaults to the
+                `modelServer` setting.
+        """
+        super().__init__(env, path)
+        self.modelType = modelType
+        self.modelName = modelType.modelName
+        self.options = options or {}
+        self.address = address or getConfig("modelServer")
+
+        self.conn = None
+        self.connLock = threading.Lock()
+        self.remoteKey = None
+        self.remoteInfo = []
+        self.remoteFingerprint = None
+
+    def construct(self):
+        with self.connLock:
+            self.connect()
+
+    def connect(self):
+        from client.modelServer import connectModelServer
+        from client.shardedPrediction import ModelFactory
+
+        self.conn = connectModelServer(
+            self.address, autostart=getConfig("modelServerAutostart", True)
+        )
+
+        factory = ModelFactory(
+            inspect.getfile(self.modelType),
+            self.modelType.__name__,
+            os.path.abspath(self.path),
+            options=self.options,
+        )
+        res = self.send("load", factory)
+        self.remoteKey = res["key"]
+        self.remoteInfo = res["info"]
+        self.remoteFingerprint = res["fingerprint"]
+
+    def send(self, *request):
+        try:
+            self.conn.send(request)
+            status, res = self.conn.recv()
+        except (EOFError, OSError) as e:
+            self.disconnect()
+            raise ConnectionError(f"Lost connection to model server: {e}")
+
+        if status == "error":
+            raise RuntimeError(f"Model server: {res}")
+        return res
+
+    def request(self, *request):
+        with self.connLock:
+            if self.conn is None:
+                # server restarted, the model has to be loaded again
+                self.connect()
+            return self.send(*request)
+
+    def disconnect(self):
+        if self.conn is not None:
+            try:
+                self.conn.close()
+            except OSError:
+                pass
+        self.conn = None
+
+    def predict(self, dataset, indices=None, batchSize=50, taskID=None):
+        try:
+            self.ensureConstructed()
+        except Exception as e:
+            logger.error(f"Could not reach model server {self.address}: {e}")
+            return None
+
+        if indices is None:
+            R = dataset.getCoordinates()
+        else:
+            R = dataset.getCoordinates(indices=indices)
+        R = np.asarray(R, dtype=np.float64)
+
+        N, nAtoms, _ = R.shape
+        chunkSize = getConfig("modelServerChunkSize", 1000)
+        z, lattice = dataset.getElements(), dataset.getLattice()
+
+        shms = {
+            "R": shared_memory.SharedMemory(
+                create=True, size=max(1, R.nbytes)
+            ),
+            "E": shared_memory.SharedMemory(create=True, size=max(1, N * 8)),
+            "F": shared_memory.SharedMemory(
+                create=True, size=max(1, R.nbytes)
+            ),
+        }
+        names = {k: v.name for k, v in shms.items()}
+        np.ndarray(R.shape, dtype=np.float64, buffer=shms["R"].buf)[:] = R
+
+        try:
+            # requests are chunked for progress reports and cancellation
+            for start in range(0, N, chunkSize):
+                stop = min(start + chunkSize, N)
+                try:
+                    self.request(
+                        "predict",
+                        self.remoteKey,
+                        names,
+                        N,
+                        nAtoms,
+                        start,
+                        stop,
+                        z,
+                        lattice,
+                        batchSize,
+                    )
+                except Exception as e:
+                    logger.error(f"Remote {self.modelName} prediction: {e}")
+                    return None
+
+                if taskID is not None:
+                    self.eventPush(
+                        "TASK_PROGRESS",
+                        taskID,
+                        progMax=N,
+                        prog=stop,
+                        message=f"{self.modelName} predictions (server)",
+                        quiet=True,
+                        percent=True,
+                    )
+
+                    if not self.env.tm.isTaskRunning(taskID):
+                        return None
+
+            E = np.ndarray((N,), dtype=np.float64, buffer=shms["E"].buf)
+            F = np.ndarray(R.shape, dtype=np.float64, buffer=shms["F"].buf)
+            E, F = E.copy(), F.copy()
+            return E, F
+
+        finally:
+            for shm in shms.values():
+                shm.close()
+                shm.unlink()
+
+    def getFingerprint(self):
+        self.ensureConstructed()
+        return self.remoteFingerprint
+
+    def getFingerprintCacheKey(self):
+        # same entry as the model loaded in-process
+        options = json.dumps(self.getOptions(), sort_keys=True)
+        path = os.path.abspath(self.path)
+        return f"{self.modelType.__name__}:{path}:{options}"
+
+    def getOptions(self):
+        return self.options
+
+    def getFactory(self):
+        # the server already runs predictions outside the session
+        return None
+
+    def getInfo(self):
+        return [("Server", self.address)] + list(self.remoteInfo)
+
+    def onDelete(self):
+        with self.connLock:
+            self.disconnect()
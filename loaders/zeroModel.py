@@ -12,7 +12,7 @@ class ZeroModelLoader(ModelLoader):
         self.name = "Zero Model"
 
     def predict(self, dataset, indices=None, batchSize=50, taskID=None):
-        R = dataset.getCoordinates()
+        R = dataset.getCoordinates(indices=indices)
         return np.zeros(R.shape[0]), np.zeros_like(R)
 
     def getFingerprint(self):
@@ -108,6 +108,7 @@ async def eventLoop(UI, env):
         await env.eventHandle()
         await nh.eventHandle()
         await env.handleGenerationQueue()
+        await env.handleFollowedDatasets()
         await taskManager.eventHandle()
         await taskManager.handleTaskQueue()
         await asyncio.sleep(0.1)
@@ -1,69 +1,216 @@
 from loaders.modelLoader import ModelLoaderACE
+import numpy as np
 import torch
+import contextlib
 import logging
+from config.userConfig import getConfig
 
 logger = logging.getLogger("FFAST")
 
+# float64 first, it is the default (see macePrecision) and what models used
+# to be forced to
+PRECISION_MODES = ["float64", "float32", "native"]
+TORCH_DTYPES = {"float32": torch.float32, "float64": torch.float64}
+
+
+@contextlib.contextmanager
+def cpuJitLoad():
+    # NOTE: This is *terrible* practice but the only way I have found
+    # to make this workable on CPU. Unfortunately this will have to do.
+    torchJitLoad = torch.jit.load
+
+    def jitLoadWrapper(*args, **kwargs):
+        kwargs.update(map_location="cpu")
+        return torchJitLoad(*args, **kwargs)
+
+    torch.jit.load = jitLoadWrapper
+    try:
+        yield
+    finally:
+        torch.jit.load = torchJitLoad
+
+
+def detectDtype(model):
+    dtype = None
+    for x in model.named_buffers():
+        if x[0].startswith("interactions"):
+            dtype = x[1].dtype
+            break
+
+    if dtype is None:
+        logger.warn(
+            f"MACE model did not find a named buffed starting with `interactions` to determined dtype. Did the versions change? Defaulting to float64"
+        )
+        dtype = torch.float64
+
+    if dtype == torch.float32:
+        return "float32"
+    return "float64"
+
 
 class MACEModelLoader(ModelLoaderACE):
     singlePredict = True
     modelName = "MACE"
     modelFileExtension = "*.model"
+    loadOptions = {"precision": PRECISION_MODES}
 
-    def __init__(self, env, path):
+    def __init__(self, env, path, precision=None):
         super().__init__(env, path)
         self.path = path
 
-        from mace.calculators.mace import MACECalculator
-
-        # NOTE: This is *terrible* practice but the only way I have found
-        # to make this workable on CPU. Unfortunately this will have to do.
-        torchJitLoad = torch.jit.load
-
-        def jitLoadWrapper(*args, **kwargs):
-            kwargs.update(map_location="cpu")
-            return torchJitLoad(*args, **kwargs)
+        if precision is None:
+            precision = getConfig("macePrecision", "float64")
+        if precision not in PRECISION_MODES:
+            logger.warning(
+                f"Unknown MACE precision `{precision}`, using float64 instead"
+            )
+            precision = "float64"
+        self.precision = precision
 
-        torch.jit.load = jitLoadWrapper
+    def construct(self):
+        from mace.calculators.mace import MACECalculator
 
-        self.calculator = MACECalculator(path, "cpu")
-        self.calculator.model.to("cpu").to(torch.double)
-        torch.jit.load = torchJitLoad
+        with cpuJitLoad():
+            self.calculator = MACECalculator(self.path, "cpu")
 
-        dtype = None
+        # the native dtype has to be read before any conversion
         model = self.calculator.model
-
-        for x in model.named_buffers():
-            if x[0].startswith("interactions"):
-                dtype = x[1].dtype
-                break
-
-        if dtype is None:
-            logger.warn(
-                f"MACE model did not find a named buffed starting with `interactions` to determined dtype. Did the versions change? Defaulting to float64"
+        self.nativeDtype = detectDtype(model)
+        self.dtype = self.resolveDtype(self.nativeDtype)
+        self.torchDtype = TORCH_DTYPES[self.dtype]
+        model.to("cpu").to(self.torchDtype)
+
+        self.cutoff = float(self.calculator.r_max)
+
+        # one-hot node attributes, in the order of the model's element table
+        zs = [int(x) for x in self.calculator.z_table.zs]
+        self.zToIndex = {x: i for i, x in enumerate(zs)}
+        self.nElements = len(zs)
+
+    def resolveDtype(self, nativeDtype):
+        if self.precision == "native":
+            return nativeDtype
+        return self.precision
+
+    def initialise(self):
+        super().initialise()
+        if self.precision != "float64":
+            # keeps models loaded at several precisions apart in the sidebar
+            self.setName(f"{self.name} ({self.precision})")
+
+    def getOptions(self):
+        return {"precision": self.precision}
+
+    def getInfo(self):
+        if not self.constructed:
+            return [("Precision", self.precision)]
+
+        return [
+            ("Precision", f"{self.precision} ({self.dtype})"),
+            ("Native dtype", self.nativeDtype),
+            ("Cutoff", f"{self.cutoff:.2f}"),
+            ("N. elements", f"{self.nElements}"),
+        ]
+
+    def getWarmUpElements(self):
+        return np.array(list(self.zToIndex.keys()))
+
+    def predictBatch(self, graph, z):
+        nFrames = len(graph["ptr"]) - 1
+        dtype = self.torchDtype
+
+        def tensor(x, dtype=dtype):
+            return torch.tensor(x, dtype=dtype)
+
+        oneHot = np.eye(self.nElements)[[self.zToIndex[int(x)] for x in z]]
+        data = {
+            "positions": tensor(graph["positions"]),
+            "node_attrs": tensor(np.tile(oneHot, (nFrames, 1))),
+            "edge_index": tensor(graph["edgeIndex"], dtype=torch.long),
+            "shifts": tensor(graph["shifts"]),
+            "unit_shifts": tensor(graph["unitShifts"]),
+            "cell": tensor(graph["cell"].reshape(-1, 3)),
+            "batch": tensor(graph["batch"], dtype=torch.long),
+            "ptr": tensor(graph["ptr"], dtype=torch.long),
+            "head": torch.zeros(nFrames, dtype=torch.long),
+        }
+
+        out = self.calculator.model(data, compute_stress=False, training=False)
+        conv = getattr(self.calculator, "energy_units_to_eV", 1.0)
+        E = out["energy"].detach().cpu().numpy() * conv
+        F = out["forces"].detach().cpu().numpy() * conv
+        F = F / getattr(self.calculator, "length_units_to_A", 1.0)
+
+        return E, F.reshape(nFrames, -1, 3)
+
+    def benchmarkPrecision(self, dataset, nConfigs=100, taskID=None):
+        """
+        Compares float32 and float64 inference of this model on (a spread
+        out subset of) a dataset, using float64 as the reference.
+
+        Args:
+            dataset (DatasetLoader): Dataset to predict.
+            nConfigs (int, optional): Number of configurations. Defaults to
+                100.
+            taskID (optional): Task ID. Defaults to None.
+
+        Returns:
+            dict: Per dtype `time` (s), `rate` (configs/s), `speedup`, `eMAE`,
+                `eMax`, `fMAE` and `fMax` (absolute deltas to float64), or
+                None if cancelled.
+        """
+        import time
+
+        self.ensureConstructed()
+        N = dataset.getN()
+        indices = np.unique(
+            np.linspace(0, N - 1, min(nConfigs, N)).astype(int)
+        )
+
+        results, preds = {}, {}
+        for dtype in ("float64", "float32"):
+            if dtype == self.dtype:
+                model = self
+            else:
+                model = MACEModelLoader(self.env, self.path, precision=dtype)
+                model.ensureConstructed()
+
+            t0 = time.perf_counter()
+            res = model.predict(dataset, indices=indices, taskID=taskID)
+            dt = time.perf_counter() - t0
+            if res is None:
+                return None
+
+            preds[dtype] = np.asarray(res[0]).flatten(), np.asarray(res[1])
+            results[dtype] = {"time": dt, "rate": len(indices) / max(dt, 1e-9)}
+
+        E64, F64 = preds["float64"]
+        for dtype, (E, F) in preds.items():
+            dE, dF = np.abs(E - E64), np.abs(F - F64)
+            results[dtype].update(
+                speedup=results["float64"]["time"] / results[dtype]["time"],
+                eMAE=dE.mean(),
+                eMax=dE.max(),
+                fMAE=dF.mean(),
+                fMax=dF.max(),
             )
-            dtype = torch.float64
 
-        if dtype == torch.float64:
-            self.dtype = "float64"
-        elif dtype == torch.float32:
-            self.dtype = "float32"
+        r = results["float32"]
+        logger.info(
+            f"MACE precision benchmark of {self.name} on {dataset.getName()} "
+            f"({len(indices)} configs): float32 {r['rate']:.1f} configs/s vs "
+            f"float64 {results['float64']['rate']:.1f} configs/s "
+            f"(x{r['speedup']:.2f}), energy MAE {r['eMAE']:.2e} "
+            f"(max {r['eMax']:.2e}), forces MAE {r['fMAE']:.2e} "
+            f"(max {r['fMax']:.2e})"
+        )
+        return results
 
     def getFingerprint(self):
         from utils import md5FromArraysAndStrings
 
-        # NOTE: This is *terrible* practice but the only way I have found
-        # to make this workable on CPU. Unfortunately this will have to do.
-        torchJitLoad = torch.jit.load
-
-        def jitLoadWrapper(*args, **kwargs):
-            kwargs.update(map_location="cpu")
-            return torchJitLoad(*args, **kwargs)
-
-        torch.jit.load = jitLoadWrapper
-
-        model = torch.load(self.path, map_location="cpu")
-        torch.jit.load = torchJitLoad
+        with cpuJitLoad():
+            model = torch.load(self.path, map_location="cpu")
 
         lst = []
         for child in model.children():
@@ -71,6 +218,12 @@ class MACEModelLoader(ModelLoaderACE):
                 lst.append(param.detach().cpu().numpy())
 
         fp = md5FromArraysAndStrings(*lst)
+
+        # predictions at different precisions must not share a cache entry,
+        # float64 keeps the plain fingerprint as it used to be the only mode
+        dtype = self.resolveDtype(detectDtype(model))
+        if dtype != "float64":
+            fp = md5FromArraysAndStrings(fp, dtype)
         return fp
 
 
@@ -13,10 +13,51 @@ class NequipModelLoader(ModelLoaderACE):
         super().__init__(env, path)
         self.path = path
 
+    def construct(self):
         from nequip.ase.nequip_calculator import nequip_calculator
 
-        calc = nequip_calculator(path)
+        calc = nequip_calculator(self.path)
         self.calculator = calc
+        self.cutoff = float(calc.r_max)
+
+    def getWarmUpElements(self):
+        from ase.data import atomic_numbers
+
+        types = self.calculator.transform.chemical_symbol_to_type
+        return np.array([atomic_numbers[x] for x in types])
+
+    def predictBatch(self, graph, z):
+        nFrames = len(graph["ptr"]) - 1
+        dtype = torch.get_default_dtype()
+        calc = self.calculator
+
+        data = {
+            "pos": torch.tensor(graph["positions"], dtype=dtype),
+            "edge_index": torch.tensor(graph["edgeIndex"], dtype=torch.long),
+            "atomic_numbers": torch.tensor(
+                np.tile(z, nFrames), dtype=torch.long
+            ),
+            "batch": torch.tensor(graph["batch"], dtype=torch.long),
+            "ptr": torch.tensor(graph["ptr"], dtype=torch.long),
+        }
+
+        if graph["periodic"]:
+            data["cell"] = torch.tensor(graph["cell"], dtype=dtype)
+            data["edge_cell_shift"] = torch.tensor(
+                graph["unitShifts"], dtype=dtype
+            )
+            data["pbc"] = torch.ones((nFrames, 3), dtype=torch.bool)
+
+        # maps atomic numbers to the model's atom types
+        data = calc.transform(data)
+        out = calc.model(data)
+
+        conv = calc.energy_units_to_eV
+        E = out["total_energy"].detach().cpu().numpy().flatten() * conv
+        F = out["forces"].detach().cpu().numpy() * conv
+        F = F / calc.length_units_to_A
+
+        return E, F.reshape(nFrames, -1, 3)
 
     def getFingerprint(self):
         from utils import md5FromArraysAndStrings
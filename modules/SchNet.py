@@ -1,8 +1,61 @@
-from loaders.modelLoader import ModelLoader
+from loaders.modelLoader import ModelLoader, torchInference
 import numpy as np
 from utils import md5FromArraysAndStrings
 
 
+class SchNetBatcher:
+    """
+    In-memory replacement for schnetpack's AtomsData/AtomsLoader pair.
+    Items are configuration indices, batches are assembled directly from the
+    coordinate array in `collate`, including the (all-pairs) neighbour
+    lists that the default SimpleEnvironmentProvider would have built.
+    """
+
+    def __init__(self, R, z):
+        from ase.data import atomic_masses
+
+        self.R = R
+        self.z = np.asarray(z)
+        self.nAtoms = len(self.z)
+
+        # AtomsData centres configurations on the center of mass by default
+        masses = atomic_masses[self.z]
+        self.weights = masses / masses.sum()
+
+        # every other atom is a neighbour, row i skips atom i
+        allPairs = np.tile(np.arange(self.nAtoms), (self.nAtoms, 1))
+        self.neighbours = allPairs[~np.eye(self.nAtoms, dtype=bool)].reshape(
+            self.nAtoms, self.nAtoms - 1
+        )
+
+    def __len__(self):
+        return len(self.R)
+
+    def __getitem__(self, i):
+        return i
+
+    def collate(self, idx):
+        import torch
+        from schnetpack import Properties
+
+        idx = np.asarray(idx)
+        B, nA = len(idx), self.nAtoms
+        r = self.R[idx]
+        r = r - np.einsum("a,bak->bk", self.weights, r)[:, None, :]
+        nbh = np.broadcast_to(self.neighbours, (B, nA, nA - 1))
+
+        return {
+            Properties.Z: torch.LongTensor(np.tile(self.z, (B, 1))),
+            Properties.R: torch.FloatTensor(r.astype(np.float32)),
+            Properties.cell: torch.zeros((B, 3, 3)),
+            Properties.cell_offset: torch.zeros((B, nA, nA - 1, 3)),
+            Properties.neighbors: torch.LongTensor(np.ascontiguousarray(nbh)),
+            Properties.neighbor_mask: torch.ones((B, nA, nA - 1)),
+            Properties.atom_mask: torch.ones((B, nA)),
+            "_idx": torch.LongTensor(idx.reshape(-1, 1)),
+        }
+
+
 class SchNetModelLoader(ModelLoader):
     """
     ModelLoader subclass specific to sGDML models.
@@ -12,6 +65,7 @@ class SchNetModelLoader(ModelLoader):
     # when False, it's separate
     singlePredict = True
     modelName = "SchNet"
+    usesTorch = True
 
     def __init__(self, env, path, *args, **kwargs):
         """
@@ -23,15 +77,23 @@ class SchNetModelLoader(ModelLoader):
         """
         super().__init__(env, path, *args, **kwargs)
 
+    def construct(self):
         import torch
         import schnetpack
 
-        self.model = torch.load(path, map_location=torch.device("cpu"))
+        self.model = torch.load(self.path, map_location=torch.device("cpu"))
         self.model.requires_stress = False
         for name, mod in self.model.named_modules():
             if isinstance(mod, schnetpack.atomistic.output_modules.Atomwise):
                 mod.stress = None
 
+    def getTorchModule(self):
+        return self.model
+
+    def setTorchModule(self, module):
+        self.model = module
+
+    @torchInference
     def predict(self, dataset, indices=None, batchSize=50, taskID=None):
         """
         Prediction function for energies and forces using the loaded sGDML
@@ -48,12 +110,7 @@ class SchNetModelLoader(ModelLoader):
             F (array): NxMx3 array containing calculated forces.
         """
 
-        import schnetpack, os
-
-        # import schnetpack.transform as trn
-        # see https://schnetpack.readthedocs.io/en/dev/tutorials/tutorial_03_force_models.html#Using-the-model
-        # except it doesnt work :)
-        from ase import Atoms
+        import torch
 
         if indices is None:
             R = dataset.getCoordinates()
@@ -62,25 +119,10 @@ class SchNetModelLoader(ModelLoader):
         z = dataset.getElements()
 
         E, F = [], []
-        molecules, props = ([], [])
-        for i in range(len(R)):
-            r = R[i]
-            atoms = Atoms(numbers=z, positions=r)
-            molecules.append(atoms)
-            props.append({"energy": 0, "forces": np.zeros(r.shape)})
-
-        path = os.path.join(
-            "temp", f"{self.fingerprint}_{dataset.fingerprint}.db"
-        )
-        if os.path.exists(path):
-            os.remove(path)
-        d = schnetpack.AtomsData(
-            path, available_properties=["energy", "forces"]
+        batcher = SchNetBatcher(R, z)
+        loader = torch.utils.data.DataLoader(
+            batcher, batch_size=batchSize, collate_fn=batcher.collate
         )
-        d.add_systems(molecules, props)
-
-        # molecules = schnetpack.AtomsData(molecules)
-        loader = schnetpack.AtomsLoader(d, batch_size=10)
         for count, batch in enumerate(loader):
             results = self.model(batch)
             e = results["energy"].detach().cpu().numpy()
@@ -115,8 +157,13 @@ class SchNetModelLoader(ModelLoader):
             s (str): Unique fingerprint
         """
 
+        import torch
+
         # TODO: not unique enough, thats just architecture!!
-        fp = md5FromArraysAndStrings(str(self.model))
+        # read separately, constructing would warm the model up (and may
+        # freeze it, changing its string)
+        model = torch.load(self.path, map_location=torch.device("cpu"))
+        fp = md5FromArraysAndStrings(str(model))
 
         return fp
 
@@ -1,102 +1,134 @@
-from loaders.modelLoader import ModelLoader
+from loaders.modelLoader import ModelLoader, torchInference
 import torch
 import numpy as np
+import queue
+import threading
+from client.neighbours import neighbourList, latticeToMatrix
 
 
 class SpookyNetBatcher:
-    def __init__(self, R, z, batchSize=50, cutoff=5):
+    """
+    Assembles SpookyNet input batches, including neighbour lists, lazily
+    per batch. Batches are built on a background thread, `prefetch`
+    batches ahead, so that assembly overlaps with model evaluation.
+    """
+
+    def __init__(self, R, z, batchSize=50, cutoff=5, lattice=None, prefetch=2):
         self.cutoff = cutoff
 
         N, nAtoms, _ = R.shape
         self.R = R
         self.Q = np.zeros(N)  # Charges, currently not really used
         self.S = np.zeros(N)  # Spin, idem
-        z = np.repeat(z.reshape(1, -1), N, axis=0)
-        self.z = torch.tensor(z, dtype=torch.int64, device="cpu")
+        self.z = np.asarray(z, dtype=np.int64).reshape(-1)
         self.batchSize = batchSize
-        self.nBatches = N // self.batchSize + 1
+        self.nBatches = -(-N // self.batchSize)
         self.nAtoms = nAtoms
+        self.prefetch = prefetch
 
-        self.constructNeightboursList()
+        if latticeToMatrix(lattice) is None:
+            self.lattice = None
+        else:
+            self.lattice = np.asarray(lattice, dtype=float).reshape(3, 3)
 
-    def constructNeightboursList(self):
+    def makeBatch(self, idx):
         # idx_i and idx_j
         # Why do they need to be given as args? Who the fuck knows
-        N, nA, _ = self.R.shape
-        cutoff = self.cutoff
-
-        nidx_i, nidx_j, segs = [], [], []
-        for i in range(N):
-            i_batch = i % self.batchSize
-            na_total_batch = i_batch * nA
+        nA = self.nAtoms
+        r = self.R[idx]
 
-            r = self.R[i]
-            aidx_i, aidx_j = [], []
-
-            for ai in range(nA):
-                for aj in range(nA):
-                    if ai == aj:
-                        continue
-                    d = np.linalg.norm(r[ai] - r[aj])
-                    if d < cutoff:
-                        aidx_i.append(int(ai + na_total_batch))
-                        aidx_j.append(int(aj + na_total_batch))
+        frameIdx, idxI, idxJ, offsets = neighbourList(
+            r, self.cutoff, lattice=self.lattice
+        )
 
-            nidx_i.append(aidx_i)
-            nidx_j.append(aidx_j)
+        # indices are relative to the batch
+        batchShift = frameIdx * nA
 
-            segs.append([i_batch] * nA)
+        R = torch.tensor(
+            r, dtype=torch.float32, device="cpu", requires_grad=True
+        )
+        Q = torch.tensor(self.Q[idx], dtype=torch.float32, device="cpu")
+        S = torch.tensor(self.S[idx], dtype=torch.float32, device="cpu")
+        nidx_i = torch.tensor(idxI + batchShift, dtype=torch.int64)
+        nidx_j = torch.tensor(idxJ + batchShift, dtype=torch.int64)
+        segs = torch.tensor(np.repeat(np.arange(len(idx)), nA))
+        Z = torch.tensor(np.tile(self.z, len(idx)), dtype=torch.int64)
+
+        batch = {
+            "R": R.reshape(-1, 3),
+            "Z": Z,
+            "Q": Q.view(-1),
+            "S": S.view(-1),
+            "idx_i": nidx_i,
+            "idx_j": nidx_j,
+            "batch_seg": segs,
+            "num_batch": len(idx),
+        }
+
+        if self.lattice is not None:
+            cell = np.repeat(self.lattice[None], len(idx), axis=0)
+            batch["cell"] = torch.tensor(
+                cell, dtype=torch.float32, device="cpu"
+            )
+            batch["cell_offsets"] = torch.tensor(
+                offsets, dtype=torch.float32, device="cpu"
+            )
 
-        self.nidx_i = nidx_i
-        self.nidx_j = nidx_j
-        self.segs = np.array(segs)
+        return batch
 
     def batches(self, dump=False):
         N = self.R.shape[0]
-        nBatches = self.nBatches
-        if N % self.batchSize == 0:
-            nBatches -= 1
+        if N == 0:
+            return
 
         indices = np.arange(N)
-        batchSize = self.batchSize
         if dump:
-            nBatches = 1
-            batchSize = self.R.shape[0]
-
-        for i in range(nBatches):
-            if i == N - 1:
-                idx = indices[i * batchSize :]
-            else:
-                idx = indices[i * batchSize : (i + 1) * batchSize]
-
-            R = torch.tensor(
-                self.R[idx],
-                dtype=torch.float32,
-                device="cpu",
-                requires_grad=True,
-            )
-            Q = torch.tensor(self.Q[idx], dtype=torch.float32, device="cpu")
-            S = torch.tensor(self.S[idx], dtype=torch.float32, device="cpu")
-            nidx_i = np.concatenate([self.nidx_i[x] for x in idx])
-            nidx_j = np.concatenate([self.nidx_j[x] for x in idx])
-            nidx_i = torch.tensor(nidx_i, dtype=torch.int64, device="cpu")
-            nidx_j = torch.tensor(nidx_j, dtype=torch.int64, device="cpu")
-
-            segs = torch.tensor(
-                self.segs[idx], dtype=torch.int64, device="cpu"
-            )
-            Z = self.z[idx]
-
-            yield {
-                "R": R.reshape(-1, 3),
-                "Z": Z.view(-1),
-                "Q": Q.view(-1),
-                "S": S.view(-1),
-                "idx_i": nidx_i.view(-1),
-                "idx_j": nidx_j.view(-1),
-                "batch_seg": segs.view(-1),
-                "num_batch": len(idx),
-            }, idx
+            chunks = [indices]
+        else:
+            bs = self.batchSize
+            chunks = [indices[i : i + bs] for i in range(0, N, bs)]
+
+        if self.prefetch <= 0:
+            for idx in chunks:
+                yield self.makeBatch(idx), idx
+            return
+
+        q = queue.Queue(maxsize=self.prefetch)
+        stop = threading.Event()
+
+        def put(item):
+            # gives up once the consumer stopped, it may never empty the queue
+            while not stop.is_set():
+                try:
+                    q.put(item, timeout=0.1)
+                    return True
+                except queue.Full:
+                    continue
+            return False
+
+        def produce():
+            try:
+                for idx in chunks:
+                    if not put((self.makeBatch(idx), idx)):
+                        return
+            except Exception as e:
+                put(e)
+                return
+            put(None)
+
+        thread = threading.Thread(target=produce, daemon=True)
+        thread.start()
+        try:
+            while True:
+                item = q.get()
+                if item is None:
+                    return
+                if isinstance(item, Exception):
+                    raise item
+                yield item
+        finally:
+            # consumer stopped early (e.g. task cancelled)
+            stop.set()
 
     def all(self):
         return next(self.batches(dump=True))
@@ -105,35 +137,59 @@ class SpookyNetBatcher:
 class SpookyNetModelLoader(ModelLoader):
     singlePredict = True
     modelName = "SpookyNet"
+    usesTorch = True
 
     def __init__(self, env, path):
         super().__init__(env, path)
-        self.data = torch.load(path, map_location="cpu")
+
+    def construct(self):
+        self.data = torch.load(self.path, map_location="cpu")
         self.cutoff = self.data["cutoff"]
 
         from spookynet.spookynet import SpookyNet
 
-        self.model = SpookyNet(load_from=path).to(torch.float32).to("cpu")
+        self.model = SpookyNet(load_from=self.path).to(torch.float32).to("cpu")
         self.model.eval()
 
     def getFingerprint(self):
         from utils import md5FromArraysAndStrings
 
+        # hashed from the saved tensors, building the model just for this
+        # would construct it twice on a cold load
+        data = torch.load(self.path, map_location="cpu")
+        state = data.get("state_dict", data)
         lst = []
-        for child in self.model.children():
-            for param in child.parameters():
-                lst.append(param.detach().numpy())
+        for name in sorted(state):
+            if torch.is_tensor(state[name]):
+                lst.append(name)
+                lst.append(state[name].to(torch.float32).numpy())
 
         fp = md5FromArraysAndStrings(*lst)
         return fp
 
+    def getFingerprintCacheKey(self):
+        # cached fingerprints of the constructed model (before they were
+        # hashed from the file) must not be reused
+        return f"{super().getFingerprintCacheKey()}:stateDict"
+
+    def getTorchModule(self):
+        return self.model
+
+    def setTorchModule(self, module):
+        self.model = module
+
+    @torchInference
     def predict(self, dataset, indices=None, batchSize=50, taskID=None):
         R = dataset.getCoordinates()
         if indices is not None:
             R = R[indices]
 
         batcher = SpookyNetBatcher(
-            R, dataset.getElements(), batchSize=batchSize, cutoff=self.cutoff
+            R,
+            dataset.getElements(),
+            batchSize=batchSize,
+            cutoff=self.cutoff,
+            lattice=dataset.getLattice(),
         )
 
         E, F, i = [], [], 0
@@ -1,13 +1,22 @@
 import numpy as np
-from loaders.datasetLoader import DatasetLoader
+from loaders.datasetLoader import (
+    DatasetLoader,
+    chunkIndices,
+    reportChunkProgress,
+)
 import ase.io
 from collections.abc import Iterable
+import logging
+import os
+
+logger = logging.getLogger("FFAST")
 
 
 class aseDatasetLoader(DatasetLoader):
     datasetName = "ase"
     datasetFileExtension = "*"
     saveFormats = ["db", "xyz", "extxyz", "traj", "vasp", "dftb"]
+    followable = True
 
     def __init__(self, path, *args, **kwargs):
         super().__init__(path)
@@ -29,6 +38,31 @@ class aseDatasetLoader(DatasetLoader):
     def getN(self):
         return self.N
 
+    def readNewFrames(self):
+        try:
+            newAtoms = ase.io.read(self.path, index=f"{self.N}:")
+        except Exception as e:
+            # the simulation may be halfway through writing a frame, the
+            # next check will pick it up
+            logger.debug(f"Could not read new frames of `{self.path}`: {e}")
+            return 0
+
+        nNew = len(newAtoms)
+        if nNew == 0:
+            return 0
+
+        if any(len(atoms) != self.nAtoms for atoms in newAtoms):
+            logger.error(
+                f"New frames of followed dataset `{self.path}` do not match its number of atoms, ignoring them"
+            )
+            return 0
+
+        self.atomsList.extend(newAtoms)
+        self.N = len(self.atomsList)
+        self.generation += 1
+
+        return nNew
+
     def getNAtoms(self):
         return self.nAtoms
 
@@ -81,26 +115,71 @@ class aseDatasetLoader(DatasetLoader):
         return None
 
     @staticmethod
-    def saveDataset(dataset, path, format=None, taskID=None):
+    def saveDataset(
+        dataset, path, format=None, taskID=None, env=None, chunkSize=None
+    ):
         from ase import Atoms
-        from ase.calculators.calculator import Calculator
-
-        R, F = dataset.getCoordinates(), dataset.getForces()
-        E, zStr = dataset.getEnergies(), dataset.getElementsName()
-
-        atoms = []
-
-        class FakeCalc(Calculator):
-            def __init__(self):
-                pass
-
-        for i in range(R.shape[0]):
-            atom = Atoms(positions=R[i], symbols=zStr)
-            atom.calc = FakeCalc()
-            atom.calc.results = {"forces": F[i], "energy": E[i]}
-            atoms.append(atom)
-
-        ase.io.write(path, atoms, format=format)
+        from ase.calculators.singlepoint import SinglePointCalculator
+        from ase.io.formats import ioformats
+
+        N, zStr = dataset.getN(), dataset.getElementsName()
+        io = ioformats.get(format, None)
+
+        if (io is not None) and io.single and (N > 1):
+            logger.error(
+                f"Tried saving {N} configurations as `{format}`, but the format only supports a single configuration"
+            )
+            return
+
+        chunks = list(chunkIndices(N, chunkSize))
+
+        def chunkAtoms(idx):
+            R = dataset.getCoordinates(indices=idx)
+            E = dataset.getEnergies(indices=idx)
+            F = dataset.getForces(indices=idx)
+
+            for i in range(len(idx)):
+                atom = Atoms(positions=R[i], symbols=zStr)
+                atom.calc = SinglePointCalculator(
+                    atom, forces=F[i], energy=E[i]
+                )
+                yield atom
+
+        # formats differ in how they can be written incrementally: trajectories
+        # have their own writer, text formats (xyz) are concatenated into one
+        # open file and the rest (db, single-config formats) go by path
+        writer = None
+        if format == "traj":
+            writer = ase.io.Trajectory(path, "w")
+        elif (io is not None) and io.acceptsfd and not io.can_append:
+            writer = open(path, "w")
+
+        def writeChunk(atoms, i):
+            if format == "traj":
+                for a in atoms:
+                    writer.write(a)
+            elif writer is not None:
+                ase.io.write(writer, list(atoms), format=format)
+            else:
+                ase.io.write(path, list(atoms), format=format, append=i > 0)
+
+        cancelled = False
+        try:
+            for i, idx in enumerate(chunks):
+                writeChunk(chunkAtoms(idx), i)
+
+                if not reportChunkProgress(
+                    env, taskID, i + 1, len(chunks), f"Saving {format} dataset"
+                ):
+                    cancelled = True
+                    break
+        finally:
+            if writer is not None:
+                writer.close()
+
+        if cancelled:
+            logger.info(f"Saving dataset at `{path}` cancelled")
+            os.remove(path)
 
 
 def loadData(env):
@@ -17,6 +17,7 @@ def loadData(env):
         dependencies = ["energy"]
         iterable = True
         atomConstant = True
+        extendable = True
 
         def __init__(self, *args):
             super().__init__(*args)
@@ -33,6 +34,19 @@ def loadData(env):
             env.setData(de, self.key, model=model, dataset=dataset)
             return True
 
+        def extendData(
+            self, dataset=None, model=None, indices=None, taskID=None
+        ):
+            env = self.env
+
+            ePred = env.getData("energy", model=model, dataset=dataset)
+            eData = dataset.getEnergies(indices=indices)
+
+            diff = ePred.get("energy")[indices] - eData
+            de = env.getData(self.key, model=model, dataset=dataset)
+            de.extend(diff=diff)
+            return True
+
     class ForcesPredictionError(DataType):
         modelDependent = True
         datasetDependent = True
@@ -40,6 +54,7 @@ def loadData(env):
         dependencies = ["forces"]
         iterable = True
         atomFilterable = True
+        extendable = True
 
         def __init__(self, *args):
             super().__init__(*args)
@@ -61,6 +76,19 @@ def loadData(env):
             env.setData(de, self.key, model=model, dataset=dataset)
             return True
 
+        def extendData(
+            self, dataset=None, model=None, indices=None, taskID=None
+        ):
+            env = self.env
+
+            fPred = env.getData("forces", model=model, dataset=dataset)
+            fData = dataset.getForces(indices=indices)
+
+            diff = fPred.get("forces")[indices] - fData
+            de = env.getData(self.key, model=model, dataset=dataset)
+            de.extend(diff=diff)
+            return True
+
     class EnergyErrorDist(DataType):
         modelDependent = True
         datasetDependent = True
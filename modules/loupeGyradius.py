@@ -14,14 +14,13 @@ class GyrationRadius(DataType):
     key = "gyradius"
     dependencies = []
     iterable = True
+    extendable = True
 
     def __init__(self, *args):
         super().__init__(*args)
 
-    def data(self, dataset=None, model=None, taskID=None):
-        env = self.env
-
-        R = dataset.getCoordinates()  # (N, nA, 3)
+    def gyradius(self, dataset, indices=None):
+        R = dataset.getCoordinates(indices=indices)  # (N, nA, 3)
         com = np.mean(R, axis=1)  # (N, 3)
 
         diff = R - com.reshape(-1, 1, 3)  # (N, nA, 3)
@@ -30,12 +29,22 @@ class GyrationRadius(DataType):
 
         z = dataset.getElements()
 
-        gyradius = np.sqrt(np.sum(z * s ** 2, axis=1) / np.sum(z))
+        return np.sqrt(np.sum(z * s ** 2, axis=1) / np.sum(z))
+
+    def data(self, dataset=None, model=None, taskID=None):
+        env = self.env
+
+        gyradius = self.gyradius(dataset)
 
         de = self.newDataEntity(gyradius=gyradius)  # , mae=mae)
         env.setData(de, self.key, model=model, dataset=dataset)
         return True
 
+    def extendData(self, dataset=None, model=None, indices=None, taskID=None):
+        de = self.env.getData(self.key, model=model, dataset=dataset)
+        de.extend(gyradius=self.gyradius(dataset, indices=indices))
+        return True
+
 
 class GyrationDistribution(DataType):
     modelDependent = False
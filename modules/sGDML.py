@@ -1,7 +1,67 @@
 from loaders.modelLoader import ModelLoader
 import numpy as np
-from utils import md5FromArraysAndStrings
-from loaders.datasetLoader import DatasetLoader
+from utils import md5FromArraysAndStrings, combineMD5
+from loaders.datasetLoader import (
+    DatasetLoader,
+    chunkIndices,
+    reportChunkProgress,
+)
+from config.userConfig import getConfig
+import hashlib
+import logging
+import os
+import zipfile
+
+logger = logging.getLogger("FFAST")
+
+# model fingerprint -> (num. workers, chunk size) found by prepare_parallel
+tunedParallel = {}
+
+# number of geometries per predict call the parallel setup is tuned for
+PARALLEL_TUNING_BULK = 50
+
+
+def writeNpzEntry(zf, key, arr):
+    with zf.open(f"{key}.npy", mode="w", force_zip64=True) as f:
+        np.lib.format.write_array(f, np.asanyarray(arr), allow_pickle=True)
+
+
+def streamNpzEntry(zf, key, getter, N, chunks, progress):
+    """
+    Writes a (N, ...) array into an npz archive chunk by chunk, without ever
+    holding the full array in memory.
+
+    Args:
+        zf (ZipFile): Archive opened for writing.
+        key (str): Array name in the npz.
+        getter (func): Dataset getter accepting an `indices` kwarg.
+        N (int): Total number of configurations.
+        chunks (list): Index arrays, see chunkIndices.
+        progress (func): Called after every chunk, returns False to cancel.
+
+    Returns:
+        md5 (hashlib md5 object) of the raw array data, or None if cancelled.
+    """
+    example = np.asarray(getter(indices=np.arange(min(1, N))))
+    header = {
+        "descr": np.lib.format.dtype_to_descr(example.dtype),
+        "fortran_order": False,
+        "shape": (N,) + example.shape[1:],
+    }
+
+    md5 = hashlib.md5()
+    with zf.open(f"{key}.npy", mode="w", force_zip64=True) as f:
+        np.lib.format.write_array_header_1_0(f, header)
+
+        for idx in chunks:
+            arr = np.ascontiguousarray(getter(indices=idx), dtype=example.dtype)
+            f.write(arr.data)
+            md5.update(arr.data)
+
+            if not progress(key):
+                return None
+
+    return md5
 
 
 class sGDMLModelLoader(ModelLoader):
@@ -25,12 +85,66 @@ class sGDMLModelLoader(ModelLoader):
         """
         super().__init__(env, path, *args, **kwargs)
 
+        # arrays are only read from the npz when accessed
+        self.modelInfo = np.load(path, allow_pickle=True)
+
+    def construct(self):
         from sgdml.predict import GDMLPredict
 
-        model = np.load(path, allow_pickle=True)
-        self.modelInfo = model
-        self.fpArrays = (model["perms"], model["R_d_desc_alpha"])
-        self.model = GDMLPredict(model)
+        workers = getConfig("sgdmlWorkers", None)
+        chunkSize = getConfig("sgdmlChunkSize", None)
+        self.model = GDMLPredict(self.modelInfo, num_workers=workers)
+
+        if (workers is None) and (chunkSize is None):
+            self.tuneParallel()
+        elif chunkSize is not None:
+            self.setParallel(chunkSize=chunkSize)
+
+    def setParallel(self, workers=None, chunkSize=None):
+        """
+        Sets the number of worker processes and/or the chunk size (training
+        points per worker task) of the predictor's parallel path.
+        """
+        if workers is not None:
+            self.model.set_num_workers(workers)
+        if chunkSize is not None:
+            # renamed from set_batch_size in later sGDML versions
+            if hasattr(self.model, "set_chunk_size"):
+                self.model.set_chunk_size(chunkSize)
+            else:
+                self.model.set_batch_size(chunkSize)
+
+    def getParallel(self):
+        workers = getattr(self.model, "num_workers", None)
+        chunkSize = getattr(self.model, "chunk_size", None)
+        if chunkSize is None:
+            chunkSize = getattr(self.model, "_chunk_size", None)
+        return workers, chunkSize
+
+    def tuneParallel(self):
+        """
+        Benchmarks worker counts and chunk sizes with the predictor's own
+        prepare_parallel, once per model (and session).
+        """
+        if self.fingerprint in tunedParallel:
+            self.setParallel(*tunedParallel[self.fingerprint])
+            return
+
+        try:
+            self.model.prepare_parallel(n_bulk=PARALLEL_TUNING_BULK)
+        except Exception as e:
+            logger.warning(
+                f"sGDML parallel tuning failed, using defaults: {e}"
+            )
+            return
+
+        workers, chunkSize = self.getParallel()
+        if self.fingerprint is not None:
+            tunedParallel[self.fingerprint] = (workers, chunkSize)
+        logger.info(
+            f"Tuned sGDML model {self.name}: {workers} workers, "
+            f"chunk size {chunkSize}"
+        )
 
     def predict(self, dataset, indices=None, batchSize=50, taskID=None):
         """
@@ -47,22 +161,21 @@ class sGDMLModelLoader(ModelLoader):
             E (array): Nx1 array containing calculated energies.
             F (array): NxMx3 array containing calculated forces.
         """
+        self.ensureConstructed()
 
         if indices is None:
             R = dataset.getCoordinates()
         else:
             R = dataset.getCoordinates(indices=indices)
 
-        E, F = [], []
-        nBatches = len(R) // batchSize + 1
-        rBatches = np.array_split(R, nBatches)
-        nBatches = len(rBatches)
+        N = len(R)
+        R = R.reshape((N, -1))
+        E, F = np.empty(N), np.empty(R.shape)
+        nBatches = int(np.ceil(N / batchSize))
 
         for i in range(nBatches):
-            r = rBatches[i]
-            (e, f) = self.model.predict(r.reshape((r.shape[0], -1)))
-            E.append(e)
-            F.append(f)
+            s = slice(i * batchSize, min((i + 1) * batchSize, N))
+            E[s], F[s] = self.model.predict(R[s])
 
             if taskID is not None:
                 self.eventPush(
@@ -78,9 +191,7 @@ class sGDMLModelLoader(ModelLoader):
                 if not self.env.tm.isTaskRunning(taskID):
                     return None
 
-        E, F = np.concatenate(E), np.concatenate(F)
-
-        return E, F.reshape(F.shape[0], -1, 3)
+        return E, F.reshape(N, -1, 3)
 
     def getFingerprint(self):
         """
@@ -91,7 +202,8 @@ class sGDMLModelLoader(ModelLoader):
             s (str): Unique fingerprint
         """
 
-        fp = md5FromArraysAndStrings(*self.fpArrays)
+        model = self.modelInfo
+        fp = md5FromArraysAndStrings(model["perms"], model["R_d_desc_alpha"])
 
         return fp
 
@@ -99,15 +211,40 @@ class sGDMLModelLoader(ModelLoader):
         return [
             ("N. perms", f"{len(self.modelInfo['perms'])}"),
             ("Sigma", f"{self.modelInfo['sig']}"),
-            ("N. atoms", f"{self.model.n_atoms}"),
+            ("N. atoms", f"{len(self.modelInfo['z'])}"),
             ("N. train", f"{len(self.modelInfo['idxs_train'])}"),
             ("Code ver.", f"{self.modelInfo['code_version']}"),
-        ]
+        ] + self.getParallelInfo()
+
+    def getParallelInfo(self):
+        if not self.constructed:
+            return []
+
+        workers, chunkSize = self.getParallel()
+        return [("Workers", f"{workers}"), ("Chunk size", f"{chunkSize}")]
+
+
+def readLattice(lattice):
+    """
+    sGDML files store lattice vectors as columns (sgdml writes `cell.T`),
+    FFAST uses rows (see neighbours.latticeToMatrix). Missing lattices are
+    written as `array(None)`, e.g. by saveDataset.
+
+    Returns:
+        3x3 array with lattice vectors as rows, or None.
+    """
+    if lattice is None:
+        return None
+    lattice = np.asarray(lattice)
+    if lattice.size != 9:
+        return None
+    return lattice.astype(float).reshape(3, 3).T
 
 
 class sGDMLDatasetLoader(DatasetLoader):
     datasetName = "sGDML"
     datasetFileExtension = "*.npz"
+    followable = True
 
     def __init__(self, path, *args, **kwargs):
         super().__init__(path)
@@ -123,14 +260,38 @@ class sGDMLDatasetLoader(DatasetLoader):
         self.N = self.R.shape[0]
         self.nAtoms = self.R.shape[1]
 
-        if "lattice" in data:
-            self.lattice = data["lattice"]
-        else:
-            self.lattice = None
+        self.lattice = readLattice(data.get("lattice", None))
 
     def getN(self):
         return self.N
 
+    def readNewFrames(self):
+        # npz files cannot be appended to, so growing ones get rewritten as a
+        # whole. Only accepted if the already loaded frames are unchanged
+        try:
+            data = np.load(self.path, allow_pickle=True)
+            data = {key.lower(): value for key, value in data.items()}
+        except Exception as e:
+            logger.debug(f"Could not read new frames of `{self.path}`: {e}")
+            return 0
+
+        N = self.N
+        R, E, F = data["r"], data["e"], data["f"]
+        if (len(R) <= N) or (R.shape[1:] != self.R.shape[1:]):
+            return 0
+
+        if not np.array_equal(R[:N], self.R):
+            logger.error(
+                f"Followed dataset `{self.path}` changed its existing configurations, ignoring new frames. Reload it instead."
+            )
+            return 0
+
+        self.R, self.E, self.F = R, E, F
+        self.N = self.R.shape[0]
+        self.generation += 1
+
+        return self.N - N
+
     def getNAtoms(self):
         return self.nAtoms
 
@@ -162,20 +323,53 @@ class sGDMLDatasetLoader(DatasetLoader):
         return self.lattice
 
     @staticmethod
-    def saveDataset(dataset, path, format=None, taskID=None):
-        data = {
-            "R": dataset.getCoordinates(),
-            "E": dataset.getEnergies(),
-            "F": dataset.getForces(),
-            "z": dataset.getElements(),
-            "lattice": dataset.getLattice(),  # not yet used at all
-            "name": path,
-        }
-
-        md5 = md5FromArraysAndStrings(data["R"], data["E"], data["F"])
-        data["md5"] = md5
-
-        np.savez_compressed(path, **data)
+    def saveDataset(
+        dataset, path, format=None, taskID=None, env=None, chunkSize=None
+    ):
+        # same naming behaviour as np.savez_compressed
+        if not path.endswith(".npz"):
+            path = f"{path}.npz"
+
+        N = dataset.getN()
+        chunks = list(chunkIndices(N, chunkSize))
+        getters = [
+            ("R", dataset.getCoordinates),
+            ("E", dataset.getEnergies),
+            ("F", dataset.getForces),
+        ]
+        progMax = len(getters) * len(chunks)
+        prog = 0
+
+        def progress(key):
+            nonlocal prog
+            prog += 1
+            return reportChunkProgress(
+                env, taskID, prog, progMax, f"Saving {key} of sGDML dataset"
+            )
+
+        hashes = []
+        with zipfile.ZipFile(
+            path, mode="w", compression=zipfile.ZIP_DEFLATED, allowZip64=True
+        ) as zf:
+            for key, getter in getters:
+                md5 = streamNpzEntry(zf, key, getter, N, chunks, progress)
+                if md5 is None:
+                    break
+                hashes.append(md5)
+
+            if len(hashes) == len(getters):
+                writeNpzEntry(zf, "z", dataset.getElements())
+                lattice = dataset.getLattice()
+                if lattice is not None:
+                    # back to sGDML's columns, see readLattice
+                    lattice = np.asarray(lattice).T
+                writeNpzEntry(zf, "lattice", lattice)
+                writeNpzEntry(zf, "name", path)
+                writeNpzEntry(zf, "md5", combineMD5(*hashes))
+
+        if len(hashes) < len(getters):
+            logger.info(f"Saving dataset at `{path}` cancelled")
+            os.remove(path)
 
 
 def loadData(env):
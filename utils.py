@@ -3,6 +3,7 @@ import re
 import numpy as np
 import glob
 import importlib
+import sys
 import os
 import logging
 
@@ -94,6 +95,8 @@ def loadModules(UI, env, headless=False):
 
         spec = importlib.util.spec_from_file_location(f"module_{name}", path)
         mod = importlib.util.module_from_spec(spec)
+        # registered so that the source of module classes can be looked up
+        sys.modules[spec.name] = mod
         spec.loader.exec_module(mod)
 
         mods[name] = mod
@@ -136,6 +139,32 @@ def md5FromArraysAndStrings(*args):
     return fp.hexdigest()
 
 
+def combineMD5(*hashes):
+    """
+    Combines incrementally updated md5 objects (one per array, fed chunk by
+    chunk) into the same fingerprint md5FromArraysAndStrings would give for
+    the full arrays.
+    """
+    fp = hashlib.md5()
+
+    for h in hashes:
+        fp.update(h.digest())
+
+    return fp.hexdigest()
+
+
+def getFileStamp(path):
+    """
+    (mtime, size) of a file, used to detect whether it changed since it was
+    last read. None if the file does not exist.
+    """
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    return (stat.st_mtime_ns, stat.st_size)
+
+
 def removeExtension(path):
     if "." not in path:
         return path